@@ -0,0 +1,601 @@
+"""
+HTML post rasm generatori uchun benchmark.
+
+Ishga tushirish:
+    python bench_render.py
+    python bench_render.py --repeat 20
+    python bench_render.py --suite stages          # bosqichlar vaqti + xotira cho'qqisi
+    python bench_render.py --suite golden          # vizual regressiya tekshiruvi (xato bo'lsa exit 1)
+    python bench_render.py --suite golden --update-golden
+
+Telegramga ulanmaydi: mikro-benchmarklar faqat post_renderer modulini ishlatadi,
+"pipeline" esa bot.py ni soxta token va soxta get_file/download_file bilan yuklaydi.
+"""
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+from PIL import Image, ImageDraw, ImageFilter  # noqa: E402
+
+import post_renderer as renderer  # noqa: E402
+
+
+def timeit(fn, repeat: int) -> float:
+    """Eng yaxshi natija (ms)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def gradient_reference_loop(width, height, color, angle_deg=-225):
+    """Eski piksel-piksel implementatsiya (taqqoslash uchun)"""
+    layer = Image.new("RGBA", (width, height))
+    pixels = layer.load()
+    angle_rad = math.radians(angle_deg)
+    dx = math.cos(angle_rad)
+    dy = math.sin(angle_rad)
+    center_x, center_y = width / 2, height / 2
+    max_dist = math.sqrt(width**2 + height**2) / 2
+    for x in range(width):
+        for y in range(height):
+            distance = (x - center_x) * dx + (y - center_y) * dy
+            ratio = max(0.0, min(1.0, (distance + max_dist) / (2 * max_dist)))
+            r = int(color[0] * (1 - ratio) + 0 * ratio)
+            g = int(color[1] * (1 - ratio) + 0 * ratio)
+            b = int(color[2] * (1 - ratio) + 0 * ratio)
+            a = int(60 + 80 * ratio)
+            pixels[x, y] = (r, g, b, a)
+    return layer
+
+
+def bench_gradient(repeat: int):
+    width, height, color = int(1920 * 0.6), 1080, (246, 79, 89)
+    new_ms = timeit(lambda: renderer.make_diagonal_gradient(width, height, color), repeat)
+    old_ms = timeit(lambda: gradient_reference_loop(width, height, color), 1)
+    diff = np.abs(
+        np.asarray(renderer.make_diagonal_gradient(width, height, color), dtype=np.int16)
+        - np.asarray(gradient_reference_loop(width, height, color), dtype=np.int16)
+    ).max()
+    print(f"gradient {width}x{height}: loop {old_ms:.1f} ms -> numpy {new_ms:.2f} ms "
+          f"(x{old_ms / new_ms:.0f}), max piksel farqi: {diff}")
+
+
+def button_reference_loop(canvas, x, y, btn_text="TOMOSHA QILISH", font_size=20):
+    """Eski tugma chizish usuli: btn_draw.point() + ikki marta maska"""
+    draw = ImageDraw.Draw(canvas)
+    btn_font = renderer.load_font(font_size, bold=True)
+    bbox = draw.textbbox((0, 0), btn_text, font=btn_font)
+    text_w = bbox[2] - bbox[0]
+    text_h = bbox[3] - bbox[1]
+    btn_w = text_w + 40
+    btn_h = text_h + 30
+    start_color, end_color = (30, 144, 255), (220, 20, 60)
+    gradient_btn = Image.new('RGB', (btn_w, btn_h))
+    btn_draw = ImageDraw.Draw(gradient_btn)
+    for px in range(btn_w):
+        ratio = px / (btn_w - 1) if btn_w > 1 else 0
+        r = int(start_color[0] + (end_color[0] - start_color[0]) * ratio)
+        g = int(start_color[1] + (end_color[1] - start_color[1]) * ratio)
+        b = int(start_color[2] + (end_color[2] - start_color[2]) * ratio)
+        for py in range(btn_h):
+            btn_draw.point((px, py), fill=(r, g, b))
+    btn_mask = Image.new('L', (btn_w, btn_h), 0)
+    ImageDraw.Draw(btn_mask).rounded_rectangle([0, 0, btn_w, btn_h], radius=30, fill=255)
+    gradient_rgba = Image.new('RGBA', (btn_w, btn_h), (0, 0, 0, 0))
+    gradient_rgba.paste(gradient_btn, (0, 0), btn_mask)
+    canvas.paste(gradient_rgba, (x, y), btn_mask)
+    draw.rounded_rectangle([x, y, x + btn_w, y + btn_h], radius=30, outline=(255, 255, 255), width=3)
+    draw.text((x + (btn_w - text_w) // 2, y + (btn_h - text_h) // 2 - 5), btn_text, fill=(255, 255, 255), font=btn_font)
+
+
+def bench_button(repeat: int):
+    base = Image.new("RGBA", (400, 200), (40, 60, 80, 255))
+
+    def new_way():
+        canvas = base.copy()
+        sprite = renderer.build_button_sprite("TOMOSHA QILISH", 20)
+        canvas.paste(sprite, (50, 50), sprite)
+        return canvas
+
+    def old_way():
+        canvas = base.copy()
+        button_reference_loop(canvas, 50, 50)
+        return canvas
+
+    old_ms = timeit(old_way, repeat)
+    renderer.layer_cache.clear()
+    cold_ms = timeit(new_way, 1)
+    warm_ms = timeit(new_way, repeat)
+    diff = np.abs(np.asarray(new_way(), dtype=np.int16) - np.asarray(old_way(), dtype=np.int16)).max()
+    print(f"tugma: point() sikl {old_ms:.2f} ms -> sprite sovuq {cold_ms:.2f} ms, issiq {warm_ms * 1000:.0f} µs "
+          f"(nusxa bilan), max piksel farqi: {diff}")
+
+
+def palette_reference_loop(image):
+    """Eski usul: markaziy 100x100 bo'lakning o'rtacha rangi piksel-piksel"""
+    cx, cy = image.size[0] // 2, image.size[1] // 2
+    sample = image.crop((cx - 50, cy - 50, cx + 50, cy + 50))
+    pixels = sample.load()
+    total, count = [0, 0, 0], 0
+    for x in range(sample.size[0]):
+        for y in range(sample.size[1]):
+            r, g, b, a = pixels[x, y]
+            if a > 0:
+                total[0] += r
+                total[1] += g
+                total[2] += b
+                count += 1
+    return tuple(int(c / count) for c in total) if count else (100, 100, 100)
+
+
+def synthetic_poster(width=1920, height=1080):
+    """Bir nechta rangli bo'laklardan iborat soxta poster"""
+    rng = np.random.default_rng(7)
+    arr = np.zeros((height, width, 4), dtype=np.uint8)
+    arr[..., 3] = 255
+    blocks = [(20, 24, 40), (200, 60, 70), (240, 200, 180), (40, 110, 190)]
+    for i, color in enumerate(blocks):
+        arr[:, i * width // 4:(i + 1) * width // 4, :3] = color
+    noise = rng.integers(-12, 12, size=(height, width, 3))
+    arr[..., :3] = np.clip(arr[..., :3].astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    return Image.fromarray(arr, "RGBA")
+
+
+def bench_palette(repeat: int):
+    poster = synthetic_poster()
+    old_ms = timeit(lambda: palette_reference_loop(poster), repeat)
+    new_ms = timeit(lambda: renderer.pick_theme_colors(renderer.extract_palette(poster, k=6)), repeat)
+    palette = renderer.extract_palette(poster, k=6)
+    dominant, accent = renderer.pick_theme_colors(palette)
+    print(f"palitra 1920x1080: markaz o'rtachasi {old_ms:.2f} ms -> quantize {new_ms:.2f} ms; "
+          f"dominant {dominant}, aksent {accent}")
+    print("  " + ", ".join(f"{rgb} {share:.0%}" for rgb, share in palette))
+
+
+def font_probe_reference(size, bold=False):
+    """Eski load_font: har chaqiruvda nomzod fayllarni ImageFont.truetype orqali sinab ko'radi"""
+    from PIL import ImageFont
+    names = [
+        "Poppins-Bold.ttf" if bold else "Poppins-Regular.ttf",
+        "arialbd.ttf" if bold else "arial.ttf",
+        "Arial Bold.ttf" if bold else "Arial.ttf",
+        "DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf",
+    ]
+    for name in names:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+def bench_fonts(repeat: int):
+    render_fonts = [(60, True), (36, True), (24, False), (20, True), (28, True)]
+    registry = renderer.font_registry
+
+    def per_render(load):
+        for size, bold in render_fonts:
+            load(size, bold)
+
+    old_ms = timeit(lambda: per_render(font_probe_reference), repeat)
+    registry.clear()
+    cold_ms = timeit(lambda: per_render(renderer.load_font), 1)
+    cold = registry.stats()
+    warm_ms = timeit(lambda: per_render(renderer.load_font), repeat)
+    print(f"fontlar (5 ta/render): qidiruv {old_ms:.2f} ms -> registry sovuq {cold_ms:.2f} ms "
+          f"(aniqlash {cold['resolve_ms']} ms, yuklash {cold['load_ms']} ms), issiq {warm_ms * 1000:.0f} µs")
+    print(f"  {registry.stats()['paths']}")
+
+
+def bench_encoders(repeat: int):
+    """To'liq post rasmini har bir formatda kodlash vaqti va hajmi"""
+    poster = BytesIO()
+    synthetic_poster(1280, 720).convert("RGB").save(poster, format="JPEG", quality=92)
+    png = renderer.render_post_image(poster.getvalue(), "Bench sarlavha", "Tavsif " * 30, "Action, Drama", 7, "png")
+    card = Image.open(BytesIO(png))
+    card.load()
+
+    def old_png():
+        buffer = BytesIO()
+        card.convert("RGB").save(buffer, format="PNG", quality=95, optimize=True)
+        return buffer.getvalue()
+
+    old_ms = timeit(old_png, max(1, repeat // 5))
+    print(f"kodlash 1920x1080: PNG optimize (eski) {old_ms:.1f} ms, {len(old_png()) / 1024:.0f} KB")
+    for name in renderer.ENCODERS:
+        ms = timeit(lambda: renderer.encode_image(card, name), repeat)
+        print(f"  {name:5s} {ms:6.1f} ms, {len(renderer.encode_image(card, name)) / 1024:.0f} KB")
+
+
+def wrap_text_reference(text, font, max_width, draw):
+    """Eski wrap_text: har bir prefiks uchun ' '.join + textbbox (O(n^2))"""
+    lines, current = [], []
+    for word in text.split():
+        test_line = " ".join(current + [word])
+        bbox = draw.textbbox((0, 0), test_line, font=font)
+        if bbox[2] - bbox[0] <= max_width:
+            current.append(word)
+        else:
+            if current:
+                lines.append(" ".join(current))
+            current = [word]
+    if current:
+        lines.append(" ".join(current))
+    return lines
+
+
+def bench_layout(repeat: int):
+    desc = ("Qahramon qishloqdan chiqib, dunyoning eng kuchli sehrgari bo'lish uchun "
+            "uzoq va xavfli sayohatga otlanadi. Yo'lda do'stlar, dushmanlar va sirlar kutmoqda. ") * 4
+    font = renderer.load_font(24)
+    draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    # Eski kod matnni ikki marta qatorlardi (o'lchash va chizish uchun)
+    old_ms = timeit(lambda: [wrap_text_reference(desc, font, 1180, draw) for _ in range(2)], repeat)
+    renderer.word_width.cache_clear()
+    cold_ms = timeit(lambda: renderer.layout_text(desc, font, 1180, 30), 1)
+    warm_ms = timeit(lambda: renderer.layout_text(desc, font, 1180, 30), repeat)
+    old_lines = wrap_text_reference(desc, font, 1180, draw)
+    new_lines = renderer.layout_text(desc, font, 1180, 30).lines
+    same = sum(a == b for a, b in zip(old_lines, new_lines))
+    print(f"qatorlash ({len(desc.split())} so'z, 2 bosqich): textbbox {old_ms:.2f} ms -> layout sovuq {cold_ms:.2f} ms, "
+          f"issiq {warm_ms * 1000:.0f} µs; qatorlar {len(old_lines)}/{len(new_lines)}, bir xil: {same}")
+    cut = renderer.layout_text(desc, font, 1180, 30, max_lines=3)
+    print(f"  max_lines=3: ...{cut.lines[-1][-40:]!r} ({cut.widths[-1]:.0f}px)")
+
+
+def shadow_reference(canvas, x, y, lines, font, line_height, offset):
+    """Eski soya: har bir qator 8 ta siljishda + 1 marta asosiy (9 ta rasterizatsiya)"""
+    draw = ImageDraw.Draw(canvas)
+    for i, line in enumerate(lines):
+        ty = y + i * line_height
+        for dx, dy in renderer.ring_offsets(offset):
+            draw.text((x + dx, ty + dy), line, fill=(0, 0, 0, 220), font=font)
+        draw.text((x, ty), line, fill=(255, 255, 255), font=font)
+
+
+def bench_shadow(repeat: int):
+    base = synthetic_poster(1600, 400)
+    font = renderer.load_font(60, bold=True)
+    lines = ["SHINGEKI NO KYOJIN FINAL", "SEASON PART TWO"]
+
+    def old_way():
+        canvas = base.copy()
+        shadow_reference(canvas, 60, 60, lines, font, 65, 4)
+        return canvas.convert("RGB")
+
+    def new_way():
+        canvas = base.copy()
+        renderer.draw_text_block(canvas, (60, 60), lines, font, 65,
+                                 fill=(255, 255, 255, 255), shadow_offsets=renderer.ring_offsets(4))
+        return canvas.convert("RGB")
+
+    old_ms = timeit(old_way, repeat)
+    new_ms = timeit(new_way, repeat)
+    diff = np.abs(np.asarray(old_way(), dtype=np.int16) - np.asarray(new_way(), dtype=np.int16))
+    print(f"soya ({len(lines)} qator sarlavha): 9x draw.text {old_ms:.2f} ms -> maska + dilate {new_ms:.2f} ms; "
+          f"piksel farqi max {diff.max()}, o'rtacha {diff.mean():.3f}, farqli piksellar {(diff.max(axis=2) > 8).mean():.2%}")
+
+
+# ==================== FIXTURE POSTERLAR ====================
+# (nom, poster o'lchami yoki None - fallback, format, sarlavha, tavsif, janr, qism)
+LONG_DESC = ("Qahramon qishloqdan chiqib, dunyoning eng kuchli sehrgari bo'lish uchun "
+             "uzoq va xavfli sayohatga otlanadi. Yo'lda do'stlar, dushmanlar va sirlar kutmoqda. ") * 4
+FIXTURES = [
+    ("hd_short", (1280, 720), "JPEG", "Naruto", "Yosh ninja Xokage bo'lishni orzu qiladi.",
+     "Action, Adventure", 1),
+    ("fullhd_long", (1920, 1080), "JPEG", "Shingeki no Kyojin: The Final Season Kanketsu-hen Part 2",
+     LONG_DESC, "Action, Drama, Fantasy, Mystery", 12),
+    ("portrait_huge_title", (700, 1000), "JPEG", "Sousou no Frieren " * 6, "", "", 105),
+    ("small_png_unicode", (320, 180), "PNG", "O'g'il bola va qush — Kimi-tachi wa dō ikiru ka",
+     LONG_DESC[:180], "Drama", 3),
+    ("no_poster", None, None, "Poster yo'q", "Fallback fon bilan render.", "Comedy", 2),
+    ("uhd_poster", (3840, 2160), "JPEG", "Kimetsu no Yaiba", LONG_DESC[:240], "Action, Fantasy", 8),
+]
+
+
+def fixture_poster(width: int, height: int, fmt: str = "JPEG", seed: int = 3) -> bytes:
+    """Silliq gradient va bir nechta rangli shakllardan iborat deterministik poster"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([40 + 150 * x / width, 30 + 80 * y / height, 120 - 60 * x / width], axis=-1)
+    image = Image.fromarray(base.clip(0, 255).astype(np.uint8), "RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        cx, cy = rng.integers(0, width), rng.integers(0, height)
+        r = int(rng.integers(min(width, height) // 10, min(width, height) // 3))
+        draw.ellipse((cx - r, cy - r, cx + r, cy + r), fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+    buffer = BytesIO()
+    image.save(buffer, format=fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+def fixture_inputs():
+    """(nom, poster baytlari yoki None, render argumentlari)"""
+    for name, size, fmt, title, desc, genre, episode in FIXTURES:
+        poster = fixture_poster(*size, fmt) if size else None
+        yield name, poster, (title, desc, genre, episode)
+
+
+# ==================== BOSQICHLAR VA XOTIRA ====================
+STAGES = ("decode", "resize", "palette", "gradient", "blur", "text", "encode")
+
+
+def _vm_status_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def _peak_render_mb(poster, render_args, profile=renderer.DEFAULT_PROFILE) -> float:
+    """
+    Yangi (spawn) ishchida bitta render xotira cho'qqisi: VmHWM - VmRSS, MB.
+    Fork yaramaydi: ota jarayonda bo'shatilgan malloc xotirasi rezident qoladi va o'lchovni kamaytiradi.
+    """
+    logging.getLogger().setLevel(logging.CRITICAL)
+    renderer.warm_up_worker()
+    renderer.compile_layout("", profile)
+    try:
+        # VmHWM ni joriy RSS ga tushiradi (Linux 4.0+)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return float("nan")
+    before = _vm_status_kb("VmRSS")
+    renderer.render_post_image(poster, *render_args, profile=profile)
+    return (_vm_status_kb("VmHWM") - before) / 1024
+
+
+def bench_stages(repeat: int):
+    """Har bir profil va fixture uchun bosqichlar medianasi (ms) va bitta renderning xotira cho'qqisi"""
+    renderer.font_registry.preload()
+    spawn = multiprocessing.get_context("spawn")
+    for profile, (width, height) in renderer.RENDER_PROFILES.items():
+        renderer.compile_layout("", profile)
+        print(f"profil {profile} ({width}x{height})")
+        print(f"{'fixture':22s} {'jami':>6s} " + " ".join(f"{stage:>8s}" for stage in STAGES) + "   xotira")
+        for name, poster, render_args in fixture_inputs():
+            runs = []
+            for _ in range(repeat):
+                renderer.layer_cache.clear()  # sovuq bosqichlar; issiq yo'l bench_layers da
+                timings = {}
+                renderer.render_post_image(poster, *render_args, profile=profile, timings=timings)
+                runs.append(timings)
+            median = {stage: statistics.median(run.get(stage, 0.0) for run in runs) for stage in STAGES}
+            total = statistics.median(sum(run.values()) for run in runs)
+            with spawn.Pool(1) as pool:
+                peak_mb = pool.apply(_peak_render_mb, (poster, render_args, profile))
+            print(f"{name:22s} {total:6.1f} " + " ".join(f"{median[stage]:8.1f}" for stage in STAGES)
+                  + f"   +{peak_mb:.0f} MB")
+
+
+def bench_decode(repeat: int):
+    """4K JPEG poster: to'liq RGBA dekodlash + LANCZOS va draft/reduce + RGB, har bir profil uchun"""
+    poster = fixture_poster(3840, 2160)
+
+    def full_decode(size):
+        with Image.open(BytesIO(poster)) as source:
+            return source.convert("RGBA").resize(size, Image.Resampling.LANCZOS)
+
+    def draft_decode(size):
+        with Image.open(BytesIO(poster)) as source:
+            return renderer.decode_reduced(source, size).resize(size, Image.Resampling.LANCZOS)
+
+    for profile, size in renderer.RENDER_PROFILES.items():
+        old_ms = timeit(lambda: full_decode(size), repeat)
+        new_ms = timeit(lambda: draft_decode(size), repeat)
+        with Image.open(BytesIO(poster)) as source:
+            decoded = renderer.decode_reduced(source, size).size
+        diff = np.abs(np.asarray(full_decode(size).convert("RGB"), dtype=np.int16)
+                      - np.asarray(draft_decode(size), dtype=np.int16))
+        print(f"dekodlash 3840x2160 JPEG -> {profile}: RGBA + LANCZOS {old_ms:.1f} ms -> draft {decoded[0]}x{decoded[1]} "
+              f"RGB {new_ms:.1f} ms; piksel farqi o'rtacha {diff.mean():.2f}, max {diff.max()}")
+
+
+def bench_layers(repeat: int):
+    """Qatlamlar keshi: bir xil poster, boshqa qism/sarlavha - faqat matn chizish va kodlash qoladi"""
+    renderer.layer_cache.clear()
+    for name, poster, (title, desc, genre, episode) in fixture_inputs():
+        cold_ms = timeit(lambda: renderer.render_post_image(poster, title, desc, genre, episode), 1)
+        warm = []
+        for i in range(repeat):
+            timings = {}
+            renderer.render_post_image(poster, title, desc, genre, episode + i + 1, timings=timings)
+            warm.append(timings)
+        median = {stage: statistics.median(run.get(stage, 0.0) for run in warm) for stage in STAGES}
+        total = statistics.median(sum(run.values()) for run in warm)
+        print(f"qatlamlar {name:22s} sovuq {cold_ms:6.1f} ms -> issiq {total:6.1f} ms "
+              f"(fon {median['decode']:.1f}, blur {median['blur']:.1f}, matn {median['text']:.1f}, "
+              f"kodlash {median['encode']:.1f})")
+    stats = renderer.layer_cache.stats()
+    print(f"  layer_cache: {stats['entries']} ta, {stats['bytes'] / 2**20:.1f}/{stats['max_bytes'] / 2**20:.0f} MB, "
+          f"hit {stats['hits']}, miss {stats['misses']}, chiqarilgan {stats['evictions']}")
+
+
+def bench_batch(repeat: int, episodes: int = 12):
+    """Mavsum: har bir qism alohida render_post_image va bitta render_post_batch (bitta ishchida)"""
+    poster = fixture_poster(1280, 720)
+    args = ("Mavsum sarlavhasi", LONG_DESC[:300], "Action, Drama")
+    numbers = list(range(1, episodes + 1))
+    single_ms = timeit(lambda: [renderer.render_post_image(poster, *args, ep) for ep in numbers], max(1, repeat // 5))
+    batch_ms = timeit(lambda: renderer.render_post_batch(poster, *args, numbers), max(1, repeat // 5))
+    same = renderer.render_post_batch(poster, *args, [5])[0] == renderer.render_post_image(poster, *args, 5)
+    print(f"mavsum ({episodes} qism, 1 ishchi): alohida {single_ms:.0f} ms -> batch {batch_ms:.0f} ms "
+          f"({batch_ms / episodes:.1f} ms/qism), baytma-bayt bir xil: {same}")
+
+
+# ==================== GOLDEN RASMLAR ====================
+GOLDEN_DIR = os.path.join(ROOT, "bench_golden")
+GOLDEN_SIZE = (480, 270)
+# Perseptual tolerantlik: kichraytirilgan va xiralashtirilgan rasmlarda piksel farqi
+GOLDEN_PIXEL_THRESHOLD = 24  # 0-255, shundan katta farq "farqli piksel" hisoblanadi
+GOLDEN_MAX_MEAN = 2.0
+GOLDEN_MAX_SHARE = 0.01
+# Golden rasmlar shu papkadagi fontlar bilan chizilgan (fonts/DejaVuSans*.ttf)
+GOLDEN_FONTS_DIR = os.path.join(ROOT, "fonts")
+
+
+def golden_thumbnail(data: bytes) -> Image.Image:
+    with Image.open(BytesIO(data)) as image:
+        return image.convert("RGB").resize(GOLDEN_SIZE, Image.Resampling.BOX)
+
+
+def perceptual_diff(expected: Image.Image, actual: Image.Image) -> tuple:
+    """(o'rtacha farq, farqli piksellar ulushi) - JPEG shovqini va subpiksel siljishlarni e'tiborsiz qoldiradi"""
+    soften = ImageFilter.GaussianBlur(1)
+    a = np.asarray(expected.filter(soften), dtype=np.int16)
+    b = np.asarray(actual.filter(soften), dtype=np.int16)
+    diff = np.abs(a - b).max(axis=2)
+    return float(diff.mean()), float((diff > GOLDEN_PIXEL_THRESHOLD).mean())
+
+
+def golden_font_problems() -> list:
+    """Repodagi fonts/ dan emas, tizimdan (yoki Pillow standarti) olingan fontlar ro'yxati"""
+    bundled = os.path.realpath(GOLDEN_FONTS_DIR) + os.sep
+    problems = []
+    for weight in renderer.PRELOAD_FONT_SIZES:
+        path = renderer.font_registry.resolve("sans", weight)
+        if not path or not os.path.realpath(path).startswith(bundled):
+            problems.append(f"sans/{weight} -> {path or 'Pillow standart fonti'}")
+    return problems
+
+
+def check_golden(update: bool = False, max_mean: float = GOLDEN_MAX_MEAN,
+                 max_share: float = GOLDEN_MAX_SHARE) -> bool:
+    """
+    Fixture renderlarini bench_golden/*.png bilan solishtiradi; update=True bo'lsa qayta yozadi.
+    Golden rasmlar fonts/ dagi fontlarga bog'liq: ular topilmasa tekshiruv ishlamaydi (False),
+    fonts/ papkasi o'zgarsa --update-golden bilan yangilang.
+    """
+    problems = golden_font_problems()
+    if problems:
+        print(f"golden: fontlar {GOLDEN_FONTS_DIR} dan olinmadi, natija hostga bog'liq bo'lardi - "
+              f"tekshiruv o'tkazilmadi:", file=sys.stderr)
+        for problem in problems:
+            print(f"  {problem}", file=sys.stderr)
+        return False
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    passed = True
+    for name, poster, render_args in fixture_inputs():
+        actual = golden_thumbnail(renderer.render_post_image(poster, *render_args))
+        path = os.path.join(GOLDEN_DIR, f"{name}.png")
+        if update or not os.path.exists(path):
+            actual.save(path, optimize=True)
+            print(f"golden {name}: yozildi ({os.path.getsize(path) / 1024:.0f} KB)")
+            continue
+        with Image.open(path) as expected:
+            mean, share = perceptual_diff(expected.convert("RGB"), actual)
+        ok = mean <= max_mean and share <= max_share
+        passed &= ok
+        print(f"golden {name}: {'OK' if ok else 'FARQ'} o'rtacha {mean:.2f} (<= {max_mean}), "
+              f"farqli {share:.2%} (<= {max_share:.2%})")
+        if not ok:
+            actual_path = os.path.join(tempfile.gettempdir(), f"golden_{name}_actual.png")
+            actual.save(actual_path)
+            print(f"  haqiqiy natija: {actual_path}")
+    return passed
+
+
+# ==================== TO'LIQ PIPELINE (bot.py) ====================
+def bench_pipeline(repeat: int):
+    """
+    generate_html_post_image_pillow ni oflayn ishga tushiradi: bot.get_file/download_file soxta,
+    keshlar va media_store vaqtinchalik papkada. Sovuq = yuklash + render_pool, issiq = render keshidan.
+    """
+    workdir = tempfile.mkdtemp(prefix="bench_render_")
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+    os.environ["RENDER_CACHE_DIR"] = os.path.join(workdir, "render_cache")
+    os.environ["POSTER_CACHE_DIR"] = os.path.join(workdir, "poster_cache")
+    os.environ["MEDIA_STORE_DIR"] = os.path.join(workdir, "media_store")
+    import bot as bot_module
+    from aiogram.types import File
+    logging.getLogger().setLevel(logging.CRITICAL)  # bot.py INFO darajasini yoqadi
+
+    posters = {name: poster for name, poster, _ in fixture_inputs()}
+    downloads = []
+
+    async def get_file(file_id):
+        if posters.get(file_id) is None:
+            raise RuntimeError("fixture posteri yo'q")
+        return File(file_id=file_id, file_unique_id=f"bench-{file_id}", file_path=f"photos/{file_id}")
+
+    async def download_file(file_path, destination=None):
+        downloads.append(file_path)
+        with open(destination, "wb") as f:
+            f.write(posters[os.path.basename(file_path)])
+
+    object.__setattr__(bot_module.bot, "get_file", get_file)
+    object.__setattr__(bot_module.bot, "download_file", download_file)
+
+    async def render(name, title, desc, genre, episode):
+        key = await bot_module.generate_html_post_image_pillow(
+            title=title, desc=desc, genre=genre, file_id=name, anime_code="bench", episode_num=episode)
+        os.remove(bot_module.media_store.path(key))
+
+    async def main():
+        bot_module.render_pool.start()
+        try:
+            for name, _, (title, desc, genre, episode) in fixture_inputs():
+                start = time.perf_counter()
+                await render(name, title, desc, genre, episode)
+                cold_ms = (time.perf_counter() - start) * 1000
+                warm = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    await render(name, title, desc, genre, episode)
+                    warm.append((time.perf_counter() - start) * 1000)
+                print(f"pipeline {name:22s} sovuq {cold_ms:6.1f} ms, issiq {statistics.median(warm):5.2f} ms")
+            print(f"  yuklashlar: {len(downloads)}, render_cache: {bot_module.render_cache.metrics()}")
+        finally:
+            # wait=True: Python 3.11 da wait=False atexit paytida yopilgan pipe ga yozib xato beradi
+            bot_module.render_pool.shutdown(wait=True)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rasm generatori benchmarki")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--suite", choices=("all", "micro", "stages", "pipeline", "golden"), default="all")
+    parser.add_argument("--update-golden", action="store_true", help="bench_golden/*.png ni qayta yozish")
+    parser.add_argument("--max-mean", type=float, default=GOLDEN_MAX_MEAN)
+    parser.add_argument("--max-share", type=float, default=GOLDEN_MAX_SHARE)
+    args = parser.parse_args()
+    # Fallback fixture ataylab xato loglaydi - natijalar jadvalini buzmasin
+    logging.getLogger().setLevel(logging.CRITICAL)
+    if args.suite in ("all", "micro"):
+        bench_gradient(args.repeat)
+        bench_button(args.repeat)
+        bench_palette(args.repeat)
+        bench_fonts(args.repeat)
+        bench_layout(args.repeat)
+        bench_shadow(args.repeat)
+        bench_encoders(args.repeat)
+    if args.suite in ("all", "stages"):
+        bench_stages(args.repeat)
+        bench_decode(args.repeat)
+        bench_layers(args.repeat)
+        bench_batch(args.repeat)
+    if args.suite in ("all", "pipeline"):
+        bench_pipeline(args.repeat)
+    if args.suite in ("all", "golden"):
+        if not check_golden(args.update_golden, args.max_mean, args.max_share):
+            sys.exit(1)
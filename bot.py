@@ -7,10 +7,13 @@ import random
 import html
 import tempfile
 import shutil
+import sys
+from collections import OrderedDict, deque
+from contextvars import ContextVar
 from datetime import datetime
 from typing import List, Dict
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -24,6 +27,7 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram import exceptions
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer, SimpleFilesPathWrapper
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 
 from dotenv import load_dotenv
@@ -33,6 +37,7 @@ load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_ID = int(os.getenv("TELEGRAM_ADMIN_ID", "6607605946"))
 PORT = int(os.getenv("PORT", 10000))
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")  # API veb serveri; faqat lokal kirish uchun "127.0.0.1"
 
 # Token tekshiruvi
 if not TOKEN:
@@ -43,8 +48,108 @@ print(f"✅ Token: {TOKEN[:10]}...")
 print(f"✅ Admin: {ADMIN_ID}")
 print(f"✅ Port: {PORT}")
 
+# ==================== BOT API HTTP SESSIYASI ====================
+# Barcha Bot obyektlari bitta sozlangan sessiyadan foydalanadi: ulanishlar puli,
+# DNS kesh, keep-alive va har bir API metodi uchun alohida timeout.
+BOT_HTTP_POOL_SIZE = int(os.getenv("BOT_HTTP_POOL_SIZE", 100))
+BOT_HTTP_DNS_TTL = int(os.getenv("BOT_HTTP_DNS_TTL", 300))
+BOT_HTTP_KEEPALIVE = float(os.getenv("BOT_HTTP_KEEPALIVE", 60))
+BOT_DOWNLOAD_TIMEOUT = int(os.getenv("BOT_DOWNLOAD_TIMEOUT", 120))
+
+# Lokal telegram-bot-api server rejimi (--local yoki BOT_API_LOCAL=1).
+# Bu rejimda getFile fayl tizimidagi yo'lni qaytaradi va fayllar HTTP orqali yuklanmaydi,
+# 20 MB chegarasi ham yo'q.
+BOT_API_LOCAL = "--local" in sys.argv or os.getenv("BOT_API_LOCAL", "0") == "1"
+BOT_API_URL = os.getenv("BOT_API_URL", "http://localhost:8081")
+# Server va bot fayllarni turli yo'lda ko'rsa (masalan, Docker volume), moslashtirish uchun
+BOT_API_SERVER_FILES = os.getenv("BOT_API_SERVER_FILES")
+BOT_API_LOCAL_FILES = os.getenv("BOT_API_LOCAL_FILES")
+
+if BOT_API_LOCAL:
+    if BOT_API_SERVER_FILES and BOT_API_LOCAL_FILES:
+        bot_api_server = TelegramAPIServer.from_base(
+            BOT_API_URL,
+            is_local=True,
+            wrap_local_file=SimpleFilesPathWrapper(BOT_API_SERVER_FILES, BOT_API_LOCAL_FILES),
+        )
+    else:
+        bot_api_server = TelegramAPIServer.from_base(BOT_API_URL, is_local=True)
+    print(f"✅ Lokal Bot API: {BOT_API_URL}")
+else:
+    bot_api_server = PRODUCTION
+
+# Metod nomi (Bot API) -> timeout (soniya). Ro'yxatda bo'lmaganlar sessiya timeoutini oladi.
+BOT_METHOD_TIMEOUTS = {
+    "getChatMember": 5,
+    "getChat": 5,
+    "getMe": 5,
+    "answerCallbackQuery": 5,
+    "sendMessage": 15,
+    "editMessageText": 15,
+    "getFile": 15,
+    "sendPhoto": 60,
+    "sendDocument": 120,
+    "sendVideo": 120,
+}
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """Telegram Bot API uchun sozlangan aiohttp sessiyasi"""
+
+    def __init__(self, pool_size: int, dns_ttl: int, keepalive: float, method_timeouts: dict,
+                 download_timeout: int, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init.update(
+            limit=pool_size,
+            limit_per_host=pool_size,
+            ttl_dns_cache=dns_ttl,
+            use_dns_cache=True,
+            keepalive_timeout=keepalive,
+            enable_cleanup_closed=True,
+        )
+        self.pool_size = pool_size
+        self.method_timeouts = method_timeouts
+        self.download_timeout = download_timeout
+
+    async def make_request(self, bot, method, timeout=None):
+        if timeout is None:
+            timeout = self.method_timeouts.get(method.__api_method__)
+        return await super().make_request(bot, method, timeout)
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        # bot.download_file() standart 30 soniya beradi — katta videolar uchun kam
+        async for chunk in super().stream_content(
+            url, headers=headers, timeout=max(timeout, self.download_timeout),
+            chunk_size=chunk_size, raise_for_status=raise_for_status
+        ):
+            yield chunk
+
+    def pool_stats(self) -> dict:
+        """Ulanishlar pulidan foydalanish (monitoring uchun)"""
+        connector = self._session.connector if self._session and not self._session.closed else None
+        if connector is None:
+            return {"limit": self.pool_size, "in_use": 0, "idle": 0, "utilization": 0.0}
+        in_use = len(getattr(connector, '_acquired', ()))
+        idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+        return {
+            "limit": self.pool_size,
+            "in_use": in_use,
+            "idle": idle,
+            "utilization": round(in_use / self.pool_size, 3) if self.pool_size else 0.0,
+        }
+
+
+bot_session = TunedAiohttpSession(
+    pool_size=BOT_HTTP_POOL_SIZE,
+    dns_ttl=BOT_HTTP_DNS_TTL,
+    keepalive=BOT_HTTP_KEEPALIVE,
+    method_timeouts=BOT_METHOD_TIMEOUTS,
+    download_timeout=BOT_DOWNLOAD_TIMEOUT,
+    api=bot_api_server,
+)
+
 # Bot va Dispatcher
-bot = Bot(token=TOKEN)
+bot = Bot(token=TOKEN, session=bot_session)
 dp = Dispatcher()
 
 # ==================== WEB SERVER ====================
@@ -71,7 +176,7 @@ async def main():
     )
     
     # Botni yaratish
-    bot = Bot(token=TOKEN)
+    bot = Bot(token=TOKEN, session=bot_session)
     dp = Dispatcher()
     
     try:
@@ -84,7 +189,7 @@ async def main():
 
 
 # Botni ishga tushirish (Global obyekt)
-bot = Bot(token=TOKEN)
+bot = Bot(token=TOKEN, session=bot_session)
 dp = Dispatcher()
 
 # User states dictionary
@@ -303,7 +408,91 @@ def init_db():
             ''')
             logging.info("'chatbot_responses' jadvali yaratildi")
 
+        if 'outbox' not in existing_tables:
+            cursor.execute('''
+                CREATE TABLE outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    idempotency_key TEXT UNIQUE NOT NULL,
+                    method TEXT NOT NULL CHECK(method IN ('send_message', 'send_photo', 'send_video')),
+                    chat_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    media_blob BLOB,
+                    media_key TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending', 'sending', 'sent', 'failed')),
+                    attempts INTEGER DEFAULT 0,
+                    last_error TEXT,
+                    message_id INTEGER,
+                    next_attempt_at REAL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    sent_at TIMESTAMP
+                )
+            ''')
+            logging.info("'outbox' jadvali yaratildi")
+        else:
+            cursor.execute("PRAGMA table_info(outbox)")
+            columns = [column[1] for column in cursor.fetchall()]
+            if 'media_key' not in columns:
+                cursor.execute("ALTER TABLE outbox ADD COLUMN media_key TEXT")
+                logging.info("'outbox' jadvaliga media_key maydoni qo'shildi")
+
+        if 'layout_templates' not in existing_tables:
+            # Post rasmi uchun vizual uslublar (post_renderer.DEFAULT_LAYOUT ustidan JSON o'zgartirishlar)
+            cursor.execute('''
+                CREATE TABLE layout_templates (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT UNIQUE NOT NULL,
+                    spec TEXT NOT NULL DEFAULT '',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute("INSERT INTO layout_templates (name, spec) VALUES (?, ?)", ("Standart", ""))
+            logging.info("'layout_templates' jadvali yaratildi va standart uslub qo'shildi")
+
+        cursor.execute("PRAGMA table_info(channels)")
+        columns = [column[1] for column in cursor.fetchall()]
+        if 'layout_name' not in columns:
+            cursor.execute("ALTER TABLE channels ADD COLUMN layout_name TEXT")
+            logging.info("'channels' jadvaliga layout_name maydoni qo'shildi")
+
+        if 'media_file_ids' not in existing_tables:
+            # Yuklangan rasmning Telegram file_id si (kalit - render keshi kaliti)
+            cursor.execute('''
+                CREATE TABLE media_file_ids (
+                    media_key TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            logging.info("'media_file_ids' jadvali yaratildi")
+
+        if 'render_jobs' not in existing_tables:
+            # HTML post API render ishlari (job_id - so'rov parametrlari xeshi, natija - media_store kaliti)
+            cursor.execute('''
+                CREATE TABLE render_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    anime_code TEXT NOT NULL,
+                    episode_num INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ('queued', 'running', 'done', 'failed', 'rejected')),
+                    result_key TEXT,
+                    error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            logging.info("'render_jobs' jadvali yaratildi")
+
+        if 'bot_settings' not in existing_tables:
+            cursor.execute('''
+                CREATE TABLE bot_settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            logging.info("'bot_settings' jadvali yaratildi")
+
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_anime_code ON anime(code)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, next_attempt_at)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_episodes_anime_code ON episodes(anime_code)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_favorites_user_id ON favorites(user_id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_questions_question ON questions(question)")
@@ -379,57 +568,89 @@ async def api_get_anime_episodes(request):
 
     return web.json_response(episode_list)
 
-async def api_get_html_post_image(request):
-    """HTML post uchun rasm generatsiya qiladi va URL qaytaradi"""
+async def _read_request_params(request) -> dict:
+    """So'rov parametrlari: query + JSON yoki forma tanasi"""
+    params = dict(request.query)
+    if request.can_read_body:
+        if request.content_type == 'application/json':
+            body = await request.json()
+            if isinstance(body, dict):
+                params.update(body)
+        else:
+            params.update(await request.post())
+    return params
+
+def _render_job_response(job: dict):
+    """Ish holati JSON javobi; tayyor bo'lsa image_url bilan"""
+    payload = {'job_id': job['job_id'], 'status': job['status'],
+               'status_url': f"/api/html_post_image/{job['job_id']}"}
+    if job['status'] == 'done':
+        if job['result_key'] not in media_store:
+            # Natija janitor tomonidan o'chirilgan - qayta POST yangi render qiladi
+            payload['status'] = 'expired'
+            return web.json_response(payload, status=410)
+        payload['image_url'] = f"/static/{job['result_key']}"
+        return web.json_response(payload)
+    if job['error']:
+        payload['error'] = job['error']
+    if job['status'] == 'rejected':
+        # Render navbati to'la edi - mijoz keyinroq POST ni qaytarsin
+        return web.json_response(payload, status=503, headers={'Retry-After': '5'})
+    if job['status'] == 'failed':
+        return web.json_response(payload, status=500)
+    return web.json_response(payload, status=202)
+
+async def api_create_html_post_image(request):
+    """
+    HTML post rasmi uchun render ishi yaratadi (POST).
+    Parametrlar: anime_code, episode_num (default 1), desc. Bir xil parametrli so'rovlar bitta ishga tushadi;
+    javob 202 + job_id (tayyor bo'lsa 200 + image_url). Holat: GET /api/html_post_image/{job_id}.
+    """
     try:
-        anime_code = request.query.get('anime_code')
-        episode_num = int(request.query.get('episode_num', 1)) # Default 1-qism
-        desc = request.query.get('desc', 'Tavsif yo\'q')
-
-        conn = sqlite3.connect('anime_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT title, genre, image FROM anime WHERE code = ?", (anime_code,))
-        anime = cursor.fetchone()
-        conn.close()
-
-        if not anime:
-            return web.json_response({'error': 'Anime topilmadi'}, status=404)
-
-        title, genre, image_file_id = anime
-
-        if not image_file_id:
-            return web.json_response({'error': 'Rasm topilmadi'}, status=404)
-
-        # Rasmni generatsiya qilish
-        bot_username = (await bot.get_me()).username
-        image_path = await generate_html_post_image_pillow(
-            title=title,
-            desc=desc,
-            genre=genre,
-            file_id=image_file_id,
-            bot_username=bot_username,
-            anime_code=anime_code,
-            episode_num=episode_num
-        )
-
-        # Bu yerda rasm faylini veb-server uchun statik URL ga saqlash kerak.
-        # Oddiy yechim sifatida, rasmni vaqtinchalik papkaga saqlab, URL qaytarish.
-        # E'tibor bering: Bu yechim faqat test uchun, ishlab chiqarishda statik fayllar serveri kerak.
-        static_url = f"/static/{os.path.basename(image_path)}"
-        # image_path ni server statik papkasiga ko'chirish kerak, lekin bu misolda oddiy qoldirilgan.
-
-        return web.json_response({'image_url': static_url})
-
+        params = await _read_request_params(request)
+        anime_code = str(params.get('anime_code') or '')
+        episode_num = int(params.get('episode_num', 1)) # Default 1-qism
+        desc = str(params.get('desc') or 'Tavsif yo\'q')
+    except (ValueError, TypeError, json.JSONDecodeError):
+        return web.json_response({'error': 'Parametrlar noto\'g\'ri'}, status=400)
+    try:
+        job = submit_render_job(anime_code, episode_num, desc)
+    except LookupError as e:
+        return web.json_response({'error': str(e)}, status=404)
     except Exception as e:
-        logging.error(f"HTML rasm generatsiyasi xatosi: {e}")
+        logging.error(f"HTML rasm ishi yaratishda xatolik: {e}")
         return web.json_response({'error': str(e)}, status=500)
+    return _render_job_response(job)
+
+async def api_get_html_post_image_job(request):
+    """Render ishi holati (GET)"""
+    job = get_render_job(request.match_info.get('job_id'))
+    if not job:
+        return web.json_response({'error': 'Ish topilmadi'}, status=404)
+    return _render_job_response(job)
+
+# Monitoring: har bir komponent o'z ko'rsatkichlarini shu lug'atga ro'yxatdan o'tkazadi
+metrics_providers = {
+    "bot_http_pool": lambda: bot_session.pool_stats(),
+}
+
+async def api_get_metrics(request):
+    """Ichki ko'rsatkichlarni JSON sifatida qaytaradi"""
+    result = {}
+    for name, provider in metrics_providers.items():
+        try:
+            result[name] = provider()
+        except Exception as e:
+            result[name] = {"error": str(e)}
+    return web.json_response(result)
 
-# Statik fayllar uchun oddiy handler (generate_html_post_image_pillow uchun)
+# Statik fayllar: media_store dagi tayyor rasmlar (fayl nomi - kontent xeshi).
+# web.FileResponse kuchli ETag (mtime+hajm - fayl qayta yozilmaydi) bilan If-None-Match/304,
+# Range/206 va sendfile ni bajaradi; kontent o'zgarmagani uchun brauzer va CDN uni abadiy keshlaydi.
 async def handle_static_file(request):
-    filename = request.match_info.get('filename')
-    filepath = os.path.join(tempfile.gettempdir(), filename) # Vaqtinchalik papka
-    if os.path.exists(filepath):
-        return web.FileResponse(filepath)
+    filepath = media_store.path(request.match_info.get('filename'))
+    if filepath:
+        return web.FileResponse(filepath, headers={'Cache-Control': MEDIA_CACHE_CONTROL})
     else:
         return web.Response(status=404)
 
@@ -437,16 +658,19 @@ async def handle_static_file(request):
 app = web.Application()
 app.router.add_get('/api/anime', api_get_anime_list)
 app.router.add_get('/api/anime/{anime_code}/episodes', api_get_anime_episodes)
-app.router.add_get('/api/html_post_image', api_get_html_post_image)
+app.router.add_post('/api/html_post_image', api_create_html_post_image)
+app.router.add_get('/api/html_post_image/{job_id}', api_get_html_post_image_job)
 app.router.add_get('/static/{filename}', handle_static_file)
+app.router.add_get('/api/metrics', api_get_metrics)
 
 # Bot va veb-serverni birgalikda ishga tushirish
 async def start_web_server():
+    recover_render_jobs()
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, 'localhost', 8080) # Portni o'zgartirishingiz mumkin
+    site = web.TCPSite(runner, WEB_HOST, PORT)  # WEB_HOST va PORT muhit o'zgaruvchilaridan
     await site.start()
-    print("Veb server http://localhost:8080 da ishga tushdi")
+    logging.info(f"🌐 Veb server http://{WEB_HOST}:{PORT} da ishga tushdi")
 
 # Asosiy main() funksiyasini yangilash
 async def main():
@@ -481,6 +705,27 @@ async def is_admin(user_id: int) -> bool:
     finally:
         conn.close()
 
+def get_setting(key: str, default: str = None) -> str:
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
+        row = cursor.fetchone()
+        return row[0] if row else default
+    finally:
+        conn.close()
+
+def set_setting(key: str, value: str):
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        conn.execute("""
+            INSERT OR REPLACE INTO bot_settings (key, value, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        """, (key, value))
+        conn.commit()
+    finally:
+        conn.close()
+
 async def validate_database(db_path: str) -> dict:
     conn = None
     try:
@@ -541,29 +786,585 @@ async def check_admin(user_id: int, message=None, call=None, require_owner=False
         return False
     return True
 
-# ==================== MUHIM TATAT: check_subscription funksiyasi qo'shildi ====================
-async def check_subscription(user_id: int, show_message: bool = False, message: types.Message = None) -> bool:
-    """Har doim Telegram API orqali real-time tekshirish — user_subscriptions jadvalidan foydalanilmaydi"""
+# ==================== OUTBOX (XABARLAR NAVBATI) ====================
+# Handlerlar xabarni to'g'ridan-to'g'ri yubormaydi — outbox jadvaliga yozib, darhol qaytadi.
+# Fon dispetcheri navbatni rate limiter ostida bo'shatadi, shuning uchun bot qayta
+# ishga tushsa ham xabarlar yo'qolmaydi, idempotency_key esa dublikatlarni to'xtatadi.
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 30))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", 25))  # xabar/soniya (Telegram limiti ~30)
+OUTBOX_PRIVATE_INTERVAL = 1.0  # bitta foydalanuvchiga xabarlar orasidagi minimal vaqt
+OUTBOX_GROUP_INTERVAL = 3.0    # kanal/guruhga (~20 xabar/daqiqa)
+
+outbox_wakeup = asyncio.Event()
+
+
+class OutboxRateLimiter:
+    """Global va chat bo'yicha tezlik cheklovchisi"""
+
+    def __init__(self, global_rate: float, private_interval: float, group_interval: float):
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self._next_global = 0.0
+        self._next_per_chat = {}
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        is_group = str(chat_id).startswith('-')
+        chat_ready = self._next_per_chat.get(chat_id, 0.0)
+        delay = max(self._next_global - now, chat_ready - now, 0)
+        if delay:
+            await asyncio.sleep(delay)
+            now = time.monotonic()
+        self._next_global = now + self.global_interval
+        self._next_per_chat[chat_id] = now + (self.group_interval if is_group else self.private_interval)
+        # Eski yozuvlarni tozalash (lug'at cheksiz o'smasligi uchun)
+        if len(self._next_per_chat) > 10000:
+            self._next_per_chat = {k: v for k, v in self._next_per_chat.items() if v > now}
+
+
+outbox_limiter = OutboxRateLimiter(OUTBOX_GLOBAL_RATE, OUTBOX_PRIVATE_INTERVAL, OUTBOX_GROUP_INTERVAL)
+
+
+def _outbox_payload(kwargs: dict) -> str:
+    payload = dict(kwargs)
+    if isinstance(payload.get('reply_markup'), InlineKeyboardMarkup):
+        payload['reply_markup'] = payload['reply_markup'].model_dump(exclude_none=True)
+    return json.dumps(payload, ensure_ascii=False)
+
+
+def enqueue_outbox(method: str, chat_id, idempotency_key: str, media_blob: bytes = None,
+                   media_key: str = None, **kwargs) -> bool:
+    """
+    Xabarni outbox ga qo'shadi. Agar shu kalit bilan xabar allaqachon bo'lsa, qayta qo'shmaydi.
+    reply_markup InlineKeyboardMarkup bo'lishi mumkin — JSON ga aylantiriladi.
+    media_key berilsa, media_blob bir marta yuklanadi va keyin uning file_id si ishlatiladi.
+    """
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR IGNORE INTO outbox (idempotency_key, method, chat_id, payload, media_blob, media_key)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (idempotency_key, method, str(chat_id), _outbox_payload(kwargs), media_blob, media_key))
+        conn.commit()
+        added = cursor.rowcount > 0
+    finally:
+        conn.close()
+    if added:
+        outbox_wakeup.set()
+    return added
+
+
+def enqueue_outbox_many(items: list) -> int:
+    """Ko'p xabarni bitta tranzaksiyada qo'shadi: items = [(method, chat_id, key, kwargs), ...]"""
+    rows = [
+        (idempotency_key, method, str(chat_id), _outbox_payload(kwargs))
+        for method, chat_id, idempotency_key, kwargs in items
+    ]
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        before = conn.total_changes
+        conn.executemany("""
+            INSERT OR IGNORE INTO outbox (idempotency_key, method, chat_id, payload)
+            VALUES (?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+        added = conn.total_changes - before
+    finally:
+        conn.close()
+    if added:
+        outbox_wakeup.set()
+    return added
+
+
+def _outbox_claim_batch(limit: int) -> list:
+    """Tayyor xabarlarni 'sending' holatiga o'tkazib qaytaradi"""
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, method, chat_id, payload, media_blob, media_key, attempts
+            FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id
+            LIMIT ?
+        """, (time.time(), limit))
+        rows = cursor.fetchall()
+        if rows:
+            cursor.executemany("UPDATE outbox SET status = 'sending' WHERE id = ?", [(row[0],) for row in rows])
+            conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+def _outbox_apply_results(sent: list, retry: list, failed: list, blocked_users: list, released: list = ()):
+    """Batch natijalarini bitta tranzaksiyada yozadi; released - yuborishga yetmagan id lar ('pending' ga qaytadi)"""
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        cursor = conn.cursor()
+        if released:
+            cursor.executemany("UPDATE outbox SET status = 'pending' WHERE id = ? AND status = 'sending'",
+                               [(row_id,) for row_id in released])
+        if sent:
+            cursor.executemany("""
+                UPDATE outbox SET status = 'sent', message_id = ?, sent_at = CURRENT_TIMESTAMP,
+                       attempts = attempts + 1, media_blob = NULL
+                WHERE id = ?
+            """, sent)
+        if retry:
+            cursor.executemany("""
+                UPDATE outbox SET status = 'pending', attempts = attempts + 1,
+                       next_attempt_at = ?, last_error = ?
+                WHERE id = ?
+            """, retry)
+        if failed:
+            cursor.executemany("""
+                UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = ?, media_blob = NULL
+                WHERE id = ?
+            """, failed)
+        if blocked_users:
+            cursor.executemany("DELETE FROM subscribers WHERE user_id = ?", [(u,) for u in blocked_users])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def _outbox_finish_batch(rows: list, sent: list, retry: list, failed: list, blocked_users: list):
+    """
+    Claim qilingan batchni yopadi: natijasi bor qatorlar yoziladi, qolganlari (xato yoki bekor qilish
+    sababli yuborilmagan) 'pending' ga qaytadi. Yozish muvaffaqiyatli bo'lguncha qayta uriniladi -
+    aks holda yuborilgan xabarlar 'sending' da qolib, restartdan keyin takror yuborilardi.
+    """
+    done = {result[-1] for result in sent + retry + failed}
+    released = [row[0] for row in rows if row[0] not in done]
+    delay = 0.5
+    while True:
+        try:
+            _outbox_apply_results(sent, retry, failed, blocked_users, released)
+            return
+        except sqlite3.Error as e:
+            logging.error(f"Outbox natijalarini yozishda xatolik ({len(rows)} ta xabar), "
+                          f"{delay:.1f}s dan keyin qayta urinish: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+def outbox_recover():
+    """Crashdan keyin 'sending' holatida qolgan xabarlarni qayta navbatga qo'yadi"""
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+        conn.commit()
+        if cursor.rowcount:
+            logging.warning(f"♻️ Outbox: {cursor.rowcount} ta yakunlanmagan xabar qayta navbatga qo'yildi")
+    finally:
+        conn.close()
+
+
+media_file_id_stats = {"reused": 0, "uploaded": 0, "rejected": 0}
+
+def get_media_file_id(media_key: str):
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        row = conn.execute("SELECT file_id FROM media_file_ids WHERE media_key = ?", (media_key,)).fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+def remember_media_file_id(media_key: str, file_id: str):
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        conn.execute("""
+            INSERT INTO media_file_ids (media_key, file_id) VALUES (?, ?)
+            ON CONFLICT(media_key) DO UPDATE SET file_id = excluded.file_id, updated_at = CURRENT_TIMESTAMP
+        """, (media_key, file_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def forget_media_file_id(media_key: str):
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        conn.execute("DELETE FROM media_file_ids WHERE media_key = ?", (media_key,))
+        conn.commit()
+    finally:
+        conn.close()
+
+async def _outbox_send(method: str, chat_id, payload: dict, media_blob: bytes, media_key: str = None):
+    kwargs = dict(payload)
+    if kwargs.get('reply_markup'):
+        kwargs['reply_markup'] = InlineKeyboardMarkup.model_validate(kwargs['reply_markup'])
+    chat = int(chat_id) if str(chat_id).lstrip('-').isdigit() else chat_id
+    if method == 'send_photo':
+        filename = kwargs.pop('filename', 'post.png')
+        # Shu rasm avval yuklangan bo'lsa - qayta yuklamasdan file_id bilan yuboramiz
+        cached_file_id = get_media_file_id(media_key) if media_key else None
+        if cached_file_id:
+            try:
+                result = await bot.send_photo(chat_id=chat, photo=cached_file_id, **kwargs)
+                media_file_id_stats["reused"] += 1
+                return result
+            except exceptions.TelegramBadRequest as e:
+                # Faqat file_id rad etilganda qayta yuklaymiz; boshqa xatolar odatdagidek
+                if media_blob is None or "file" not in str(e).lower():
+                    raise
+                media_file_id_stats["rejected"] += 1
+                logging.warning(f"♻️ file_id rad etildi ({e}), rasm qayta yuklanadi")
+                forget_media_file_id(media_key)
+        if media_blob is not None:
+            kwargs['photo'] = BufferedInputFile(media_blob, filename=filename)
+        result = await bot.send_photo(chat_id=chat, **kwargs)
+        if media_key and media_blob is not None and result.photo:
+            media_file_id_stats["uploaded"] += 1
+            remember_media_file_id(media_key, result.photo[-1].file_id)
+        return result
+    if method == 'send_video':
+        return await bot.send_video(chat_id=chat, **kwargs)
+    return await bot.send_message(chat_id=chat, **kwargs)
+
+
+async def outbox_dispatcher():
+    """Outbox navbatini fon rejimida bo'shatadi"""
+    outbox_recover()
+    logging.info("📮 Outbox dispetcheri ishga tushdi")
+    while True:
+        try:
+            rows = _outbox_claim_batch(OUTBOX_BATCH_SIZE)
+            if not rows:
+                outbox_wakeup.clear()
+                try:
+                    await asyncio.wait_for(outbox_wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            sent, retry, failed, blocked_users = [], [], [], []
+            try:
+                for row_id, method, chat_id, payload, media_blob, media_key, attempts in rows:
+                    await outbox_limiter.wait(chat_id)
+                    try:
+                        result = await _outbox_send(method, chat_id, json.loads(payload), media_blob, media_key)
+                        sent.append((getattr(result, 'message_id', None), row_id))
+                    except exceptions.TelegramRetryAfter as e:
+                        retry.append((time.time() + e.retry_after, str(e), row_id))
+                    except exceptions.TelegramForbiddenError as e:
+                        failed.append((str(e), row_id))
+                        if "bot was blocked" in str(e).lower():
+                            blocked_users.append(int(chat_id))
+                    except exceptions.TelegramBadRequest as e:
+                        failed.append((str(e), row_id))
+                    except Exception as e:
+                        if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                            failed.append((str(e), row_id))
+                        else:
+                            retry.append((time.time() + 2 ** attempts, str(e), row_id))
+                        logging.error(f"Outbox xabar yuborishda xatolik (id={row_id}): {e}")
+            finally:
+                await _outbox_finish_batch(rows, sent, retry, failed, blocked_users)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Outbox dispetcheri xatosi: {e}")
+            await asyncio.sleep(5)
+
+# ==================== TELEGRAM FAYLLARI ====================
+def telegram_local_path(file_path: str):
+    """Lokal Bot API rejimida fayl yo'lini qaytaradi (aks holda None)"""
+    if not bot_session.api.is_local or not file_path:
+        return None
+    path = str(bot_session.api.wrap_local_file.to_local(file_path))
+    return path if os.path.isfile(path) else None
+
+async def read_telegram_file(file_id: str) -> bytes:
+    """Faylni o'qiydi: lokal rejimda diskdan, aks holda Bot API orqali"""
+    file = await bot.get_file(file_id)
+    local_path = telegram_local_path(file.file_path)
+    if local_path:
+        with open(local_path, 'rb') as f:
+            return f.read()
+    file_bytes_io = await bot.download_file(file.file_path)
+    return file_bytes_io.getvalue()
+
+async def save_telegram_file(file_id: str, destination: str):
+    """Faylni destination ga saqlaydi: lokal rejimda oddiy nusxa, aks holda yuklab olish"""
+    file = await bot.get_file(file_id)
+    local_path = telegram_local_path(file.file_path)
+    if local_path:
+        shutil.copyfile(local_path, destination)
+    else:
+        await bot.download_file(file.file_path, destination)
+
+# ==================== BITTA UPDATE DOIRASIDAGI KESH ====================
+# Bitta update ichida bir xil DB so'rovi yoki API chaqiruvi bir necha marta bajarilmasligi
+# uchun middleware har bir update ga alohida kesh biriktiradi (ContextVar orqali).
+update_cache_var = ContextVar("update_cache", default=None)
+update_cache_stats = {}  # update turi -> {"updates", "hits", "misses"}
+
+
+class UpdateCacheMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        try:
+            update_type = event.event_type
+        except Exception:
+            update_type = "unknown"
+        cache = {"values": {}, "hits": 0, "misses": 0}
+        token = update_cache_var.set(cache)
+        try:
+            return await handler(event, data)
+        finally:
+            update_cache_var.reset(token)
+            stats = update_cache_stats.setdefault(update_type, {"updates": 0, "hits": 0, "misses": 0})
+            stats["updates"] += 1
+            stats["hits"] += cache["hits"]
+            stats["misses"] += cache["misses"]
+
+
+dp.update.outer_middleware(UpdateCacheMiddleware())
+
+
+async def update_memo(key, factory):
+    """factory() natijasini joriy update davomida keshlaydi (async)"""
+    cache = update_cache_var.get()
+    if cache is None:
+        return await factory()
+    if key in cache["values"]:
+        cache["hits"] += 1
+        return cache["values"][key]
+    cache["misses"] += 1
+    value = await factory()
+    cache["values"][key] = value
+    return value
+
+
+def update_memo_sync(key, factory):
+    """factory() natijasini joriy update davomida keshlaydi (sinxron DB so'rovlari uchun)"""
+    cache = update_cache_var.get()
+    if cache is None:
+        return factory()
+    if key in cache["values"]:
+        cache["hits"] += 1
+        return cache["values"][key]
+    cache["misses"] += 1
+    value = factory()
+    cache["values"][key] = value
+    return value
+
+
+def _update_cache_metrics() -> dict:
+    result = {}
+    for update_type, stats in update_cache_stats.items():
+        result[update_type] = dict(stats, saved_per_update=round(stats["hits"] / stats["updates"], 2) if stats["updates"] else 0)
+    return result
+
+
+metrics_providers["update_cache"] = _update_cache_metrics
+
+
+def _fetch_mandatory_channels() -> list:
+    conn = sqlite3.connect('anime_bot.db')
     try:
-        conn = sqlite3.connect('anime_bot.db')
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT channel_id 
+            SELECT channel_id, channel_name 
             FROM channels 
             WHERE channel_type IN ('mandatory', 'additional_mandatory')
+            ORDER BY channel_type
         """)
-        channels = cursor.fetchall()
+        return cursor.fetchall()
+    finally:
         conn.close()
+
+def get_mandatory_channels() -> list:
+    return update_memo_sync(("mandatory_channels",), _fetch_mandatory_channels)
+
+def _fetch_one(query: str, params: tuple):
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        return cursor.fetchone()
+    finally:
+        conn.close()
+
+def fetch_anime_title(anime_code: str):
+    row = update_memo_sync(
+        ("anime_title", anime_code),
+        lambda: _fetch_one("SELECT title FROM anime WHERE code = ?", (anime_code,))
+    )
+    return row[0] if row else None
+
+def fetch_episode_video(anime_code: str, episode_num: int):
+    row = update_memo_sync(
+        ("episode_video", anime_code, episode_num),
+        lambda: _fetch_one("""
+            SELECT video_file_id 
+            FROM episodes 
+            WHERE anime_code = ? AND episode_number = ?
+        """, (anime_code, episode_num))
+    )
+    return row[0] if row else None
+
+def _save_user_redirect(user_id: int, redirect_data: str) -> bool:
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        conn.execute("""
+            INSERT OR REPLACE INTO user_redirects 
+            (user_id, redirect_data, created_at) 
+            VALUES (?, ?, ?)
+        """, (user_id, redirect_data, datetime.now()))
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+def save_user_redirect(user_id: int, redirect_data: str):
+    # Bitta update ichida faqat bir marta yoziladi
+    update_memo_sync(("redirect", user_id, redirect_data), lambda: _save_user_redirect(user_id, redirect_data))
+
+async def get_chat_cached(channel_id):
+    return await update_memo(("chat", str(channel_id)), lambda: bot.get_chat(channel_id))
+
+# ==================== OBUNA TEKSHIRUVI: CIRCUIT BREAKER ====================
+# Telegram sekinlashganda har bir get_chat_member so'rovini kutib o'tirmaslik uchun.
+# Ketma-ket xatoliklar chegaradan oshsa, breaker "open" holatga o'tadi va javob
+# oxirgi ma'lum holatdan (kesh) yoki admin tanlagan siyosatdan olinadi.
+SUBSCRIPTION_CHECK_TIMEOUT = float(os.getenv("SUBSCRIPTION_CHECK_TIMEOUT", 3))
+SUBSCRIPTION_BREAKER_THRESHOLD = int(os.getenv("SUBSCRIPTION_BREAKER_THRESHOLD", 5))
+SUBSCRIPTION_BREAKER_RESET = float(os.getenv("SUBSCRIPTION_BREAKER_RESET", 30))
+SUBSCRIPTION_CACHE_SIZE = 50000
+# open: noma'lum holatda foydalanuvchini o'tkazib yuborish; closed: obuna talab qilish
+SUBSCRIPTION_POLICY_KEY = "subscription_fail_policy"
+SUBSCRIPTION_POLICY_DEFAULT = os.getenv("SUBSCRIPTION_FAIL_POLICY", "closed")
+
+MEMBER_STATUSES = (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR)
+
+
+class MembershipCircuitBreaker:
+    """Oddiy circuit breaker: closed -> open -> half_open -> closed"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = None  # half_open: sinov so'rovi boshlangan vaqt (None - sinov yo'q)
+        self.stats = {"calls": 0, "successes": 0, "failures": 0, "timeouts": 0,
+                      "short_circuited": 0, "cache_answers": 0, "policy_answers": 0, "opened": 0}
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == "open":
+            if now - self.opened_at >= self.reset_timeout:
+                # Bitta sinov so'roviga ruxsat; natijasi record_success/record_failure da hal bo'ladi
+                self.state = "half_open"
+                self.probe_started_at = now
+                return True
+            self.stats["short_circuited"] += 1
+            return False
+        if self.state == "half_open":
+            # Sinov javobini kutayotganda qolganlar keshdan/siyosatdan javob oladi.
+            # Sinov natijasiz yo'qolsa (bekor qilingan so'rov), reset_timeout dan keyin yangi sinov
+            if self.probe_started_at is not None and now - self.probe_started_at < self.reset_timeout:
+                self.stats["short_circuited"] += 1
+                return False
+            self.probe_started_at = now
+            return True
+        return True
+
+    def record_success(self):
+        self.stats["successes"] += 1
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            logging.info("✅ Obuna breaker yopildi (Telegram javob bermoqda)")
+        self.state = "closed"
+        self.probe_started_at = None
+
+    def record_failure(self):
+        self.stats["failures"] += 1
+        self.consecutive_failures += 1
+        if self.state == "half_open" or (
+            self.state == "closed" and self.consecutive_failures >= self.failure_threshold
+        ):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probe_started_at = None
+            self.stats["opened"] += 1
+            logging.warning(f"⚠️ Obuna breaker ochildi ({self.consecutive_failures} ta ketma-ket xatolik)")
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures,
+                "policy": get_setting(SUBSCRIPTION_POLICY_KEY, SUBSCRIPTION_POLICY_DEFAULT),
+                "cached_entries": len(membership_cache), **self.stats}
+
+
+subscription_breaker = MembershipCircuitBreaker(SUBSCRIPTION_BREAKER_THRESHOLD, SUBSCRIPTION_BREAKER_RESET)
+membership_cache = OrderedDict()  # (channel_id, user_id) -> oxirgi ma'lum a'zolik holati
+
+
+def _membership_fallback(key) -> bool:
+    if key in membership_cache:
+        subscription_breaker.stats["cache_answers"] += 1
+        return membership_cache[key]
+    subscription_breaker.stats["policy_answers"] += 1
+    return get_setting(SUBSCRIPTION_POLICY_KEY, SUBSCRIPTION_POLICY_DEFAULT) == "open"
+
+
+async def is_channel_member(channel_id, user_id: int) -> bool:
+    """Kanal a'zoligini tekshiradi (bitta update ichida natija keshlanadi)"""
+    return await update_memo(
+        ("member", str(channel_id), user_id),
+        lambda: _check_channel_member(channel_id, user_id)
+    )
+
+
+async def _check_channel_member(channel_id, user_id: int) -> bool:
+    """Kanal a'zoligini breaker va timeout bilan tekshiradi"""
+    key = (str(channel_id), user_id)
+    subscription_breaker.stats["calls"] += 1
+    if not subscription_breaker.allow():
+        return _membership_fallback(key)
+    try:
+        member = await asyncio.wait_for(
+            bot.get_chat_member(channel_id, user_id),
+            timeout=SUBSCRIPTION_CHECK_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        subscription_breaker.stats["timeouts"] += 1
+        subscription_breaker.record_failure()
+        return _membership_fallback(key)
+    except (exceptions.TelegramNetworkError, exceptions.TelegramServerError, exceptions.TelegramRetryAfter) as e:
+        logging.error(f"Kanal a'zoligini tekshirishda tarmoq xatosi: {e}")
+        subscription_breaker.record_failure()
+        return _membership_fallback(key)
+    except exceptions.TelegramAPIError as e:
+        # Telegram javob berdi (masalan, foydalanuvchi topilmadi) — bu aniq "obuna emas"
+        logging.error(f"Kanal a'zoligini tekshirishda xato: {e}")
+        subscription_breaker.record_success()
+        return False
+    subscription_breaker.record_success()
+    is_member = member.status in MEMBER_STATUSES
+    membership_cache[key] = is_member
+    membership_cache.move_to_end(key)
+    if len(membership_cache) > SUBSCRIPTION_CACHE_SIZE:
+        membership_cache.popitem(last=False)
+    return is_member
+
+
+metrics_providers["subscription_breaker"] = lambda: subscription_breaker.snapshot()
+
+# ==================== MUHIM TATAT: check_subscription funksiyasi qo'shildi ====================
+async def check_subscription(user_id: int, show_message: bool = False, message: types.Message = None) -> bool:
+    """Har doim Telegram API orqali real-time tekshirish — user_subscriptions jadvalidan foydalanilmaydi"""
+    try:
+        channels = get_mandatory_channels()
         if not channels:
             return True
-        for channel_id, in channels:
-            try:
-                member = await bot.get_chat_member(channel_id, user_id)
-                if member.status not in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]:
-                    if show_message and message:
-                        await show_subscription_required(message)
-                    return False
-            except Exception:
+        for channel_id, _ in channels:
+            if not await is_channel_member(channel_id, user_id):
                 if show_message and message:
                     await show_subscription_required(message)
                 return False
@@ -574,39 +1375,15 @@ async def check_subscription(user_id: int, show_message: bool = False, message:
 
 async def check_subscription_with_redirect(user_id: int, redirect_data: str = None, message: types.Message = None, call: types.CallbackQuery = None) -> bool:
     try:
-        conn = sqlite3.connect('anime_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT channel_id, channel_name 
-            FROM channels 
-            WHERE channel_type IN ('mandatory', 'additional_mandatory')
-            ORDER BY channel_type
-        """)
-        channels = cursor.fetchall()
+        channels = get_mandatory_channels()
         if not channels:
-            conn.close()
             return True
         not_subscribed = []
         for channel_id, channel_name in channels:
-            try:
-                member = await bot.get_chat_member(channel_id, user_id)
-                if member.status not in [
-                    ChatMemberStatus.MEMBER,
-                    ChatMemberStatus.ADMINISTRATOR,
-                    ChatMemberStatus.CREATOR
-                ]:
-                    not_subscribed.append((channel_id, channel_name))
-            except Exception as e:
-                logging.error(f"Kanal a'zoligini tekshirishda xato: {e}")
+            if not await is_channel_member(channel_id, user_id):
                 not_subscribed.append((channel_id, channel_name))
         if redirect_data:
-            cursor.execute("""
-                INSERT OR REPLACE INTO user_redirects 
-                (user_id, redirect_data, created_at) 
-                VALUES (?, ?, ?)
-            """, (user_id, redirect_data, datetime.now()))
-            conn.commit()
-        conn.close()
+            save_user_redirect(user_id, redirect_data)
         if not_subscribed:
             if message:
                 await show_subscription_required(message, not_subscribed, redirect_data)
@@ -621,28 +1398,10 @@ async def check_subscription_with_redirect(user_id: int, redirect_data: str = No
 async def show_subscription_required(message: types.Message, not_subscribed_channels: list = None, redirect_data: str = None):
     try:
         if not_subscribed_channels is None:
-            conn = sqlite3.connect('anime_bot.db')
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT channel_id, channel_name 
-                FROM channels 
-                WHERE channel_type IN ('mandatory', 'additional_mandatory')
-                ORDER BY channel_type
-            """)
-            all_channels = cursor.fetchall()
-            conn.close()
+            all_channels = get_mandatory_channels()
             not_subscribed_channels = []
             for channel_id, channel_name in all_channels:
-                try:
-                    member = await bot.get_chat_member(channel_id, message.from_user.id)
-                    if member.status not in [
-                        ChatMemberStatus.MEMBER,
-                        ChatMemberStatus.ADMINISTRATOR,
-                        ChatMemberStatus.CREATOR
-                    ]:
-                        not_subscribed_channels.append((channel_id, channel_name))
-                except Exception as e:
-                    logging.error(f"Kanal a'zoligini tekshirishda xato: {e}")
+                if not await is_channel_member(channel_id, message.from_user.id):
                     not_subscribed_channels.append((channel_id, channel_name))
         # Agar barcha kanallarga obuna bo'lsa — animeni ochamiz
         if not not_subscribed_channels:
@@ -663,7 +1422,7 @@ async def show_subscription_required(message: types.Message, not_subscribed_chan
         buttons = []
         for channel_id, channel_name in not_subscribed_channels:
             try:
-                chat = await bot.get_chat(channel_id)
+                chat = await get_chat_cached(channel_id)
                 if chat.username:
                     invite_link = f"https://t.me/{chat.username}"
                 else:
@@ -675,17 +1434,9 @@ async def show_subscription_required(message: types.Message, not_subscribed_chan
             except Exception as e:
                 logging.error(f"Kanal linkini olishda xato: {e}")
                 continue
-        # Redirect ma'lumotini saqlash
+        # Redirect ma'lumotini saqlash (check_subscription_with_redirect saqlagan bo'lsa, qayta yozilmaydi)
         if redirect_data:
-            conn = sqlite3.connect('anime_bot.db')
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO user_redirects 
-                (user_id, redirect_data) 
-                VALUES (?, ?)
-            """, (message.from_user.id, redirect_data))
-            conn.commit()
-            conn.close()
+            save_user_redirect(message.from_user.id, redirect_data)
         # "Obunani tekshirish" tugmasi
         buttons.append([InlineKeyboardButton(
             text="🔄 Obunani tekshirish",
@@ -1153,33 +1904,21 @@ async def process_redirect(user_id: int, message: types.Message = None, call: ty
 async def handle_episode_request_direct(user_id: int, anime_code: str, episode_num: int, message: types.Message):
     """Qismni yuborish - hech qanday tugmasiz"""
     try:
-        conn = sqlite3.connect('anime_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT title FROM anime WHERE code = ?", (anime_code,))
-        anime = cursor.fetchone()
-        if not anime:
+        anime_title = fetch_anime_title(anime_code)
+        if not anime_title:
             return
             
-        cursor.execute("""
-            SELECT video_file_id 
-            FROM episodes 
-            WHERE anime_code = ? AND episode_number = ?
-        """, (anime_code, episode_num))
-        episode = cursor.fetchone()
-        if not episode:
+        video_file_id = fetch_episode_video(anime_code, episode_num)
+        if not video_file_id:
             return
-            
-        video_file_id = episode[0]
         
         # FAQAT VIDEO YUBORISH, HECH QANDAY TUGMA
         await message.answer_video(
             video=video_file_id,
-            caption=f"🎬 {anime[0]} - {episode_num}-qism"
+            caption=f"🎬 {anime_title} - {episode_num}-qism"
         )
     except Exception as e:
         logging.error(f"Video yuborishda xatolik: {str(e)}")
-    finally:
-        conn.close()
 
 
 async def show_episodes_menu(message: types.Message, anime_code: str):
@@ -1324,6 +2063,7 @@ async def manage_post_templates(message: types.Message):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Yangi Shablon Qo'shish", callback_data="start_add_template")],
         [InlineKeyboardButton(text="🗑 Shablonni O'chirish", callback_data="remove_template")],
+        [InlineKeyboardButton(text="🎨 Rasm Uslublari", callback_data="layout_styles")],
         [InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_features")]
     ])
     await message.answer("📋 Post Shablonlari Boshqaruvi:", reply_markup=keyboard)
@@ -1428,6 +2168,147 @@ async def cancel_add_template(call: types.CallbackQuery, state: FSMContext):
     await call.message.edit_text("❌ Shablon qo'shish bekor qilindi.")
     await call.answer()
 
+# ==================== RASM USLUBLARI (LAYOUT SHABLONLARI) ====================
+class ManageLayoutTemplate(StatesGroup):
+    waiting_for_spec = State()  # Birinchi qator - nom, qolgani - JSON
+
+@dp.callback_query(lambda call: call.data == "layout_styles")
+async def show_layout_styles(call: types.CallbackQuery):
+    if not await check_admin(call.from_user.id, call=call):
+        return
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        layouts = conn.execute("SELECT name, spec FROM layout_templates ORDER BY id").fetchall()
+        assigned = conn.execute(
+            "SELECT channel_name, layout_name FROM channels WHERE channel_type = 'post' AND layout_name IS NOT NULL"
+        ).fetchall()
+    finally:
+        conn.close()
+    text = "🎨 <b>Post rasmi uslublari</b>\n\n"
+    text += "\n".join(f"• <b>{html.escape(name)}</b> — {len(spec)} belgi JSON" for name, spec in layouts)
+    if assigned:
+        text += "\n\n📺 <b>Kanallar:</b>\n" + "\n".join(
+            f"• {html.escape(channel_name or '')}: {html.escape(layout_name)}" for channel_name, layout_name in assigned
+        )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="➕ Yangi Uslub", callback_data="add_layout_style")],
+        [InlineKeyboardButton(text="📺 Kanalga Biriktirish", callback_data="assign_layout")],
+    ])
+    await call.message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+    await call.answer()
+
+@dp.callback_query(lambda call: call.data == "add_layout_style")
+async def start_add_layout_style(call: types.CallbackQuery, state: FSMContext):
+    if not await check_admin(call.from_user.id, call=call):
+        return
+    await state.set_state(ManageLayoutTemplate.waiting_for_spec)
+    await call.message.answer(
+        "📝 Birinchi qatorda uslub nomini, keyingi qatorlarda JSON ni yuboring.\n"
+        "Faqat o'zgaradigan qiymatlarni yozing, qolgani standart uslubdan olinadi.\n"
+        "Misol:\n<code>Oltin\n"
+        '{"title": {"size": 68, "color": [255, 215, 0]}, "panel": {"width": 1200}, "genres": {"y": 980}}</code>',
+        parse_mode="HTML",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="🔙 Bekor qilish")]],
+            resize_keyboard=True
+        )
+    )
+    await call.answer()
+
+@dp.message(ManageLayoutTemplate.waiting_for_spec)
+async def get_layout_style(message: types.Message, state: FSMContext):
+    if message.text == "🔙 Bekor qilish":
+        await cancel_post_action(message, state)
+        return
+    name, _, raw_spec = (message.text or "").partition("\n")
+    name = name.strip()
+    if len(name) < 2:
+        await message.answer("❌ Uslub nomi juda qisqa. Birinchi qatorga nom yozing.")
+        return
+    try:
+        spec = normalize_layout(raw_spec)
+    except ValueError as e:
+        await message.answer(f"❌ JSON xatosi: {html.escape(str(e))}", parse_mode="HTML")
+        return
+    try:
+        # Sinov renderi (ishchida, haqiqiy profilda): saqlangan uslub har bir postni buzmasligi kerak
+        await render_pool.run(render_post_image, None, "Sinov sarlavhasi", "Sinov tavsifi", "Action, Drama", 1,
+                              RENDER_FORMAT, spec, RENDER_PROFILE)
+    except RenderQueueFullError:
+        await message.answer("⏳ Render navbati band, birozdan keyin qayta yuboring.")
+        return
+    except Exception as e:
+        await message.answer(f"❌ Uslub bilan rasm chizib bo'lmadi: {html.escape(str(e))}", parse_mode="HTML")
+        return
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        conn.execute("INSERT INTO layout_templates (name, spec) VALUES (?, ?)", (name, spec))
+        conn.commit()
+    except sqlite3.IntegrityError:
+        await message.answer("❌ Bu nomdagi uslub allaqachon mavjud. Boshqa nom kiriting.")
+        return
+    finally:
+        conn.close()
+    await state.clear()
+    await message.answer(f"✅ <b>{html.escape(name)}</b> uslubi saqlandi.", parse_mode="HTML")
+
+@dp.callback_query(lambda call: call.data == "assign_layout")
+async def choose_layout_channel(call: types.CallbackQuery):
+    if not await check_admin(call.from_user.id, call=call):
+        return
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        channels = conn.execute(
+            "SELECT channel_id, channel_name, layout_name FROM channels WHERE channel_type = 'post'"
+        ).fetchall()
+    finally:
+        conn.close()
+    if not channels:
+        await call.answer("❌ Post kanali topilmadi!", show_alert=True)
+        return
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"📢 {channel_name} ({layout_name or 'Standart'})",
+                              callback_data=f"layout_channel:{channel_id}")]
+        for channel_id, channel_name, layout_name in channels
+    ])
+    await call.message.answer("📺 Qaysi kanal uchun uslub tanlaysiz?", reply_markup=keyboard)
+    await call.answer()
+
+@dp.callback_query(lambda call: call.data.startswith("layout_channel:"))
+async def choose_channel_layout(call: types.CallbackQuery):
+    if not await check_admin(call.from_user.id, call=call):
+        return
+    channel_id = call.data.split(":", 1)[1]
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        layouts = conn.execute("SELECT id, name FROM layout_templates ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"🎨 {name}", callback_data=f"layout_set:{channel_id}:{layout_id}")]
+        for layout_id, name in layouts
+    ])
+    await call.message.edit_text("🎨 Uslubni tanlang:", reply_markup=keyboard)
+    await call.answer()
+
+@dp.callback_query(lambda call: call.data.startswith("layout_set:"))
+async def set_channel_layout(call: types.CallbackQuery):
+    if not await check_admin(call.from_user.id, call=call):
+        return
+    _, channel_id, layout_id = call.data.split(":")
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        row = conn.execute("SELECT name FROM layout_templates WHERE id = ?", (int(layout_id),)).fetchone()
+        if not row:
+            await call.answer("❌ Uslub topilmadi!", show_alert=True)
+            return
+        conn.execute("UPDATE channels SET layout_name = ? WHERE channel_id = ?", (row[0], channel_id))
+        conn.commit()
+    finally:
+        conn.close()
+    await call.message.edit_text(f"✅ Kanal uslubi: <b>{html.escape(row[0])}</b>", parse_mode="HTML")
+    await call.answer()
+
 
 @dp.callback_query(lambda call: call.data == "back_to_main_from_episodes")
 async def back_to_main_from_episodes(call: types.CallbackQuery):
@@ -1466,25 +2347,15 @@ async def handle_episode_request(call: types.CallbackQuery):
             
         await call.answer("⏳ Yuklanmoqda...")
         
-        conn = sqlite3.connect('anime_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT title FROM anime WHERE code = ?", (anime_code,))
-        anime = cursor.fetchone()
-        if not anime:
+        anime_title = fetch_anime_title(anime_code)
+        if not anime_title:
             await call.answer("❌ Anime topilmadi!", show_alert=True)
             return
             
-        cursor.execute("""
-            SELECT video_file_id 
-            FROM episodes 
-            WHERE anime_code = ? AND episode_number = ?
-        """, (anime_code, episode_num))
-        episode = cursor.fetchone()
-        if not episode:
+        video_file_id = fetch_episode_video(anime_code, episode_num)
+        if not video_file_id:
             await call.answer(f"❌ {episode_num}-qism topilmadi!", show_alert=True)
             return
-            
-        video_file_id = episode[0]
         
         # ESKI: Tugmalar bilan yuborish
         # YANGI: FAQAT VIDEO YUBORISH, HECH QANDAY TUGMA
@@ -1497,16 +2368,13 @@ async def handle_episode_request(call: types.CallbackQuery):
         await bot.send_video(
             chat_id=call.from_user.id,
             video=video_file_id,
-            caption=f"🎬 {anime[0]} - {episode_num}-qism"
+            caption=f"🎬 {anime_title} - {episode_num}-qism"
             # reply_markup o'chirildi - hech qanday tugma yo'q
         )
         
     except Exception as e:
         logging.error(f"Xatolik: {str(e)}")
         await call.answer("❌ Xatolik yuz berdi. Iltimos, qayta urinib ko'ring.", show_alert=True)
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 @dp.callback_query(lambda call: call.data == "back_to_main_from_episode")
 async def back_to_main_from_episode(call: types.CallbackQuery):
@@ -2269,36 +3137,27 @@ async def notify_subscribers(anime_code: str, episode_number: int):
         anime_title = anime[0]
         cursor.execute("SELECT user_id FROM subscribers WHERE notifications = TRUE")
         subscribers = cursor.fetchall()
-        for (user_id,) in subscribers:
-            try:
-                bot_username = (await bot.get_me()).username
-                watch_url = f"https://t.me/{bot_username}?start=watch_{anime_code}"
-                message_text = f"""
+        bot_username = (await bot.get_me()).username
+        watch_url = f"https://t.me/{bot_username}?start=watch_{anime_code}"
+        message_text = f"""
 🎬 <b>Yangi qism qo'shildi!</b>
 📺 <b>{anime_title}</b>
 🔢 <b>Qism:</b> {episode_number}
 ▶️ Tomosha qilish uchun quyidagi tugmani bosing:
                 """
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(
-                        text="▶️ Tomosha Qilish",
-                        url=watch_url
-                    )]
-                ])
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=message_text,
-                    reply_markup=keyboard,
-                    parse_mode="HTML"
-                )
-                await asyncio.sleep(0.1)
-            except exceptions.TelegramAPIError as e:
-                if "bot was blocked" in str(e).lower():
-                    cursor.execute("DELETE FROM subscribers WHERE user_id = ?", (user_id,))
-                    conn.commit()
-                logging.error(f"Xabar yuborishda xatolik (user_id={user_id}): {e}")
-            except Exception as e:
-                logging.error(f"Xabar yuborishda kutilmagan xatolik (user_id={user_id}): {e}")
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(
+                text="▶️ Tomosha Qilish",
+                url=watch_url
+            )]
+        ])
+        # Xabarlar outbox orqali yuboriladi (bloklagan foydalanuvchilar dispetcherda o'chiriladi)
+        queued = enqueue_outbox_many([
+            ('send_message', user_id, f"notify:{anime_code}:{episode_number}:{user_id}",
+             {'text': message_text, 'reply_markup': keyboard, 'parse_mode': "HTML"})
+            for (user_id,) in subscribers
+        ])
+        logging.info(f"📮 {queued} ta bildirishnoma navbatga qo'shildi ({anime_code}, {episode_number}-qism)")
     except Exception as e:
         logging.error(f"notify_subscribers xatosi: {e}")
     finally:
@@ -2548,16 +3407,34 @@ async def mandatory_channel_menu(call: types.CallbackQuery):
                 text += f"{idx}. {channel_name or channel_id} ({'Asosiy' if channel_type == 'mandatory' else 'Qoʻshimcha'})\n"
         else:
             text += "ℹ️ Hozircha kanallar qo'shilmagan"
+        policy = get_setting(SUBSCRIPTION_POLICY_KEY, SUBSCRIPTION_POLICY_DEFAULT)
+        policy_text = "🔓 O'tkazish (fail-open)" if policy == "open" else "🔒 Bloklash (fail-closed)"
+        text += f"\n\n🛡 Telegram javob bermasa: {policy_text}"
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="➕ Asosiy kanal qo'shish", callback_data="add_main_mandatory")],
             [InlineKeyboardButton(text="➕ Qo'shimcha kanal qo'shish", callback_data="add_additional_mandatory")],
             [InlineKeyboardButton(text="➖ Kanal o'chirish", callback_data="remove_mandatory_channel")],
+            [InlineKeyboardButton(text="🛡 Tekshiruv rejimini almashtirish", callback_data="toggle_subscription_policy")],
             [InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_channels")]
         ])
         await call.message.edit_text(text, reply_markup=keyboard)
     except Exception as e:
         await call.answer(f"❌ Xatolik: {str(e)}", show_alert=True)
 
+@dp.callback_query(lambda call: call.data == "toggle_subscription_policy")
+async def toggle_subscription_policy(call: types.CallbackQuery):
+    if not await check_admin(call.from_user.id, call=call):
+        return
+    policy = get_setting(SUBSCRIPTION_POLICY_KEY, SUBSCRIPTION_POLICY_DEFAULT)
+    new_policy = "closed" if policy == "open" else "open"
+    set_setting(SUBSCRIPTION_POLICY_KEY, new_policy)
+    await call.answer(
+        "🔓 Telegram javob bermasa foydalanuvchilar o'tkaziladi" if new_policy == "open"
+        else "🔒 Telegram javob bermasa obuna talab qilinadi",
+        show_alert=True
+    )
+    await mandatory_channel_menu(call)
+
 @dp.callback_query(lambda call: call.data == "add_main_mandatory")
 async def add_main_mandatory_channel(call: types.CallbackQuery):
     if not await check_admin(call.from_user.id, call=call):
@@ -2871,8 +3748,7 @@ async def process_db_file(message: types.Message, state: FSMContext):
     temp_dir = tempfile.mkdtemp()
     temp_db_path = os.path.join(temp_dir, "anime_bot.db")
     try:
-        file = await bot.get_file(message.document.file_id)
-        await bot.download_file(file.file_path, temp_db_path)
+        await save_telegram_file(message.document.file_id, temp_db_path)
         validation_result = await validate_database(temp_db_path)
         if not validation_result["valid"]:
             raise ValueError(validation_result["message"])
@@ -3609,10 +4485,12 @@ from aiogram import exceptions
 class SerialPost(StatesGroup):
     waiting_anime_code = State()
     waiting_episode_number = State()
+    waiting_episode_range = State()  # HTML mavsum rejimi: "1-12" ko'rinishidagi oraliq
     waiting_description = State()
     waiting_template = State()
     waiting_media = State()
     waiting_channel = State()
+    waiting_preview_confirm = State()  # HTML: qoralama rasm adminga yuborilgan, tasdiq kutilmoqda
     post_type = State()  # YANGI: "simple" yoki "html"
 
 @dp.message(lambda message: message.text == "🎞 Serial Post Qilish")
@@ -3670,6 +4548,11 @@ async def get_serial_anime_code(message: types.Message, state: FSMContext):
                 row = []
         if row:
             buttons.append(row)
+        if (await state.get_data()).get('post_type') == "html":
+            buttons.append([InlineKeyboardButton(
+                text="📦 Bir nechta qism (mavsum)",
+                callback_data="select_ep_range"
+            )])
         buttons.append([InlineKeyboardButton(
             text="🔙 Bekor qilish",
             callback_data="cancel_serial_post"
@@ -3685,6 +4568,70 @@ async def get_serial_anime_code(message: types.Message, state: FSMContext):
     finally:
         conn.close()
 
+@dp.callback_query(SerialPost.waiting_episode_number, lambda c: c.data == "select_ep_range")
+async def select_episode_range_for_post(call: types.CallbackQuery, state: FSMContext):
+    await state.set_state(SerialPost.waiting_episode_range)
+    await call.message.edit_text(
+        "📦 Qismlar oralig'ini kiriting (masalan: <code>1-12</code> yoki <code>1-6, 9, 11-12</code>):",
+        parse_mode="HTML"
+    )
+    await call.answer()
+
+def parse_episode_range(text: str, limit: int) -> list:
+    """
+    "1-6, 9, 11-12" -> [1, 2, 3, 4, 5, 6, 9, 11, 12]; noto'g'ri format bo'lsa ValueError.
+    limit dan keng oraliq yoki limit dan ko'p qism ham ValueError - "1-1000000000" kengaytirilmasdan rad etiladi.
+    """
+    episodes = set()
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        start, end = int(start), int(end or start)
+        if start < 1 or end < start or end - start + 1 > limit:
+            raise ValueError(part)
+        episodes.update(range(start, end + 1))
+        if len(episodes) > limit:
+            raise ValueError(text)
+    if not episodes:
+        raise ValueError(text)
+    return sorted(episodes)
+
+@dp.message(SerialPost.waiting_episode_range)
+async def get_serial_episode_range(message: types.Message, state: FSMContext):
+    if message.text == "🔙 Bekor qilish":
+        await state.clear()
+        await cancel_post_action(message)
+        return
+    try:
+        requested = parse_episode_range(message.text or "", SEASON_BATCH_MAX)
+    except ValueError:
+        await message.answer(f"❌ Noto'g'ri format yoki {SEASON_BATCH_MAX} tadan ko'p qism. Masalan: 1-12 yoki 1-6, 9")
+        return
+    data = await state.get_data()
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        existing = {row[0] for row in conn.execute(
+            "SELECT episode_number FROM episodes WHERE anime_code = ?", (data.get('anime_code'),)
+        )}
+    finally:
+        conn.close()
+    episodes = [ep for ep in requested if ep in existing]
+    if not episodes:
+        await message.answer("❌ Bu oraliqda bazada mavjud qism topilmadi. Qayta kiriting:")
+        return
+    if len(episodes) > SEASON_BATCH_MAX:
+        await message.answer(f"❌ Bir martada ko'pi bilan {SEASON_BATCH_MAX} ta qism. Qayta kiriting:")
+        return
+    skipped = len(requested) - len(episodes)
+    await state.update_data(episode_number=episodes[0], episode_range=episodes)
+    await state.set_state(SerialPost.waiting_description)
+    await message.answer(
+        f"✅ {len(episodes)} ta qism tanlandi ({episodes[0]}-{episodes[-1]})"
+        + (f", bazada yo'q {skipped} tasi o'tkazib yuborildi" if skipped else "") + ".\n"
+        "📝 Barcha qismlar uchun umumiy post tavsifini kiriting:"
+    )
+
 @dp.callback_query(SerialPost.waiting_episode_number, lambda c: c.data.startswith("select_ep_"))
 async def select_episode_for_post(call: types.CallbackQuery, state: FSMContext):
     episode_number = int(call.data.replace("select_ep_", ""))
@@ -3883,590 +4830,814 @@ import tempfile
 # Global bot obyekti (sizning kodingizda allaqachon e'lon qilingan)
 # from your_main_file import bot  # Agar boshqa faylda bo'lsa
 
-def load_font(size, bold=False):
-    """Yaxshilangan font yuklash funksiyasi"""
-    # Tizim fontlarini tekshirish tartibi
-    fonts = [
-        # Linux
-        f"/usr/share/fonts/truetype/dejavu/DejaVuSans{'-Bold' if bold else ''}.ttf",
-        "/usr/share/fonts/truetype/liberation/LiberationSans{'-Bold' if bold else ''}.ttf",
-        # macOS
-        f"/System/Library/Fonts/Arial{' Bold' if bold else ''}.ttf",
-        "/System/Library/Fonts/Helvetica.ttf",
-        # Windows
-        f"C:/Windows/Fonts/arial{'bd' if bold else ''}.ttf",
-        "C:/Windows/Fonts/calibri{'b' if bold else ''}.ttf",
-        # Umumiy
-        "arial.ttf" if not bold else "arialbd.ttf",
-        "DejaVuSans.ttf" if not bold else "DejaVuSans-Bold.ttf",
-        "calibri.ttf" if not bold else "calibrib.ttf",
-    ]
-    
-    for font_path in fonts:
-        try:
-            if os.path.exists(font_path):
-                font = ImageFont.truetype(font_path, size)
-                logging.info(f"✅ Font yuklandi: {font_path}")
-                return font
-        except (OSError, IOError):
-            continue
-    
-    # Agar hech qanday font topilmasa, default font
-    logging.warning("⚠️ Tizim font topilmadi, default font ishlatiladi")
-    try:
-        font = ImageFont.load_default()
-        logging.info("✅ Default font yuklandi")
-        return font
-    except:
-        return ImageFont.load_default()
+# ==================== HTML POST RASM GENERATORI ====================
+import logging
+import tempfile
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import json
+from post_renderer import (
+    render_post_image, render_post_batch, warm_up_worker, font_registry, TEMPLATE_VERSION, ENCODERS,
+    compile_layout, normalize_layout, RENDER_PROFILES, PREVIEW_PROFILE, estimate_render_bytes,
+    worker_resident_bytes, PosterDecodeError,
+)
 
-# ==================== MATN QISQARTIRISH FUNKSIYASI ====================
-def wrap_text(text, font, max_width, draw_obj, max_words_for_title=999):
+# Pillow ishi (LANCZOS, GaussianBlur, PNG optimize) alohida jarayonlarda bajariladi,
+# aks holda render davomida event loop va barcha foydalanuvchi update'lari to'xtab qoladi.
+# Quyida RENDER_MEMORY_BUDGET_MB ga sig'adigan songacha kamaytiriladi (render_pool yaratilishidan oldin)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", "8"))  # ishchilar band bo'lganda kutishi mumkin bo'lgan renderlar
+# Render ishchilarining jami xotirasi (512 MB konteyner uchun ~256 MB, qolgani bot jarayoni va kutubxonalar):
+#   RENDER_WORKERS x worker_resident_bytes() - har bir ishchidagi doimiy keshlar
+#     (RENDER_LAYER_CACHE_MB, standart 32 MB + PLAN_CACHE_SIZE ta reja, 1080p da ~32 MB)
+#   + qolgani - bir vaqtda bajarilayotgan renderlar (har biri estimate_render_bytes() bo'yicha, ~24 MB 1080p).
+# Ishchi interpreter va kutubxonalari fork orqali asosiy jarayon bilan bo'lishiladi.
+RENDER_MEMORY_BUDGET_MB = int(os.getenv("RENDER_MEMORY_BUDGET_MB", "256"))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "30"))  # bitta render uchun soniya
+RENDER_FORMAT = os.getenv("RENDER_FORMAT", "jpeg")  # jpeg | webp | png (post_renderer.ENCODERS)
+if RENDER_FORMAT not in ENCODERS:
+    logging.warning(f"⚠️ Noma'lum RENDER_FORMAT={RENDER_FORMAT}, jpeg ishlatiladi")
+    RENDER_FORMAT = "jpeg"
+RENDER_EXT = ENCODERS[RENDER_FORMAT]["ext"]
+# 720p | 1080p (post_renderer.RENDER_PROFILES). Telegram rasmni ~1280px gacha kichraytiradi,
+# shuning uchun 720p sifatda deyarli farq qilmaydi, lekin ~2 barobar tezroq va kam xotira oladi
+RENDER_PROFILE = os.getenv("RENDER_PROFILE", "1080p")
+if RENDER_PROFILE not in RENDER_PROFILES or RENDER_PROFILE == PREVIEW_PROFILE:
+    logging.warning(f"⚠️ Noma'lum RENDER_PROFILE={RENDER_PROFILE}, 1080p ishlatiladi")
+    RENDER_PROFILE = "1080p"
+SEASON_BATCH_MAX = int(os.getenv("SEASON_BATCH_MAX", "50"))  # mavsum rejimida bir martada qismlar soni
+
+class RenderQueueFullError(Exception):
+    """Render navbati to'lgan - so'rov darhol rad etiladi (HTTP API da 503)"""
+
+class RenderPool:
     """
-    Matnni berilgan kenglikda qatorlarga ajratadi
-    Sarlavha uchun max_words_for_title limitini qo'llaydi (999 = cheksiz)
+    ProcessPoolExecutor ustidagi render rejalashtiruvchisi (admission control).
+    Ish boshlanishi uchun ikkala shart kerak: bo'sh ishchi (RENDER_WORKERS) va xotira byudjetida joy
+    (RENDER_JOB_BUDGET - ishchilar keshlaridan keyin qolgan qism, ish narxi - estimate_render_bytes). Aks holda ish FIFO navbatda kutadi;
+    navbatda RENDER_QUEUE_SIZE tadan ortiq bo'lsa RenderQueueFullError. Byudjetdan katta bitta ish
+    faqat pool bo'sh bo'lganda boshlanadi. Timeout bo'lgan render ishchisi to'xtatiladi.
     """
-    words = text.split()
-    
-    # Sarlavha uchun max_words_for_title tekshiruvi
-    if len(words) > max_words_for_title and max_words_for_title < 999:
-        # Faqat birinchi max_words_for_title ta so'z + "..."
-        truncated_text = ' '.join(words[:max_words_for_title]) + "..."
-        # Truncated matnni tekshirish
+    def __init__(self, workers: int, queue_size: int, timeout: float, memory_budget: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.memory_budget = memory_budget
+        self._executor = None
+        self._running = 0
+        self._memory_in_use = 0
+        self._waiters = deque()  # (narx, future) - kelish tartibida
+        self.stats = {"completed": 0, "failed": 0, "timeouts": 0, "rejected": 0, "restarts": 0, "queued": 0,
+                      "retried": 0}
+
+    def _ensure_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # fork: ishchi bot.py ni qayta import qilmaydi. spawn/forkserver har bir ishchida bot.py ni
+            # __mp_main__ sifatida qayta bajaradi (init_db, Bot, media_store) - shuning uchun qayta yaratishda ham fork.
+            # Qayta yaratish kamdan-kam (faqat timeout/crash), logging qulflarini Python fork da o'zi tiklaydi
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=warm_up_worker,
+            )
+        return self._executor
+
+    def start(self):
+        """Ishchilarni oldindan yaratadi - fork polling va oqimlar boshlanishidan oldin bo'lishi uchun"""
+        # Fontlar asosiy jarayonda aniqlanadi: fork qilingan ishchilar tayyor keshni meros oladi
+        font_registry.preload()
+        compile_layout("", RENDER_PROFILE)
+        self._ensure_executor().submit(int).result()
+
+    def _restart(self, executor: ProcessPoolExecutor):
+        """executor hali joriy bo'lsa to'xtatadi (har bir avlod uchun bir marta)"""
+        if executor is None or executor is not self._executor:
+            return
+        self._executor = None
+        self.stats["restarts"] += 1
+        # Osilib qolgan ishchini to'xtatishning boshqa yo'li yo'q: jarayonlar majburan yakunlanadi
+        for process in list(getattr(executor, "_processes", {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _fits(self, cost: int) -> bool:
+        if self._running >= self.workers:
+            return False
+        return self._running == 0 or self._memory_in_use + cost <= self.memory_budget
+
+    def _take(self, cost: int):
+        self._running += 1
+        self._memory_in_use += cost
+
+    def _release(self, cost: int):
+        self._running -= 1
+        self._memory_in_use -= cost
+        # Navbat boshidan sig'adiganlarini ishga tushiramiz (FIFO: katta ish kichiklar ortida och qolmaydi)
+        while self._waiters and self._fits(self._waiters[0][0]):
+            waiter_cost, waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self._take(waiter_cost)
+            waiter.set_result(None)
+
+    async def _acquire(self, cost: int):
+        if not self._waiters and self._fits(cost):
+            self._take(cost)
+            return
+        if len(self._waiters) >= self.queue_size:
+            self.stats["rejected"] += 1
+            raise RenderQueueFullError(
+                f"Render navbati to'la ({self._running} ta bajarilmoqda, {len(self._waiters)} ta kutmoqda)")
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (cost, waiter)
+        self._waiters.append(entry)
+        self.stats["queued"] += 1
         try:
-            bbox = draw_obj.textbbox((0, 0), truncated_text, font=font)
-            test_width = bbox[2] - bbox[0]
-            if test_width <= max_width:
-                return [truncated_text]  # Faqat bitta qator
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Joy berilgan edi, lekin chaqiruvchi bekor qildi - qaytaramiz
+                self._release(cost)
             else:
-                # Agar truncated ham sig'masa, oxirgi so'zni kesib tashlaymiz
-                while len(words[:max_words_for_title]) > 1:
-                    words = words[:max_words_for_title-1]
-                    truncated_text = ' '.join(words) + "..."
-                    bbox = draw_obj.textbbox((0, 0), truncated_text, font=font)
-                    test_width = bbox[2] - bbox[0]
-                    if test_width <= max_width:
-                        return [truncated_text]
-        except:
-            # Xatolik bo'lsa oddiy usul
-            return [' '.join(words[:max_words_for_title]) + "..."]
-        # Agar hech narsa sig'masa, faqat birinchi so'z + "..."
-        return [words[0] + "..."]
-    
-    # Oddiy wrap_text logikasi (cheksiz so'zlar uchun)
-    lines = []
-    current_line = []
-    
-    for word in words:
-        test_line = ' '.join(current_line + [word])
+                self._waiters.remove(entry)
+            raise
+
+    async def run(self, fn, *args, cost: int = None):
+        """fn(*args) ni ishchida bajaradi; cost - ishning taxminiy xotirasi (bayt)"""
+        cost = estimate_render_bytes(RENDER_PROFILE) if cost is None else cost
+        await self._acquire(cost)
         try:
-            bbox = draw_obj.textbbox((0, 0), test_line, font=font)
-            test_width = bbox[2] - bbox[0]
-        except:
-            try:
-                bbox = draw_obj.textbbox((0, 0), test_line, font=font)
-                test_width = bbox[2] - bbox[0]
-            except:
-                test_width = len(test_line) * 10
-        
-        if test_width <= max_width:
-            current_line.append(word)
-        else:
-            if current_line:
-                lines.append(' '.join(current_line))
-            current_line = [word]
-    
-    if current_line:
-        lines.append(' '.join(current_line))
-    
-    return lines
+            loop = asyncio.get_running_loop()
+            retried = False
+            while True:
+                executor = self._ensure_executor()
+                try:
+                    future = loop.run_in_executor(executor, fn, *args)
+                    result = await asyncio.wait_for(future, timeout=self.timeout)
+                except asyncio.TimeoutError:
+                    self.stats["timeouts"] += 1
+                    logging.error(f"⏱ Render {self.timeout}s ichida tugamadi, ishchilar qayta ishga tushiriladi")
+                    self._restart(executor)
+                    raise
+                except (BrokenProcessPool, asyncio.CancelledError) as e:
+                    # CancelledError: navbatdagi ish to'xtatilgan pool bilan bekor qilingan (chaqiruvchi bekor qilmagan)
+                    if isinstance(e, asyncio.CancelledError) and asyncio.current_task().cancelling():
+                        raise
+                    if executor is not self._executor and not retried:
+                        # Pool boshqa ish sababli (timeout/crash) allaqachon almashtirilgan -
+                        # bu ish aybsiz, yangi poolda bir marta takrorlanadi
+                        self.stats["retried"] += 1
+                        retried = True
+                        continue
+                    if isinstance(e, asyncio.CancelledError):
+                        raise
+                    self.stats["failed"] += 1
+                    logging.error("❌ Render ishchisi kutilmaganda to'xtadi, pool qayta yaratiladi")
+                    self._restart(executor)
+                    raise
+                except Exception:
+                    self.stats["failed"] += 1
+                    raise
+                self.stats["completed"] += 1
+                return result
+        finally:
+            self._release(cost)
 
-# ==================== HTML POST RASM GENERATORI ====================
-import logging
-import math
-from io import BytesIO
-import tempfile
-import os
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+    def shutdown(self, wait: bool = False):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
 
-def wrap_text(text: str, font: ImageFont.ImageFont, max_width: int, draw: ImageDraw.ImageDraw, max_words_for_title=None) -> list:
-    words = text.split()
-    lines = []
-    current_line = []
-   
-    for word in words:
-        test_line = ' '.join(current_line + [word])
-        bbox = draw.textbbox((0, 0), test_line, font=font)
-        test_width = bbox[2] - bbox[0]
-       
-        if test_width <= max_width:
-            current_line.append(word)
-            # Faqat sarlavha uchun so'zlar sonini cheklash (agar kerak bo'lsa)
-            if max_words_for_title and len(current_line) >= max_words_for_title:
-                # So'zlar soni chegarasiga yetganda, lekin to'liq matnni ko'rsatish
-                if len(words) > max_words_for_title:
-                    lines.append(' '.join(current_line) + '...')
-                    return lines
-        else:
-            if current_line:
-                lines.append(' '.join(current_line))
-            current_line = [word]
-   
-    if current_line:
-        lines.append(' '.join(current_line))
-    return lines
-
-def load_font(size, bold=False):
-    fonts = [
-        "Poppins-Bold.ttf" if bold else "Poppins-Regular.ttf",
-        "arialbd.ttf" if bold else "arial.ttf",
-        "Arial Bold.ttf" if bold else "Arial.ttf",
-        "DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf",
-    ]
-    for font_name in fonts:
-        try:
-            return ImageFont.truetype(font_name, size)
-        except OSError:
-            continue
-    return ImageFont.load_default()
+    def metrics(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "timeout": self.timeout,
+            "running": self._running,
+            "waiting": len(self._waiters),
+            "memory_budget": self.memory_budget,
+            "memory_in_use": self._memory_in_use,
+            **self.stats,
+        }
 
-async def generate_html_post_image_pillow(
-    title: str, desc: str, genre: str, file_id: str, anime_code: str, episode_num: int
-) -> str:
+# Har bir ishchi kamida bitta renderni bajara olishi kerak: ishchilar x (keshlar + bitta render) <= byudjet.
+# Standart 256 MB: 1080p - 256 / (63.6 + 23.7) = 2 ishchi, 720p - 256 / (46.1 + 10.5) = 4 ishchi
+_render_worker_bytes = worker_resident_bytes(RENDER_PROFILE) + estimate_render_bytes(RENDER_PROFILE)
+_render_workers_max = max(1, RENDER_MEMORY_BUDGET_MB * 1024 * 1024 // _render_worker_bytes)
+if RENDER_WORKERS > _render_workers_max:
+    log = logging.warning if os.getenv("RENDER_WORKERS") else logging.info
+    log(f"⚠️ RENDER_WORKERS={RENDER_WORKERS} RENDER_MEMORY_BUDGET_MB={RENDER_MEMORY_BUDGET_MB} ga sig'maydi, "
+        f"{_render_workers_max} ishchi ishlatiladi")
+    RENDER_WORKERS = _render_workers_max
+
+# Renderlar uchun qoladigan byudjet: umumiy chegaradan ishchilar keshlari ayiriladi
+RENDER_JOB_BUDGET = RENDER_MEMORY_BUDGET_MB * 1024 * 1024 - RENDER_WORKERS * worker_resident_bytes(RENDER_PROFILE)
+if RENDER_JOB_BUDGET < estimate_render_bytes(RENDER_PROFILE):
+    logging.warning(f"⚠️ RENDER_MEMORY_BUDGET_MB={RENDER_MEMORY_BUDGET_MB} ishchilar keshlariga zo'rg'a yetadi: "
+                    f"renderlar birma-bir bajariladi (RENDER_WORKERS yoki RENDER_LAYER_CACHE_MB ni kamaytiring)")
+render_pool = RenderPool(RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_TIMEOUT, max(0, RENDER_JOB_BUDGET))
+metrics_providers["render_pool"] = render_pool.metrics
+
+# ==================== RENDER KESHI ====================
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", "render_cache")
+RENDER_CACHE_MAX_MB = int(os.getenv("RENDER_CACHE_MAX_MB", "256"))
+
+class DiskLRUCache:
     """
-    Qirqilgan va siljitilgan rasm generator
-    O'ng tomondan 25% qirqiladi va chap tomonga siljitiladi
+    Diskdagi kalit -> baytlar keshi, umumiy hajm chegarasi bilan.
+    LRU tartibi xotirada saqlanadi va fayl mtime orqali qayta ishga tushishdan keyin tiklanadi.
     """
-    try:
-        logging.info(f"🎨 Rasm yaratish boshlandi: {title}")
-        logging.info(f"📁 File ID: {file_id[:20]}...")
-        # 1. Rasmni yuklab olish
+    def __init__(self, directory: str, max_bytes: int, suffix: str = ""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._index = OrderedDict()  # kalit -> hajm, eng eskisi boshida
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.endswith(suffix) or name.startswith(".") or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name[:len(name) - len(suffix)] if suffix else name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total += size
+        self._evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def path(self, key: str):
+        """Mavjud yozuv fayli yo'li (LRU da yangilanadi) yoki None"""
+        if key not in self._index:
+            self.misses += 1
+            return None
+        path = self._path(key)
         try:
-            logging.info("🔍 Bot orqali file olish...")
-            file = await bot.get_file(file_id)
-            logging.info(f"✅ File olingan: {file.file_path}")
-            logging.info("📥 File yuklanmoqda...")
-            file_bytes_io = await bot.download_file(file.file_path)
-            file_bytes = file_bytes_io.getvalue()
-            file_bytes_io.close()
-            logging.info(f"✅ File yuklandi: {len(file_bytes)} bytes")
-        except Exception as file_error:
-            logging.error(f"❌ File yuklashda xatolik: {file_error}")
-            raise Exception(f"File yuklashda xatolik: {file_error}")
-        # BytesIO orqali rasmni ochish
+            os.utime(path)
+        except FileNotFoundError:
+            self._total -= self._index.pop(key)
+            self.misses += 1
+            return None
+        self._index.move_to_end(key)
+        self.hits += 1
+        return path
+
+    def get(self, key: str):
+        path = self.path(key)
+        if path is None:
+            return None
         try:
-            image_stream = BytesIO(file_bytes)
-            image_stream.seek(0)
-            logging.info("🖼️ PIL orqali rasm ochilmoqda...")
-            bg_image = Image.open(image_stream).convert("RGBA")
-            logging.info(f"✅ Asl rasm o'lchami: {bg_image.size}")
-            image_stream.close()
-        except Exception as pil_error:
-            logging.error(f"❌ PIL da rasm ochishda xatolik: {pil_error}")
-            raise Exception(f"Rasm ochishda xatolik: {pil_error}")
-        # 2. RASMNI 1920x1080 GA MOSLASHTIRISH + QIRQISH
-        original_size = bg_image.size
-        if original_size != (1920, 1080):
-            logging.info(f"📏 Rasm {original_size} -> 1920x1080 ga o'zgartirilmoqda")
-            bg_image = bg_image.resize((1920, 1080), Image.Resampling.LANCZOS)
-            logging.info("✅ Rasm 1920x1080 ga resize qilindi")
-        else:
-            logging.info("✅ Rasm allaqachon 1920x1080")
-        # O'NG TOMONDAN 25% QIRQISH + CHAP TOMONGA SILJITISH
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            self._total -= self._index.pop(key, 0)
+            return None
+
+    def temp_path(self, key: str) -> str:
+        """Shu papkadagi yangi, noyob vaqtinchalik fayl (skanerlashda e'tiborsiz qoldiriladi)"""
+        fd, path = tempfile.mkstemp(prefix=f".{key}.", suffix=".tmp", dir=self.directory)
+        os.close(fd)
+        return path
+
+    def adopt(self, key: str, temp_path: str) -> str:
+        """Tayyor vaqtinchalik faylni keshga atomik ko'chiradi, keyin hajm bo'yicha tozalash"""
+        path = self._path(key)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        self._total += size - self._index.pop(key, 0)
+        self._index[key] = size
+        self._evict()
+        return path
+
+    def put(self, key: str, data: bytes) -> str:
+        """Atomik yozish (vaqtinchalik fayl + os.replace)"""
+        temp_path = self.temp_path(key)
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        return self.adopt(key, temp_path)
+
+    def _evict(self):
+        # Eng oxirgi yozuv chegaradan katta bo'lsa ham saqlanadi
+        while self._total > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self._total -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._index),
+            "bytes": self._total,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+class RenderCache:
+    """
+    Tayyor post rasmlari keshi: kalit - (poster file_unique_id, matnlar, qism, shablon versiyasi) xeshi.
+    Bir xil kalit bo'yicha parallel so'rovlar bitta renderni kutadi (single-flight).
+    """
+    def __init__(self, store: DiskLRUCache):
+        self.store = store
+        self._inflight = {}
+        self.requests = 0
+        self.hits = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(file_unique_id: str, title: str, desc: str, genre: str, episode_num: int,
+                 encoder: str = RENDER_FORMAT, layout: str = "", profile: str = RENDER_PROFILE) -> str:
+        """Fayl nomi sifatida ham ishlatiladi: <sha256>.<kengaytma>"""
+        raw = json.dumps([file_unique_id, title, desc, genre, episode_num, TEMPLATE_VERSION, encoder, layout,
+                          profile], ensure_ascii=False)
+        return f"{hashlib.sha256(raw.encode('utf-8')).hexdigest()}.{ENCODERS[encoder]['ext']}"
+
+    def lookup(self, key: str):
+        """Faqat keshdan o'qish (statistikaga qo'shiladi); yo'q bo'lsa None"""
+        self.requests += 1
+        data = self.store.get(key)
+        if data is not None:
+            self.hits += 1
+        return data
+
+    async def get_or_render(self, key: str, producer) -> bytes:
+        """producer() -> (baytlar, keshlash_mumkinmi); fallback rasmlar keshlanmaydi"""
+        self.requests += 1
+        data = self.store.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        if key in self._inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self._inflight[key])
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
         try:
-            logging.info("✂️ O'ng tomondan 25% qirqilmoqda...")
-            original_width = bg_image.width
-            cut_width = int(original_width * 0.25) # 25% qirqish (480px)
-            remaining_width = original_width - cut_width # Qolgan 75% (1440px)
-            # O'ng tomondan qirqish (1440px dan 1920px gacha)
-            cut_region = bg_image.crop((remaining_width, 0, original_width, bg_image.height))
-            # Yangi rasm yaratish va qirqilgan qismni chap tomonga siljitish
-            new_image = Image.new("RGBA", (original_width, bg_image.height), (0, 0, 0, 0))
-            # Chap tomonga qirqilgan qismni joylashtirish (0 dan 480px gacha)
-            new_image.paste(cut_region, (0, 0))
-            # O'rta qismni joylashtirish (480px dan 1920px gacha)
-            middle_part = bg_image.crop((0, 0, remaining_width, bg_image.height))
-            new_image.paste(middle_part, (cut_width, 0))
-            # Natijani saqlash
-            bg_image = new_image
-            logging.info(f"✅ Qirqish yakunlandi: {cut_width}px qirqildi va chap tomonga siljitildi")
-            logging.info(f"📐 Yangi rasm: {bg_image.size}")
-        except Exception as crop_error:
-            logging.warning(f"⚠️ Qirqishda xatolik: {crop_error}")
-            # Agar xatolik bo'lsa, asl rasm saqlanadi
-    except Exception as e:
-        logging.error(f"❌ Rasmni yuklashda xatolik: {e}")
-        # Fallback rasm
-        bg_image = Image.new("RGBA", (1920, 1080), (25, 25, 25, 255))
-        draw = ImageDraw.Draw(bg_image)
-        fallback_font = load_font(60, bold=True)
-        draw.text((100, 100), f"FALLBACK: {title[:20]}...", fill=(255, 255, 255), font=fallback_font)
-        logging.info("✅ Fallback rasm tayyor")
-    # 3. Dominant rang - YAXSHILANGAN
+            data, cacheable = await producer()
+            if cacheable:
+                self.store.put(key, data)
+            future.set_result(data)
+            return data
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # kutuvchi bo'lmasa "never retrieved" ogohlantirishi chiqmasin
+            raise
+        finally:
+            del self._inflight[key]
+
+    def metrics(self) -> dict:
+        store_stats = self.store.stats()
+        # Disk darajasidagi hit/miss emas, so'rovlar darajasidagi ko'rsatkichlar ishlatiladi
+        store_stats.pop("hits")
+        store_stats.pop("misses")
+        return {
+            "requests": self.requests,
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "hit_ratio": round(self.hits / self.requests, 3) if self.requests else None,
+            "inflight": len(self._inflight),
+            **store_stats,
+        }
+
+render_cache = RenderCache(DiskLRUCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_MB * 1024 * 1024))
+metrics_providers["render_cache"] = render_cache.metrics
+metrics_providers["media_file_ids"] = lambda: dict(media_file_id_stats)
+
+# Yuklangan posterlar (file_unique_id bo'yicha): bir serial qismlari bitta posterni qayta yuklamaydi
+POSTER_CACHE_DIR = os.getenv("POSTER_CACHE_DIR", "poster_cache")
+POSTER_CACHE_MAX_MB = int(os.getenv("POSTER_CACHE_MAX_MB", "256"))
+
+poster_cache = DiskLRUCache(POSTER_CACHE_DIR, POSTER_CACHE_MAX_MB * 1024 * 1024)
+metrics_providers["poster_cache"] = poster_cache.stats
+_poster_downloads = {}  # file_unique_id -> Future: bir xil poster parallel so'rovlarda bir marta yuklanadi
+
+# ==================== MEDIA OMBORI (/static/) ====================
+MEDIA_STORE_DIR = os.getenv("MEDIA_STORE_DIR", "media_store")
+MEDIA_STORE_MAX_MB = int(os.getenv("MEDIA_STORE_MAX_MB", "512"))
+MEDIA_STORE_MAX_AGE_DAYS = float(os.getenv("MEDIA_STORE_MAX_AGE_DAYS", "30"))
+MEDIA_JANITOR_INTERVAL = int(os.getenv("MEDIA_JANITOR_INTERVAL", "600"))  # soniya
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class MediaStore:
+    """
+    HTTP orqali beriladigan tayyor rasmlar. Fayl nomi - kontentning sha256 xeshi + kengaytma,
+    shuning uchun yozilgan fayl hech qachon o'zgarmaydi va abadiy keshlanishi mumkin.
+    Fayllarga o'qishda tegilmaydi: mtime - yozilgan vaqt, sweep() shu bo'yicha eskilarini,
+    keyin hajm chegarasidan ortganini (eng eskisidan boshlab) o'chiradi.
+    """
+    def __init__(self, directory: str, max_bytes: int, max_age: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.stats_counters = {"writes": 0, "dedup": 0, "evicted_age": 0, "evicted_size": 0}
+        self._entries = 0
+        self._total = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def valid_name(name: str) -> bool:
+        stem, _, ext = (name or "").partition(".")
+        return (len(stem) == 64 and all(c in "0123456789abcdef" for c in stem)
+                and 0 < len(ext) <= 5 and ext.isalnum())
+
+    def path(self, name: str):
+        """Mavjud fayl yo'li yoki None (faqat xesh nomlar - papkadan tashqariga chiqib bo'lmaydi)"""
+        if not self.valid_name(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def __contains__(self, name: str) -> bool:
+        return self.path(name) is not None
+
+    def put(self, data: bytes, ext: str = RENDER_EXT) -> str:
+        """Baytlarni yozadi va fayl nomini qaytaradi; bir xil kontent qayta yozilmaydi (mtime/ETag o'zgarmaydi)"""
+        name = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+        if name in self:
+            self.stats_counters["dedup"] += 1
+            return name
+        temp_path = os.path.join(self.directory, f".{name}.{os.getpid()}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, os.path.join(self.directory, name))
+        self.stats_counters["writes"] += 1
+        self._entries += 1
+        self._total += len(data)
+        return name
+
+    def sweep(self) -> int:
+        """Eski va ortiqcha fayllarni o'chiradi, o'chirilganlar sonini qaytaradi"""
+        now = time.time()
+        entries = []
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.startswith("."):
+                # Yozish paytida uzilib qolgan vaqtinchalik fayllar
+                if name.endswith(".tmp") and now - stat.st_mtime > 3600:
+                    os.remove(path)
+                continue
+            if not self.valid_name(name):
+                continue
+            if now - stat.st_mtime > self.max_age:
+                os.remove(path)
+                self.stats_counters["evicted_age"] += 1
+                removed += 1
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+        entries.sort()
+        total = sum(size for _, _, size in entries)
+        while total > self.max_bytes and entries:
+            _, path, size = entries.pop(0)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.stats_counters["evicted_size"] += 1
+            removed += 1
+        self._entries = len(entries)
+        self._total = total
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            **self.stats_counters,
+            "entries": self._entries,
+            "bytes": self._total,
+            "max_bytes": self.max_bytes,
+            "max_age": self.max_age,
+        }
+
+media_store = MediaStore(MEDIA_STORE_DIR, MEDIA_STORE_MAX_MB * 1024 * 1024, MEDIA_STORE_MAX_AGE_DAYS * 86400)
+media_store.sweep()
+metrics_providers["media_store"] = media_store.stats
+
+async def media_store_janitor():
+    """media_store ni vaqti-vaqti bilan yosh va hajm bo'yicha tozalaydi (fon vazifasi)"""
+    while True:
+        try:
+            removed = await asyncio.to_thread(media_store.sweep)
+            if removed:
+                logging.info(f"🧹 Media ombori: {removed} ta fayl o'chirildi")
+        except Exception as e:
+            logging.error(f"❌ Media omborini tozalashda xatolik: {e}")
+        await asyncio.sleep(MEDIA_JANITOR_INTERVAL)
+
+async def _download_poster(file) -> str:
+    """
+    Poster fayli yo'li. Lokal rejimda Bot API faylining o'zi, aks holda poster_cache dagi nusxa.
+    Yuklash to'g'ridan-to'g'ri diskka oqadi (BytesIO nusxalarisiz), ishchi faylni mmap orqali o'qiydi.
+    """
+    # Lokal Bot API rejimida ishchi rasmni to'g'ridan-to'g'ri diskdan o'qiydi
+    local_path = telegram_local_path(file.file_path)
+    if local_path:
+        logging.info(f"📂 Lokal fayl ishlatiladi: {local_path}")
+        return local_path
+    key = file.file_unique_id
+    cached_path = poster_cache.path(key)
+    if cached_path:
+        logging.info(f"📦 Poster keshdan olindi: {key}")
+        return cached_path
+    if key in _poster_downloads:
+        return await asyncio.shield(_poster_downloads[key])
+    future = asyncio.get_running_loop().create_future()
+    _poster_downloads[key] = future
+    temp_path = poster_cache.temp_path(key)
     try:
-        # Markaziy qismdan rang olish
-        center_x, center_y = bg_image.size[0] // 2, bg_image.size[1] // 2
-        sample_size = 100
-        sample = bg_image.crop((
-            center_x - sample_size//2,
-            center_y - sample_size//2,
-            center_x + sample_size//2,
-            center_y + sample_size//2
-        ))
-        # O'rtacha rangni hisoblash
-        pixels = sample.load()
-        r_total, g_total, b_total, a_total = 0, 0, 0, 0
-        pixel_count = 0
-        for x in range(sample.size[0]):
-            for y in range(sample.size[1]):
-                r, g, b, a = pixels[x, y]
-                if a > 0: # Shaffof emas
-                    r_total += r
-                    g_total += g
-                    b_total += b
-                    a_total += a
-                    pixel_count += 1
-        if pixel_count > 0:
-            dominant_color = (
-                int(r_total / pixel_count),
-                int(g_total / pixel_count),
-                int(b_total / pixel_count)
-            )
+        await bot.download_file(file.file_path, destination=temp_path)
+        path = poster_cache.adopt(key, temp_path)
+        future.set_result(path)
+    except BaseException as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
         else:
-            dominant_color = (100, 100, 100)
-        logging.info(f"🎨 Dominant rang: {dominant_color}")
-    except Exception as e:
-        logging.warning(f"⚠️ Rang hisoblashda xatolik: {e}")
-        dominant_color = (246, 79, 89)
-    # 4. Asosiy rasm yaratish
-    final_image = bg_image.copy()
-    logging.info("🖼️ Final rasm yaratildi")
-    # 5. Chap tomonga gradient - KATTALASHTIRILDI
+            future.set_exception(e)
+            future.exception()  # kutuvchi bo'lmasa "never retrieved" ogohlantirishi chiqmasin
+        raise
+    finally:
+        del _poster_downloads[key]
+    logging.info(f"✅ File yuklandi: {os.path.getsize(path)} bytes")
+    return path
+
+def get_channel_layout(channel_id) -> str:
+    """Kanalga biriktirilgan vizual uslub (normalize_layout JSON); biriktirilmagan bo'lsa "" - standart"""
+    conn = sqlite3.connect('anime_bot.db')
     try:
-        left_width = int(1920 * 0.6) # Kattaroq
-        mask = Image.new('L', (left_width, 1080), 0)
-        mask_draw = ImageDraw.Draw(mask)
-        mask_draw.polygon([
-            (0, 0),
-            (left_width, 0),
-            (int(0.8 * left_width), 1080),
-            (0, 1080)
-        ], fill=255)
-        gradient_layer = Image.new("RGBA", (left_width, 1080))
-        pixels = gradient_layer.load()
-        angle_rad = math.radians(-225)
-        dx = math.cos(angle_rad)
-        dy = math.sin(angle_rad)
-        center_x, center_y = left_width / 2, 1080 / 2
-        max_dist = math.sqrt(left_width**2 + 1080**2) / 2
-        for x in range(left_width):
-            for y in range(1080):
-                distance = (x - center_x) * dx + (y - center_y) * dy
-                ratio = max(0.0, min(1.0, (distance + max_dist) / (2 * max_dist)))
-                r = int(dominant_color[0] * (1 - ratio) + 0 * ratio)
-                g = int(dominant_color[1] * (1 - ratio) + 0 * ratio)
-                b = int(dominant_color[2] * (1 - ratio) + 0 * ratio)
-                a = int(60 + 80 * ratio)
-                pixels[x, y] = (r, g, b, a)
-        final_image.paste(gradient_layer, (0, 0), mask=mask)
-        logging.info("🌈 Gradient qo'shildi - kattaroq")
-    except Exception as e:
-        logging.warning(f"⚠️ Gradientda xatolik: {e}")
-    # 6. YAXSHILANGAN BLUR QISMI
-    draw_temp = ImageDraw.Draw(Image.new("RGBA", (1,1)))
+        row = conn.execute("""
+            SELECT lt.spec FROM channels c
+            JOIN layout_templates lt ON lt.name = c.layout_name
+            WHERE c.channel_id = ?
+        """, (str(channel_id),)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else ""
+
+async def render_post_card(title: str, desc: str, genre: str, file_id: str, episode_num: int,
+                           layout: str = "") -> tuple:
+    """
+    Post rasmi: (baytlar RENDER_FORMAT da, render keshi kaliti yoki None).
+    layout - get_channel_layout() natijasi; ishchi uni bir marta RenderPlan ga kompilyatsiya qiladi.
+    Natija render_cache da saqlanadi: bir xil poster va matnlar uchun qayta yuklash va renderlash bo'lmaydi.
+    Kalit outbox da media_key sifatida ishlatiladi (yuklangan rasmning file_id si shu kalitga yoziladi).
+    Fallback (poster olinmagan yoki ochilmagan) rasm uchun kalit None.
+    """
     try:
-        # Font o'lchamlari - SIZ O'ZGARTIRGAN O'LCHAMLAR
-        title_font = load_font(60, bold=True) # Sarlavha
-        episode_font = load_font(36, bold=True) # Qism - nomdan kichikroq
-        desc_font = load_font(24, bold=False) # Tavsif - ozgina kichik
-        btn_font = load_font(20, bold=True) # Tugma
-        menu_font = load_font(28, bold=True) # Janrlar
-        # MATN O'LCHAMLARINI HISOBLASH
-        # Sarlavha uchun to'liq matn bilan
-        title_lines = wrap_text(title.upper(), title_font, 1200, draw_temp)
-        title_height = len(title_lines) * 65 # Kichikroq line height
-        episode_height = 45
-        desc_lines = wrap_text(desc, desc_font, 1200, draw_temp)
-        desc_height = len(desc_lines) * 40 # Kichikroq line height
-        # Tugma
-        btn_text = "TOMOSHA QILISH"
-        bbox = draw_temp.textbbox((0, 0), btn_text, font=btn_font)
-        btn_height = bbox[3] - bbox[1] + 50
-        # JAMI MATN BALANDLIGI
-        total_text_height = title_height + episode_height + desc_height + btn_height
-        # BLUR REGION O'LCHAMLARI
-        base_width = 1300
-        min_height = total_text_height + 200
-        max_height = min(total_text_height + 180, 700)
-        blur_width = base_width
-        blur_height = max(min_height, max_height)
-        # MARKAZGA JOYLASHTIRISH
-        blur_x = (1920 - blur_width) // 2
-        blur_y = (1080 - blur_height) // 2
-        # Pastdan minimal bo'sh joy
-        min_bottom_margin = 100
-        if blur_y + blur_height > 1080 - min_bottom_margin:
-            blur_y = 1080 - blur_height - min_bottom_margin
-        # Tepadan minimal joy
-        min_top_margin = 120
-        if blur_y < min_top_margin:
-            blur_y = min_top_margin
-        logging.info(f"📏 Matn balandligi: {total_text_height}px")
-        logging.info(f"📐 Blur region: {blur_width}x{blur_height}")
-        logging.info(f"📍 Joylashuv: ({blur_x}, {blur_y})")
-        # BLUR REGION - XAVFSIZ
-        safe_blur_x = max(0, blur_x)
-        safe_blur_y = max(0, blur_y)
-        safe_width = min(blur_width, 1920 - safe_blur_x)
-        safe_height = min(blur_height, 1080 - safe_blur_y)
-        if safe_width > 0 and safe_height > 0:
+        file = await bot.get_file(file_id)
+        logging.info(f"✅ File olingan: {file.file_path}")
+    except Exception as file_error:
+        # Avvalgidek: poster yuklanmasa fallback fon bilan davom etamiz
+        logging.error(f"❌ File yuklashda xatolik: {file_error}")
+        data = await render_pool.run(render_post_image, None, title, desc, genre, episode_num, RENDER_FORMAT, layout,
+                                     RENDER_PROFILE)
+        return data, None
+
+    async def produce():
+        try:
+            image_source = await _download_poster(file)
+        except Exception as file_error:
+            logging.error(f"❌ File yuklashda xatolik: {file_error}")
+            image_source = None
+        if image_source is not None:
             try:
-                # Blur region yaratish
-                region_for_blur = final_image.crop((safe_blur_x, safe_blur_y, safe_blur_x + safe_width, safe_blur_y + safe_height))
-                # ANIQ BLUR EFEKTI
-                blurred_region = region_for_blur.filter(ImageFilter.GaussianBlur(radius=25))
-                # Shaffoflik - QORA SHAFFOF
-                transparent_bg = Image.new('RGBA', blurred_region.size, (0, 0, 0, 0))
-                blurred_region = Image.alpha_composite(transparent_bg, blurred_region)
-                blurred_region = Image.alpha_composite(blurred_region, Image.new('RGBA', blurred_region.size, (0, 0, 0, 10)))
-                # Yumaloq burchakli maska
-                mask_round = Image.new('L', (safe_width, safe_height), 0)
-                mask_draw = ImageDraw.Draw(mask_round)
-                try:
-                    mask_draw.rounded_rectangle([0, 0, safe_width, safe_height], radius=50, fill=255)
-                except AttributeError:
-                    mask_draw.rectangle([0, 0, safe_width, safe_height], fill=255)
-                # BLUR NI JOYLASHTIRISH
-                final_image.paste(blurred_region, (safe_blur_x, safe_blur_y), mask_round)
-                # RAMKA CHIZISH
-                draw = ImageDraw.Draw(final_image)
-                try:
-                    draw.rounded_rectangle(
-                        [safe_blur_x, safe_blur_y, safe_blur_x + safe_width, safe_blur_y + safe_height],
-                        radius=50,
-                        outline=(255, 255, 255, 100),
-                        width=1
-                    )
-                except:
-                    draw.rectangle(
-                        [safe_blur_x, safe_blur_y, safe_blur_x + safe_width, safe_blur_y + safe_height],
-                        outline=(255, 255, 255, 100),
-                        width=1
-                    )
-                # MATN KOORDINATLARI
-                caption_x = safe_blur_x + 60
-                caption_y = safe_blur_y + 60
-                max_text_width = safe_width - 120
-            except Exception as blur_error:
-                logging.warning(f"⚠️ Blur jarayonida xatolik: {blur_error}")
-                # Fallback - qora fon
-                draw = ImageDraw.Draw(final_image)
-                try:
-                    draw.rounded_rectangle(
-                        [safe_blur_x, safe_blur_y, safe_blur_x + safe_width, safe_blur_y + safe_height],
-                        radius=50,
-                        fill=(0, 0, 0, 180)
-                    )
-                except:
-                    draw.rectangle(
-                        [safe_blur_x, safe_blur_y, safe_blur_x + safe_width, safe_blur_y + safe_height],
-                        fill=(0, 0, 0, 180)
-                    )
-                caption_x = safe_blur_x + 60
-                caption_y = safe_blur_y + 60
-                max_text_width = safe_width - 120
-        else:
-            logging.warning("⚠️ Blur region xavfsiz emas, standart pozitsiya")
-            caption_x, caption_y = 360, 240
-            max_text_width = 1200 - 80
-    except Exception as e:
-        logging.warning(f"⚠️ Umumiy blur xatosi: {e}")
-        caption_x, caption_y = 360, 240
-        max_text_width = 1200 - 80
-    # 7. MATNLARNI CHIZISH
-    draw = ImageDraw.Draw(final_image)
-    current_y = caption_y
-    # 8. SARLAVHA - TO'LIQ MATN
+                # Poster kaliti ostida faqat haqiqatan ochilgan poster bilan chizilgan karta saqlanadi
+                data = await render_pool.run(render_post_image, image_source, title, desc, genre, episode_num,
+                                             RENDER_FORMAT, layout, RENDER_PROFILE, None, True)
+                return data, True
+            except PosterDecodeError:
+                logging.warning(f"⚠️ Poster ochilmadi, fallback karta keshlanmaydi: {file.file_unique_id}")
+        data = await render_pool.run(render_post_image, None, title, desc, genre, episode_num,
+                                     RENDER_FORMAT, layout, RENDER_PROFILE)
+        return data, False
+
+    key = RenderCache.make_key(file.file_unique_id, title, desc, genre, episode_num, layout=layout)
+    data = await render_cache.get_or_render(key, produce)
+    # Fallback keshlanmagan bo'lsa, file_id ham eslab qolinmasin
+    return data, (key if key in render_cache.store else None)
+
+async def render_preview_card(title: str, desc: str, genre: str, file_id: str, episode_num: int,
+                              layout: str = "") -> bytes:
+    """
+    Tezkor qoralama: xuddi shu layout rejasi PREVIEW_PROFILE o'lchamida (keshlanmaydi).
+    Poster poster_cache ga tushadi, shuning uchun keyingi to'liq render uni qayta yuklamaydi.
+    """
     try:
-        title_lines = wrap_text(title.upper(), title_font, max_text_width, draw)
-        line_height_title = 65 # Kichikroq
-        for i, line in enumerate(title_lines):
-            text_x = caption_x
-            text_y = current_y + (i * line_height_title)
-            # KATTA SOYA EFEKTI
-            shadow_offset = 4
-            shadow_color = (0, 0, 0, 220)
-            # Soya nuqtalar
-            for dx, dy in [
-                (-shadow_offset, -shadow_offset), (0, -shadow_offset), (shadow_offset, -shadow_offset),
-                (-shadow_offset, 0), (shadow_offset, 0),
-                (-shadow_offset, shadow_offset), (0, shadow_offset), (shadow_offset, shadow_offset)
-            ]:
-                draw.text((text_x + dx, text_y + dy), line, fill=shadow_color, font=title_font)
-            # Asosiy matn - OQ
-            draw.text((text_x, text_y), line, fill=(255, 255, 255), font=title_font)
-        current_y += len(title_lines) * line_height_title + 30 # Episode ga spacing - kichikroq
-        logging.info(f"✅ Sarlavha yozildi: {len(title_lines)} qator - '{title_lines[0] if title_lines else ''}'")
-        # DEBUG: Asl title va so'zlar soni
-        original_title_words = len(title.split())
-        if original_title_words > 2:
-            logging.info(f"📝 Sarlavha: {title} ({original_title_words} so'z)")
-    except Exception as e:
-        logging.warning(f"⚠️ Sarlavhada xatolik: {e}")
-        current_y += 100
-    # 9. EPISODE - NOMDAN KICHIKROQ
+        file = await bot.get_file(file_id)
+        image_source = await _download_poster(file)
+    except Exception as file_error:
+        logging.error(f"❌ File yuklashda xatolik: {file_error}")
+        image_source = None
+    return await render_pool.run(render_post_image, image_source, title, desc, genre, episode_num, RENDER_FORMAT,
+                                 layout, PREVIEW_PROFILE, cost=estimate_render_bytes(PREVIEW_PROFILE))
+
+async def render_post_batch_cards(title: str, desc: str, genre: str, file_id: str, episode_nums: list,
+                                  layout: str = "") -> list:
+    """
+    Mavsum uchun kartalar: episode_nums tartibida [(baytlar, media_key yoki None)].
+    Poster bir marta yuklanadi. Keshda yo'q qismlar RENDER_WORKERS ta bo'lakka bo'linib parallel renderlanadi,
+    har bir ishchi o'z bo'lagi uchun fon, gradient, blur va matnlarni bir marta chizadi (render_post_batch).
+    """
     try:
-        episode_text = f"QISM {episode_num}"
-        episode_shadow_offset = 3
-        # Soya
-        for dx, dy in [
-            (-episode_shadow_offset, -episode_shadow_offset), (0, -episode_shadow_offset), (episode_shadow_offset, -episode_shadow_offset),
-            (-episode_shadow_offset, 0), (episode_shadow_offset, 0),
-            (-episode_shadow_offset, episode_shadow_offset), (0, episode_shadow_offset), (episode_shadow_offset, episode_shadow_offset)
-        ]:
-            draw.text((caption_x + dx, current_y + dy), episode_text, fill=(0,0,0,200), font=episode_font)
-        # Asosiy matn
-        draw.text((caption_x, current_y), episode_text, fill=(255,255,255), font=episode_font)
-        current_y += 45 + 20 # Desc ga spacing - kichikroq
-        logging.info(f"✅ Episode yozildi: {episode_text}")
-    except Exception as e:
-        logging.warning(f"⚠️ Episode xatosi: {e}")
-        current_y += 65
-    # 10. TAVSIF - KATTA, AJRALIB TURADI
+        file = await bot.get_file(file_id)
+        image_source = await _download_poster(file)
+    except Exception as file_error:
+        logging.error(f"❌ File yuklashda xatolik: {file_error}")
+        file, image_source = None, None
+    # Fallback (poster yo'q) kartalar keshlanmaydi
+    keys = {
+        ep: RenderCache.make_key(file.file_unique_id, title, desc, genre, ep, layout=layout) if image_source else None
+        for ep in episode_nums
+    }
+    results = {}
+    for ep, key in keys.items():
+        data = render_cache.lookup(key) if key else None
+        if data is not None:
+            results[ep] = data
+    missing = [ep for ep in episode_nums if ep not in results]
+    if missing:
+        chunk_count = min(render_pool.workers, len(missing))
+        chunks = [missing[i::chunk_count] for i in range(chunk_count)]
+
+        def render_chunks(source):
+            # Poster berilgan bo'lsa u ochilishi shart: aks holda fallback karta poster kaliti ostida saqlanardi
+            return asyncio.gather(*[
+                render_pool.run(render_post_batch, source, title, desc, genre, chunk, RENDER_FORMAT, layout,
+                                RENDER_PROFILE, source is not None,
+                                cost=estimate_render_bytes(RENDER_PROFILE, batch=True))
+                for chunk in chunks
+            ])
+
+        try:
+            rendered = await render_chunks(image_source)
+        except PosterDecodeError:
+            logging.warning("⚠️ Poster ochilmadi, mavsum kartalari fallback fon bilan (keshlanmaydi)")
+            keys.update(dict.fromkeys(missing))
+            rendered = await render_chunks(None)
+        for chunk, datas in zip(chunks, rendered):
+            for ep, data in zip(chunk, datas):
+                results[ep] = data
+                if keys[ep]:
+                    render_cache.store.put(keys[ep], data)
+    logging.info(f"📦 Mavsum kartalari: {len(episode_nums)} ta, keshdan {len(episode_nums) - len(missing)} ta")
+    return [(results[ep], keys[ep] if keys[ep] and keys[ep] in render_cache.store else None) for ep in episode_nums]
+
+async def generate_html_post_image_pillow(
+    title: str, desc: str, genre: str, file_id: str, anime_code: str, episode_num: int
+) -> str:
+    """
+    Qirqilgan va siljitilgan rasm generator
+    O'ng tomondan 25% qirqiladi va chap tomonga siljitiladi.
+    Poster bu yerda yuklanadi, chizish esa render_pool ishchisida bajariladi.
+    Natija media_store ga yoziladi; qaytadi - kalit (/static/ dagi fayl nomi).
+    """
+    logging.info(f"🎨 Rasm yaratish boshlandi: {title}")
+    logging.info(f"📁 File ID: {file_id[:20]}...")
+    data, _ = await render_post_card(title, desc, genre, file_id, episode_num)
+    # Saqlash - XAVFSIZ
+    if not 0 < len(data) < 10 * 1024 * 1024: # 10MB dan kichik
+        raise ValueError(f"Rasm hajmi noto'g'ri: {len(data)}")
+    key = media_store.put(data)
+    logging.info(f"💾 Rasm saqlandi: {key} ({len(data)} bytes)")
+    return key
+
+# ==================== HTML POST RENDER ISHLARI ====================
+# POST /api/html_post_image ish yaratadi va darhol qaytadi, render fonda bajariladi.
+# job_id - parametrlar va poster xeshi: bir xil so'rovlar bitta ishga (va bitta renderga) tushadi.
+render_job_tasks = {}  # job_id -> asyncio.Task (shu jarayonda bajarilayotgan ishlar)
+render_job_stats = {"created": 0, "coalesced": 0, "reused": 0, "done": 0, "failed": 0, "rejected": 0}
+metrics_providers["render_jobs"] = lambda: {**render_job_stats, "active": len(render_job_tasks)}
+
+def get_render_job(job_id: str):
+    conn = sqlite3.connect('anime_bot.db')
     try:
-        desc_lines = wrap_text(desc, desc_font, max_text_width, draw)
-        line_height_desc = 30 # Kichikroq
-        for line in desc_lines:
-            # Engil soya
-            draw.text((caption_x + 1, current_y + 1), line, fill=(0,0,0,100), font=desc_font)
-            # Asosiy matn - Ozgina kulrang qilib ajratish
-            draw.text((caption_x, current_y), line, fill=(220, 220, 220), font=desc_font)
-            current_y += line_height_desc
-        current_y += 30 # Btn ga spacing - kichikroq
-        logging.info(f"✅ Tavsif yozildi: {len(desc_lines)} qator")
-    except Exception as e:
-        logging.warning(f"⚠️ Tavsif xatosi: {e}")
-        current_y += 150
-    # 11. KATTA TUGMA - MARKAZDA
+        row = conn.execute(
+            "SELECT job_id, status, result_key, error FROM render_jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    return {"job_id": row[0], "status": row[1], "result_key": row[2], "error": row[3]}
+
+def _set_render_job(job_id: str, status: str, result_key: str = None, error: str = None):
+    conn = sqlite3.connect('anime_bot.db')
     try:
-        btn_text = "TOMOSHA QILISH"
-        bbox = draw.textbbox((0, 0), btn_text, font=btn_font)
-        text_w = bbox[2] - bbox[0]
-        text_h = bbox[3] - bbox[1]
-        padding_x = 20
-        padding_y = 15
-        btn_w = text_w + 2 * padding_x
-        btn_h = text_h + 2 * padding_y
-        btn_x = caption_x # Markazga
-        btn_y = current_y
-        # GRADIENT TUGMA
-        start_color = (30, 144, 255) # Ko'k
-        end_color = (220, 20, 60) # Qizil
-        # Gradient yaratish
-        gradient_btn = Image.new('RGB', (btn_w, btn_h))
-        btn_draw = ImageDraw.Draw(gradient_btn)
-        for x in range(btn_w):
-            ratio = x / (btn_w - 1) if btn_w > 1 else 0
-            r = int(start_color[0] + (end_color[0] - start_color[0]) * ratio)
-            g = int(start_color[1] + (end_color[1] - start_color[1]) * ratio)
-            b = int(start_color[2] + (end_color[2] - start_color[2]) * ratio)
-            for y in range(btn_h):
-                btn_draw.point((x, y), fill=(r, g, b))
-        # Yumaloq burchaklar maskasi
-        btn_mask = Image.new('L', (btn_w, btn_h), 0)
-        mask_draw = ImageDraw.Draw(btn_mask)
-        try:
-            mask_draw.rounded_rectangle([0, 0, btn_w, btn_h], radius=30, fill=255)
-        except:
-            mask_draw.rectangle([0, 0, btn_w, btn_h], fill=255)
-        # Gradientni RGBA ga o'tkazish
-        gradient_rgba = Image.new('RGBA', (btn_w, btn_h), (0, 0, 0, 0))
-        gradient_rgba.paste(gradient_btn, (0, 0), btn_mask)
-        # Tugmani joylashtirish
-        final_image.paste(gradient_rgba, (btn_x, btn_y), btn_mask)
-        # Qalin ramka
-        try:
-            draw.rounded_rectangle(
-                [btn_x, btn_y, btn_x + btn_w, btn_y + btn_h],
-                radius=30,
-                outline=(255, 255, 255),
-                width=3
-            )
-        except:
-            draw.rectangle(
-                [btn_x, btn_y, btn_x + btn_w, btn_y + btn_h],
-                outline=(255, 255, 255),
-                width=3
-            )
-        # Matn - Markazda
-        text_x = btn_x + (btn_w - text_w) // 2
-        text_y = btn_y + (btn_h - text_h) // 2 - 5
-        draw.text((text_x, text_y), btn_text, fill=(255, 255, 255), font=btn_font)
-        current_y += btn_h + 20
-        logging.info(f"✅ Tugma qo'shildi: {btn_w}x{btn_h}px at ({btn_x}, {btn_y})")
-    except Exception as e:
-        logging.warning(f"⚠️ Tugma xatosi: {e}")
-        current_y += 80
-    # 12. JANR MENYUSI - ANIQ VA KATTA
+        conn.execute("""
+            UPDATE render_jobs SET status = ?, result_key = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ?
+        """, (status, result_key, error, job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def recover_render_jobs():
+    """Jarayon qayta ishga tushganda tugallanmay qolgan ishlar - qayta POST qilinishi kerak"""
+    conn = sqlite3.connect('anime_bot.db')
     try:
-        menu_y = 60
-        menu_x_start = 100
-        genres = [g.strip().upper() for g in genre.split(',')] if genre else ["ACTION", "DRAMA", "FANTASY"]
-        items = genres[:3] if len(genres) >= 3 else (genres + ["YO'Q"] * 3)[:3]
-        menu_x = menu_x_start
-        for i, item in enumerate(items):
-            bbox = draw.textbbox((0, 0), item, font=menu_font)
-            w = bbox[2] - bbox[0]
-            h = bbox[3] - bbox[1]
-            # Rangli effekt
-            if i == 0:
-                fill_color = (255, 215, 0) # Oltin
-                stroke_color = (139, 69, 19) # Jigarrang
-                stroke_width = 2
-            elif i == 1:
-                fill_color = (255, 255, 255) # Oq
-                stroke_color = (0, 0, 0)
-                stroke_width = 1
-            else:
-                fill_color = (200, 200, 200) # Kulrang
-                stroke_color = None
-                stroke_width = 0
-            # Soya
-            draw.text((menu_x + 2, menu_y + 2), item, fill=(0,0,0,150), font=menu_font)
-            # Asosiy matn
-            draw.text((menu_x, menu_y), item, fill=fill_color, font=menu_font,
-                     stroke_width=stroke_width, stroke_fill=stroke_color)
-            menu_x += w + 100
-        logging.info(f"✅ Janrlar qo'shildi: {items}")
-    except Exception as e:
-        logging.warning(f"⚠️ Janrlar xatosi: {e}")
-        # Fallback janrlar
-        draw.text((100, 60), "ACTION", fill=(255,255,255), font=menu_font)
-        draw.text((300, 60), "DRAMA", fill=(255,255,255), font=menu_font)
-        draw.text((500, 60), "FANTASY", fill=(255,255,255), font=menu_font)
-    # 13. SAQLASH - XAVFSIZ
+        cursor = conn.execute("""
+            UPDATE render_jobs SET status = 'failed', error = 'Ish to''xtatildi, qayta yuboring',
+                updated_at = CURRENT_TIMESTAMP
+            WHERE status IN ('queued', 'running')
+        """)
+        conn.commit()
+        if cursor.rowcount:
+            logging.info(f"♻️ Tugallanmagan render ishlari: {cursor.rowcount} ta")
+    finally:
+        conn.close()
+
+async def _run_render_job(job_id: str, title: str, desc: str, genre: str, file_id: str,
+                          anime_code: str, episode_num: int):
+    _set_render_job(job_id, 'running')
     try:
-        temp_file = tempfile.NamedTemporaryFile(mode='wb', suffix='.png', delete=False)
-        temp_file_path = temp_file.name
-        temp_file.close()
-        # RGBA ni RGB ga o'tkazish
-        final_image_rgb = final_image.convert("RGB")
-        # Saqlash
-        final_image_rgb.save(temp_file_path, format="PNG", quality=95, optimize=True)
-        # Fayl mavjudligini tekshirish
-        if os.path.exists(temp_file_path):
-            file_size = os.path.getsize(temp_file_path)
-            if file_size > 0 and file_size < 10 * 1024 * 1024: # 10MB dan kichik
-                logging.info(f"💾 Rasm saqlandi: {temp_file_path} ({file_size} bytes)")
-                return temp_file_path
-            else:
-                os.unlink(temp_file_path)
-                raise ValueError(f"Fayl hajmi noto'g'ri: {file_size}")
-        else:
-            raise FileNotFoundError(f"Fayl yaratilmadi: {temp_file_path}")
+        key = await generate_html_post_image_pillow(
+            title=title,
+            desc=desc,
+            genre=genre,
+            file_id=file_id,
+            anime_code=anime_code,
+            episode_num=episode_num
+        )
+    except RenderQueueFullError as e:
+        logging.warning(f"⏳ HTML rasm rad etildi: {e}")
+        render_job_stats["rejected"] += 1
+        _set_render_job(job_id, 'rejected', error=str(e))
     except Exception as e:
-        logging.error(f"❌ Saqlashda xatolik: {e}")
-        raise Exception(f"Rasm saqlashda jiddiy xatolik: {e}")
+        logging.error(f"HTML rasm generatsiyasi xatosi: {e}")
+        render_job_stats["failed"] += 1
+        _set_render_job(job_id, 'failed', error=str(e))
+    else:
+        render_job_stats["done"] += 1
+        _set_render_job(job_id, 'done', result_key=key)
+
+def submit_render_job(anime_code: str, episode_num: int, desc: str) -> dict:
+    """
+    Render ishini yaratadi yoki mavjudini qaytaradi (single-flight).
+    Anime topilmasa yoki rasmi bo'lmasa LookupError.
+    """
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        anime = conn.execute("SELECT title, genre, image FROM anime WHERE code = ?", (anime_code,)).fetchone()
+    finally:
+        conn.close()
+    if not anime:
+        raise LookupError("Anime topilmadi")
+    title, genre, image_file_id = anime
+    if not image_file_id:
+        raise LookupError("Rasm topilmadi")
+
+    raw = json.dumps([anime_code, episode_num, desc, title, genre, image_file_id,
+                      TEMPLATE_VERSION, RENDER_FORMAT, RENDER_PROFILE], ensure_ascii=False)
+    job_id = hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+    if job_id in render_job_tasks:
+        render_job_stats["coalesced"] += 1
+        return get_render_job(job_id)
+    job = get_render_job(job_id)
+    if job and job["status"] == 'done' and job["result_key"] in media_store:
+        render_job_stats["reused"] += 1
+        return job
+
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        conn.execute("""
+            INSERT INTO render_jobs (job_id, anime_code, episode_num, status) VALUES (?, ?, ?, 'queued')
+            ON CONFLICT(job_id) DO UPDATE SET status = 'queued', result_key = NULL, error = NULL,
+                updated_at = CURRENT_TIMESTAMP
+        """, (job_id, anime_code, episode_num))
+        conn.commit()
+    finally:
+        conn.close()
+    render_job_stats["created"] += 1
+    task = asyncio.create_task(_run_render_job(job_id, title, desc, genre, image_file_id, anime_code, episode_num))
+    render_job_tasks[job_id] = task
+    task.add_done_callback(lambda _: render_job_tasks.pop(job_id, None))
+    return get_render_job(job_id)
+
 # ==================== SERIAL POST FIXES ====================
 
 @dp.callback_query(SerialPost.post_type, lambda c: c.data == "post_type_simple")
@@ -4495,10 +5666,93 @@ async def handle_no_media_for_simple_post(message: types.Message, state: FSMCont
     await state.update_data(media_file_id=None, media_type=None)
     await show_template_selection(message, state)
 
-# Oddiy post uchun kanal tanlashda yuborish logikasini tuzatish
+def format_serial_caption(template_content: str, font_style: str, title: str, episode_number: int) -> str:
+    """Shablonni to'ldirish"""
+    raw_caption = template_content.format(title=title, episode_number=episode_number)
+    if font_style == "bold":
+        return f"<b>{raw_caption}</b>"
+    elif font_style == "italic":
+        return f"<i>{raw_caption}</i>"
+    elif font_style == "bold_italic":
+        return f"<b><i>{raw_caption}</i></b>"
+    return raw_caption
+
+def serial_watch_keyboard(bot_username: str, anime_code: str, episode_number: int) -> InlineKeyboardMarkup:
+    # Episode uchun to'g'ri URL - episode_ formatida
+    watch_url = f"https://t.me/{bot_username}?start=episode_{anime_code}_{episode_number}"
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✨Tomosha Qilish✨", url=watch_url)]
+    ])
+
 @dp.callback_query(SerialPost.waiting_channel, lambda c: c.data.startswith("select_channel_"))
 async def select_serial_channel(call: types.CallbackQuery, state: FSMContext):
     channel_id = call.data.replace("select_channel_", "")
+    data = await state.get_data()
+    if data.get('post_type') == "html" and data.get('media_file_id') and data.get('anime_code'):
+        # HTML post: avval arzon qoralama, to'liq render faqat admin tasdiqlagandan keyin
+        await send_serial_preview(call, state, channel_id)
+        return
+    await publish_serial_post(call, state, channel_id)
+
+async def send_serial_preview(call: types.CallbackQuery, state: FSMContext, channel_id: str):
+    """Qoralama rasmni (PREVIEW_PROFILE) adminga yuboradi va tasdiqni kutadi"""
+    data = await state.get_data()
+    conn = sqlite3.connect('anime_bot.db')
+    try:
+        anime = conn.execute("SELECT title, genre FROM anime WHERE code = ?", (data['anime_code'],)).fetchone()
+    finally:
+        conn.close()
+    if not anime:
+        await call.answer("❌ Anime topilmadi!", show_alert=True)
+        return
+    title, genre = anime
+    episode_range = data.get('episode_range')
+    episode_number = episode_range[0] if episode_range else data.get('episode_number')
+
+    started = time.perf_counter()
+    try:
+        preview = await render_preview_card(
+            title=title,
+            desc=data.get('description', 'Tavsif yo\'q'),
+            genre=genre,
+            file_id=data['media_file_id'],
+            episode_num=episode_number,
+            layout=get_channel_layout(channel_id)
+        )
+    except Exception as e:
+        logging.error(f"Qoralama rasm yaratishda xatolik: {e}")
+        await call.answer(f"❌ Rasm yaratishda xatolik: {str(e)}", show_alert=True)
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logging.info(f"👁 Qoralama rasm: {title} - {elapsed_ms:.0f} ms, {len(preview)} bytes")
+
+    episodes_text = (f"{episode_range[0]}-{episode_range[-1]} ({len(episode_range)} ta)"
+                     if episode_range else str(episode_number))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Tasdiqlash", callback_data="serial_preview_ok"),
+        InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_serial_post"),
+    ]])
+    await call.message.answer_photo(
+        BufferedInputFile(preview, filename=f"preview.{RENDER_EXT}"),
+        caption=(f"👁 <b>Oldindan ko'rish</b> (qoralama, {elapsed_ms:.0f} ms)\n"
+                 f"🎬 {html.escape(title)} - qism: {episodes_text}\n\n"
+                 f"To'liq o'lchamda tayyorlab kanalga yuborilsinmi?"),
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+    await state.update_data(preview_channel_id=channel_id)
+    await state.set_state(SerialPost.waiting_preview_confirm)
+    await call.answer()
+
+@dp.callback_query(SerialPost.waiting_preview_confirm, lambda c: c.data == "serial_preview_ok")
+async def confirm_serial_preview(call: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    # Tugmalar olib tashlanadi - ikkinchi bosish post ni takrorlamasin
+    await call.message.edit_reply_markup(reply_markup=None)
+    await publish_serial_post(call, state, data.get('preview_channel_id'))
+
+# Oddiy post uchun kanal tanlashda yuborish logikasini tuzatish
+async def publish_serial_post(call: types.CallbackQuery, state: FSMContext, channel_id: str):
     data = await state.get_data()
     anime_code = data.get('anime_code')
     episode_number = data.get('episode_number')
@@ -4535,25 +5789,13 @@ async def select_serial_channel(call: types.CallbackQuery, state: FSMContext):
             template_content = "<blockquote>\n<b>- {title}</b>  \n<b>- QISM - {episode_number}</b>\n</blockquote>"
             font_style = 'default'
 
-        # Shablonni to'ldirish
-        raw_caption = template_content.format(title=title, episode_number=episode_number)
-        if font_style == "bold":
-            post_caption = f"<b>{raw_caption}</b>"
-        elif font_style == "italic":
-            post_caption = f"<i>{raw_caption}</i>"
-        elif font_style == "bold_italic":
-            post_caption = f"<b><i>{raw_caption}</i></b>"
-        else:
-            post_caption = raw_caption
+        post_caption = format_serial_caption(template_content, font_style, title, episode_number)
 
         # ✅ MUHIM: Tugma URL ni TO'G'RI YARATISH
         bot_username = (await bot.get_me()).username
-        # Episode uchun to'g'ri URL - episode_ formatida
-        watch_url = f"https://t.me/{bot_username}?start=episode_{anime_code}_{episode_number}"
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✨Tomosha Qilish✨", url=watch_url)]
-        ])
+        keyboard = serial_watch_keyboard(bot_username, anime_code, episode_number)
+        # Callback ID barqaror — update qayta kelsa, post ikki marta chiqmaydi
+        outbox_key = f"serial:{anime_code}:{episode_number}:{channel_id}:{call.id}"
 
         # MEDIA: Admin yuborgan media yoki anime media
         media_file_id = data.get('media_file_id')
@@ -4566,26 +5808,50 @@ async def select_serial_channel(call: types.CallbackQuery, state: FSMContext):
                 return
                 
             try:
-                # HTML post logikasi...
-                image_path = await generate_html_post_image_pillow(
+                episode_range = data.get('episode_range')
+                if episode_range:
+                    # Mavsum rejimi: umumiy qatlamlar bir marta, qismlar ishchilar bo'yicha parallel
+                    await call.message.edit_caption(caption=f"⏳ {len(episode_range)} ta qism kartasi tayyorlanmoqda...")
+                    cards = await render_post_batch_cards(
+                        title=title,
+                        desc=desc,
+                        genre=genre,
+                        file_id=media_file_id,
+                        episode_nums=episode_range,
+                        layout=get_channel_layout(channel_id)
+                    )
+                    for ep, (image_bytes, media_key) in zip(episode_range, cards):
+                        enqueue_outbox(
+                            'send_photo', channel_id, f"serial:{anime_code}:{ep}:{channel_id}:{call.id}",
+                            media_blob=image_bytes,
+                            media_key=media_key,
+                            filename=f"post.{RENDER_EXT}",
+                            caption=format_serial_caption(template_content, font_style, title, ep),
+                            reply_markup=serial_watch_keyboard(bot_username, anime_code, ep),
+                            parse_mode="HTML"
+                        )
+                    await call.answer(f"✅ {len(episode_range)} ta post navbatga qo'yildi va tartib bilan kanalga chiqadi!",
+                                      show_alert=True)
+                    return
+
+                # Rasm xotirada kodlanadi va baytlari to'g'ridan-to'g'ri outbox ga beriladi
+                image_bytes, media_key = await render_post_card(
                     title=title,
                     desc=desc,
                     genre=genre,
                     file_id=media_file_id,
-                    bot_username=bot_username,
-                    anime_code=anime_code,
-                    episode_num=episode_number
+                    episode_num=episode_number,
+                    layout=get_channel_layout(channel_id)
+                )
+                enqueue_outbox(
+                    'send_photo', channel_id, outbox_key,
+                    media_blob=image_bytes,
+                    media_key=media_key,
+                    filename=f"post.{RENDER_EXT}",
+                    caption=post_caption,
+                    reply_markup=keyboard,
+                    parse_mode="HTML"
                 )
-                
-                with open(image_path, 'rb') as photo:
-                    await bot.send_photo(
-                        chat_id=channel_id,
-                        photo=BufferedInputFile(photo.read(), filename="post.png"),
-                        caption=post_caption,
-                        reply_markup=keyboard,
-                        parse_mode="HTML"
-                    )
-                os.unlink(image_path)
                 
             except Exception as e:
                 logging.error(f"HTML rasm yaratishda xatolik: {e}")
@@ -4606,18 +5872,18 @@ async def select_serial_channel(call: types.CallbackQuery, state: FSMContext):
                     final_media_file_id = anime_image
                     final_media_type = 'photo'
             
-            # Postni yuborish
+            # Postni navbatga qo'yish
             if final_media_type == 'photo' and final_media_file_id:
-                await bot.send_photo(
-                    chat_id=channel_id, 
+                enqueue_outbox(
+                    'send_photo', channel_id, outbox_key,
                     photo=final_media_file_id, 
                     caption=post_caption, 
                     reply_markup=keyboard, 
                     parse_mode="HTML"
                 )
             elif final_media_type == 'video' and final_media_file_id:
-                await bot.send_video(
-                    chat_id=channel_id, 
+                enqueue_outbox(
+                    'send_video', channel_id, outbox_key,
                     video=final_media_file_id, 
                     caption=post_caption, 
                     reply_markup=keyboard, 
@@ -4625,14 +5891,14 @@ async def select_serial_channel(call: types.CallbackQuery, state: FSMContext):
                 )
             else:
                 # Hech qanday media yo'q bo'lsa, faqat tekst
-                await bot.send_message(
-                    chat_id=channel_id, 
+                enqueue_outbox(
+                    'send_message', channel_id, outbox_key,
                     text=post_caption, 
                     reply_markup=keyboard, 
                     parse_mode="HTML"
                 )
 
-        await call.answer("✅ Post muvaffaqiyatli yuborildi!", show_alert=True)
+        await call.answer("✅ Post navbatga qo'yildi va tez orada kanalga chiqadi!", show_alert=True)
         
     except Exception as e:
         logging.error(f"select_serial_channel xatosi: {e}")
@@ -4641,7 +5907,8 @@ async def select_serial_channel(call: types.CallbackQuery, state: FSMContext):
         await state.clear()
         conn.close()
 
-@dp.callback_query(SerialPost.waiting_channel, lambda c: c.data == "cancel_serial_post")
+@dp.callback_query(StateFilter(SerialPost.waiting_channel, SerialPost.waiting_preview_confirm),
+                   lambda c: c.data == "cancel_serial_post")
 async def cancel_serial_post(call: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await call.answer("❌ Post qilish bekor qilindi", show_alert=True)
@@ -4767,19 +6034,16 @@ async def send_to_subs_process(message: types.Message):
     try:
         cursor.execute("SELECT user_id FROM subscribers WHERE notifications = TRUE")
         subscribers = cursor.fetchall()
-        success = 0
-        failed = 0
-        for (user_id,) in subscribers:
-            try:
-                await bot.send_message(user_id, message.text)
-                success += 1
-            except Exception as e:
-                failed += 1
-                logging.error(f"Xabar yuborishda xatolik (user_id={user_id}): {e}")
+        # Admin xabari ID si idempotency kaliti — update qayta kelsa ham dublikat bo'lmaydi
+        queued = enqueue_outbox_many([
+            ('send_message', user_id, f"broadcast:{message.chat.id}:{message.message_id}:{user_id}",
+             {'text': message.text})
+            for (user_id,) in subscribers
+        ])
         await message.answer(
-            f"📢 Xabar yuborish natijasi:\n"
-            f"✅ Muvaffaqiyatli: {success}\n"
-            f"❌ Xatoliklar: {failed}"
+            f"📢 Xabar yuborish navbatga qo'yildi:\n"
+            f"📮 Navbatda: {queued}\n"
+            f"👥 Obunachilar: {len(subscribers)}"
         )
         del user_state[message.from_user.id]
     except Exception as e:
@@ -4836,18 +6100,35 @@ async def main():
         logging.error(f"❌ Database initialization failed: {e}")
         return
 
+    # Render ishchilari - fork hali oqimlar kam paytda bo'lishi uchun eng boshida
+    render_pool.start()
+    logging.info(f"🎨 Render pool: {RENDER_WORKERS} ishchi, navbat {RENDER_QUEUE_SIZE}, "
+                 f"renderlar uchun {render_pool.memory_budget // (1024 * 1024)} MB")
+
+    # Outbox dispetcheri va media ombori tozalovchisi (fon vazifalari)
+    outbox_task = asyncio.create_task(outbox_dispatcher())
+    janitor_task = asyncio.create_task(media_store_janitor())
+
+    # Render job API, statik fayllar va monitoring uchun veb server
+    try:
+        await start_web_server()
+    except OSError as e:
+        logging.error(f"❌ Veb serverni {WEB_HOST}:{PORT} da ishga tushirib bo'lmadi: {e}")
+
     try:
         logging.info("🚀 Bot starting...")
         await dp.start_polling(bot)
     except Exception as e:
         logging.error(f"❌ Bot failed to start: {e}")
     finally:
+        outbox_task.cancel()
+        janitor_task.cancel()
+        render_pool.shutdown()
         await bot.session.close()
 
 if __name__ == "__main__":
-    # Railway uchun port sozlamasi
-    port = int(os.environ.get("PORT", 8080))
-    logging.info(f"🌐 Server port: {port}")
+    # Railway uchun port sozlamasi (PORT muhit o'zgaruvchisi)
+    logging.info(f"🌐 Server port: {PORT}")
     
     # Asosiy funksiyani ishga tushirish
     asyncio.run(main())
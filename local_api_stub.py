@@ -0,0 +1,121 @@
+"""
+Lokal telegram-bot-api serverining soddalashtirilgan o'rinbosari (test va ishlab chiqish uchun).
+
+Haqiqiy serverga o'xshab getFile javobida fayl tizimidagi absolyut yo'lni qaytaradi,
+shuning uchun botni `--local` rejimida Telegramga ulanmasdan sinab ko'rish mumkin.
+
+Ishga tushirish:
+    python local_api_stub.py --files ./stub_files --port 8081
+    BOT_API_URL=http://localhost:8081 python bot.py --local
+
+file_id sifatida --files papkasidagi fayl nomi ishlatiladi (masalan, "poster.jpg").
+Yuborilgan xabarlar xotirada saqlanadi va GET /sent orqali ko'rish mumkin.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+from aiohttp import web
+
+STUB_BOT_ID = 1000000001
+
+
+def _ok(result):
+    return web.json_response({"ok": True, "result": result})
+
+
+def _error(code: int, description: str):
+    return web.json_response({"ok": False, "error_code": code, "description": description}, status=code)
+
+
+def _fake_message(chat_id, extra: dict) -> dict:
+    message = {
+        "message_id": int(time.time() * 1000) % 2_000_000_000,
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, "type": "channel"},
+    }
+    message.update(extra)
+    return message
+
+
+async def _read_params(request) -> dict:
+    params = dict(request.query)
+    if request.can_read_body:
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        else:
+            form = await request.post()
+            for key, value in form.items():
+                params[key] = value if isinstance(value, str) else value.file.read()
+    return params
+
+
+async def handle_method(request):
+    files_dir = request.app["files_dir"]
+    method = request.match_info["method"]
+    params = await _read_params(request)
+    request.app["calls"].append({"method": method, "params": {
+        k: (v if isinstance(v, str) else f"<{len(v)} bytes>") for k, v in params.items()
+    }})
+
+    if method == "getMe":
+        return _ok({"id": STUB_BOT_ID, "is_bot": True, "first_name": "Stub", "username": "stub_bot"})
+    if method in ("deleteWebhook", "setMyCommands", "answerCallbackQuery", "deleteMessage"):
+        return _ok(True)
+    if method == "getUpdates":
+        await asyncio.sleep(min(float(params.get("timeout", 0) or 0), 1.0))
+        return _ok([])
+    if method == "getFile":
+        name = os.path.basename(params.get("file_id", ""))
+        path = os.path.abspath(os.path.join(files_dir, name))
+        if not name or not os.path.isfile(path):
+            return _error(400, "Bad Request: invalid file_id")
+        return _ok({
+            "file_id": name,
+            "file_unique_id": hashlib.md5(name.encode()).hexdigest()[:16],
+            "file_size": os.path.getsize(path),
+            "file_path": path,
+        })
+    if method == "getChatMember":
+        user_id = int(params.get("user_id", 0))
+        return _ok({"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "User"}})
+    if method == "getChat":
+        return _ok({"id": int(params.get("chat_id", 0)), "type": "channel", "title": "Stub kanal"})
+    if method == "sendMessage":
+        return _ok(_fake_message(params.get("chat_id"), {"text": params.get("text", "")}))
+    if method == "sendPhoto":
+        photo = params.get("photo")
+        file_id = photo if isinstance(photo, str) else f"stub_photo_{hashlib.md5(photo).hexdigest()}"
+        return _ok(_fake_message(params.get("chat_id"), {"photo": [{
+            "file_id": file_id, "file_unique_id": file_id[-16:], "width": 1280, "height": 720,
+        }]}))
+    if method in ("sendVideo", "sendDocument"):
+        return _ok(_fake_message(params.get("chat_id"), {"caption": params.get("caption", "")}))
+    return _error(404, f"Not Found: method {method} is not emulated")
+
+
+async def handle_sent(request):
+    return web.json_response(request.app["calls"])
+
+
+def create_app(files_dir: str) -> web.Application:
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["files_dir"] = files_dir
+    app["calls"] = []
+    app.router.add_route("*", "/bot{token}/{method}", handle_method)
+    app.router.add_get("/sent", handle_sent)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lokal Bot API o'rinbosari")
+    parser.add_argument("--files", default="./stub_files", help="file_id lar uchun fayllar papkasi")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    os.makedirs(args.files, exist_ok=True)
+    print(json.dumps({"files": os.path.abspath(args.files), "port": args.port}))
+    web.run_app(create_app(args.files), host=args.host, port=args.port)
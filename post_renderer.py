@@ -0,0 +1,1026 @@
+"""
+HTML post rasmi uchun sof renderlash (Pillow + NumPy).
+
+Bu modul aiogram, baza yoki tarmoqqa bog'liq emas: bot.py uni ProcessPoolExecutor
+ishchilarida chaqiradi, shuning uchun ishchi jarayon bot.py ni qayta import qilmaydi.
+Kirish - rasm baytlari (yoki lokal fayl yo'li), chiqish - kodlangan rasm baytlari.
+"""
+import colorsys
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageFont
+
+class PosterDecodeError(ValueError):
+    """require_poster=True bo'lganda poster ochilmadi - natija fallback fon bilan chiqar edi"""
+
+@lru_cache(maxsize=8192)
+def word_width(font, word: str) -> float:
+    """So'z kengligi (advance) - (font, so'z) bo'yicha bir marta o'lchanadi"""
+    return font.getlength(word)
+
+class TextLayout:
+    """Qatorlarga ajratilgan matn: o'lchash va chizish bosqichlari bir xil natijani ishlatadi"""
+    __slots__ = ("lines", "widths", "line_height", "truncated")
+
+    def __init__(self, lines: list, widths: list, line_height: int, truncated: bool):
+        self.lines = lines
+        self.widths = widths
+        self.line_height = line_height
+        self.truncated = truncated
+
+    @property
+    def height(self) -> int:
+        return len(self.lines) * self.line_height
+
+    @property
+    def width(self) -> float:
+        return max(self.widths, default=0)
+
+def layout_text(text: str, font, max_width: float, line_height: int,
+                max_lines: int = None, ellipsis: str = "...") -> TextLayout:
+    """
+    Greedy qatorlash: har bir so'z kengligi keshdan olinadi va qator kengligi yig'ib boriladi
+    (har bir prefiks uchun textbbox chaqirilmaydi). max_lines dan oshsa, oxirgi qator
+    ellipsis bilan qisqartiriladi. Kenglikdan uzun yakka so'z o'z qatorida qoladi.
+    """
+    space = word_width(font, " ")
+    lines, widths = [], []
+    current, current_width = [], 0.0
+    for word in text.split():
+        w = word_width(font, word)
+        candidate = current_width + space + w if current else w
+        if candidate <= max_width or not current:
+            current.append(word)
+            current_width = candidate
+        else:
+            lines.append(current)
+            widths.append(current_width)
+            current, current_width = [word], w
+    if current:
+        lines.append(current)
+        widths.append(current_width)
+
+    truncated = max_lines is not None and len(lines) > max_lines
+    if truncated:
+        lines, widths = lines[:max_lines], widths[:max_lines]
+        last = list(lines[-1])
+        tail = word_width(font, ellipsis)
+        width = widths[-1] + tail
+        while len(last) > 1 and width > max_width:
+            width -= word_width(font, last.pop()) + space
+        lines[-1], widths[-1] = last, width
+        lines = [" ".join(words) for words in lines[:-1]] + [" ".join(last) + ellipsis]
+    else:
+        lines = [" ".join(words) for words in lines]
+    return TextLayout(lines, widths, line_height, truncated)
+
+def ring_offsets(radius: int) -> tuple:
+    """Soya uchun 8 ta siljish: (±r, ±r), (0, ±r), (±r, 0)"""
+    return tuple((dx, dy) for dy in (-radius, 0, radius) for dx in (-radius, 0, radius) if dx or dy)
+
+def dilate_mask(mask: Image.Image, offsets) -> Image.Image:
+    """Maskaning siljitilgan nusxalari bo'yicha maksimum (glif qayta chizilmaydi)"""
+    src = np.asarray(mask)
+    out = np.zeros_like(src)
+    height, width = src.shape
+    for dx, dy in offsets:
+        dst_y = slice(max(dy, 0), height + min(dy, 0))
+        dst_x = slice(max(dx, 0), width + min(dx, 0))
+        src_y = slice(max(-dy, 0), height + min(-dy, 0))
+        src_x = slice(max(-dx, 0), width + min(-dx, 0))
+        np.maximum(out[dst_y, dst_x], src[src_y, src_x], out=out[dst_y, dst_x])
+    return Image.fromarray(out, "L")
+
+def draw_text_block(image: Image.Image, xy: tuple, lines: list, font, line_height: int,
+                    fill: tuple, shadow_offsets=(), shadow_fill: tuple = (0, 0, 0, 255)):
+    """
+    Matn bloki bir marta alfa maskaga chiziladi; soya shu maskadan dilate bilan olinadi,
+    keyin soya va matn rasmga rang + maska sifatida qo'yiladi.
+    """
+    pad = max((max(abs(dx), abs(dy)) for dx, dy in shadow_offsets), default=0)
+    ascent, descent = font.getmetrics()
+    width = int(max(font.getlength(line) for line in lines)) + 2 * pad + font.size // 4
+    height = (len(lines) - 1) * line_height + ascent + descent + 2 * pad
+    mask = Image.new("L", (width, height), 0)
+    mask_draw = ImageDraw.Draw(mask)
+    for i, line in enumerate(lines):
+        mask_draw.text((pad, pad + i * line_height), line, fill=255, font=font)
+    origin = (xy[0] - pad, xy[1] - pad)
+    if shadow_offsets:
+        image.paste(shadow_fill, origin, dilate_mask(mask, shadow_offsets))
+    image.paste(fill, origin, mask)
+
+# Layout o'zgarganda oshiriladi: eski keshlangan rasmlar avtomatik eskiradi
+TEMPLATE_VERSION = 3
+
+FONTS_DIR = os.getenv("RENDER_FONTS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts"))
+
+# Oila -> og'irlik -> nomzod fayllar (birinchi topilgani ishlatiladi).
+# Nisbiy nomlar avval FONTS_DIR da, keyin Pillow/FreeType qidiruv yo'llarida izlanadi.
+FONT_FAMILIES = {
+    "sans": {
+        "regular": [
+            "Poppins-Regular.ttf", "arial.ttf", "Arial.ttf", "DejaVuSans.ttf",
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+            "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+            "/System/Library/Fonts/Helvetica.ttf",
+            "C:/Windows/Fonts/arial.ttf",
+        ],
+        "bold": [
+            "Poppins-Bold.ttf", "arialbd.ttf", "Arial Bold.ttf", "DejaVuSans-Bold.ttf",
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+            "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+            "/System/Library/Fonts/Supplemental/Arial Bold.ttf",
+            "C:/Windows/Fonts/arialbd.ttf",
+        ],
+    },
+}
+
+# Har bir render ishlatadigan o'lchamlar (oldindan yuklanadi)
+PRELOAD_FONT_SIZES = {"bold": (20, 28, 36, 60), "regular": (24,)}
+
+class FontRegistry:
+    """
+    Font fayllarini bir marta aniqlaydi va FreeTypeFont obyektlarini
+    (oila, og'irlik, o'lcham) bo'yicha LRU keshda saqlaydi.
+    """
+    def __init__(self, families: dict, fonts_dir: str, cache_size: int = 64):
+        self.families = families
+        self.fonts_dir = fonts_dir
+        self._paths = {}
+        self._resolve_ms = 0.0
+        self._load_count = 0
+        self._load_ms = 0.0
+        self._get = lru_cache(maxsize=cache_size)(self._load)
+
+    def _probe(self, candidate: str):
+        """Nomzod faylni ochib ko'radi; muvaffaqiyatli bo'lsa ImageFont.truetype uchun manbani qaytaradi"""
+        local = os.path.join(self.fonts_dir, candidate)
+        for source in ([candidate] if os.path.isabs(candidate) else [local, candidate]):
+            if os.path.isabs(source) and not os.path.exists(source):
+                continue
+            try:
+                font = ImageFont.truetype(source, 12)
+            except OSError:
+                continue
+            # FreeType qidiruvi orqali topilgan bo'lsa, to'liq yo'lni eslab qolamiz
+            return getattr(font, "path", source) or source
+        return None
+
+    def resolve(self, family: str, weight: str):
+        """(oila, og'irlik) uchun font fayli yo'li; topilmasa None (Pillow standart fonti)"""
+        key = (family, weight)
+        if key not in self._paths:
+            start = time.perf_counter()
+            path = None
+            for candidate in self.families.get(family, {}).get(weight, []):
+                path = self._probe(candidate)
+                if path:
+                    break
+            self._resolve_ms += (time.perf_counter() - start) * 1000
+            self._paths[key] = path
+            if path:
+                logging.info(f"✅ Font aniqlandi: {family}/{weight} -> {path}")
+            else:
+                logging.warning(f"⚠️ {family}/{weight} uchun font topilmadi, standart font ishlatiladi")
+        return self._paths[key]
+
+    def _load(self, family: str, weight: str, size: int):
+        path = self.resolve(family, weight)
+        start = time.perf_counter()
+        font = ImageFont.truetype(path, size) if path else ImageFont.load_default(size)
+        self._load_count += 1
+        self._load_ms += (time.perf_counter() - start) * 1000
+        return font
+
+    def get(self, family: str, weight: str, size: int):
+        """Keshlangan font - chaqiruvchi uni o'zgartirmasligi kerak"""
+        return self._get(family, weight, size)
+
+    def preload(self, sizes: dict = PRELOAD_FONT_SIZES, family: str = "sans"):
+        """Fayllarni aniqlash va standart o'lchamlarni yuklash (ishchi ishga tushganda)"""
+        for weight, weight_sizes in sizes.items():
+            for size in weight_sizes:
+                self.get(family, weight, size)
+
+    def clear(self):
+        """Barcha keshlarni tozalash (benchmark sovuq o'lchovi uchun)"""
+        self._paths.clear()
+        self._get.cache_clear()
+        self._resolve_ms = self._load_ms = 0.0
+        self._load_count = 0
+
+    def stats(self) -> dict:
+        info = self._get.cache_info()
+        return {
+            "paths": {f"{family}/{weight}": path for (family, weight), path in self._paths.items()},
+            "resolve_ms": round(self._resolve_ms, 2),
+            "loads": self._load_count,
+            "load_ms": round(self._load_ms, 2),
+            "hits": info.hits,
+            "misses": info.misses,
+            "cached": info.currsize,
+        }
+
+font_registry = FontRegistry(FONT_FAMILIES, FONTS_DIR)
+
+def load_font(size, bold=False):
+    return font_registry.get("sans", "bold" if bold else "regular", size)
+
+def warm_up_worker():
+    """ProcessPoolExecutor initializer: fontlar birinchi renderdan oldin tayyor bo'ladi"""
+    font_registry.preload()
+
+# ==================== QATLAMLAR KESHI ====================
+LAYER_CACHE_MB = int(os.getenv("RENDER_LAYER_CACHE_MB", "32"))  # har bir ishchi jarayon uchun
+
+class LayerCache:
+    """
+    Renderlar orasida qayta ishlatiladigan oraliq qatlamlar (Image obyektlari): fon + gradient,
+    blur panel, maskalar, tugma va janr spritelari. Kalit - (qatlam, poster xeshi, geometriya).
+    Xotira piksel baytlari bo'yicha chegaralangan, eng kam ishlatilgani chiqariladi (LRU).
+    Qiymatlar umumiy - chaqiruvchi ularni o'zgartirmasligi kerak (kerak bo'lsa .copy()).
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(value) -> int:
+        if isinstance(value, Image.Image):
+            return value.width * value.height * len(value.getbands())
+        if isinstance(value, (tuple, list)):
+            return sum(LayerCache._size(item) for item in value)
+        return 0
+
+    def get(self, key):
+        entry = self._items.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        size = self._size(value)
+        if size > self.max_bytes:
+            return value
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self._items[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+        return value
+
+    def get_or_build(self, key, builder):
+        """key None bo'lsa keshlanmaydi (masalan, fallback fon ustidagi qatlamlar)"""
+        if key is None:
+            return builder()
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, builder())
+        return value
+
+    def clear(self):
+        self._items.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {"entries": len(self._items), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+layer_cache = LayerCache(LAYER_CACHE_MB * 1024 * 1024)
+
+def poster_fingerprint(image_source):
+    """Poster xeshi: baytlar uchun blake2b, fayl uchun yo'l + hajm + mtime (kesh fayllari o'zgarmaydi)"""
+    if image_source is None:
+        return None
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        return hashlib.blake2b(image_source, digest_size=16).hexdigest()
+    try:
+        st = os.stat(image_source)
+    except OSError:
+        return None  # fayl yo'q - prepare_background fallback ga o'tadi
+    return hashlib.blake2b(f"{image_source}:{st.st_size}:{st.st_mtime_ns}".encode(), digest_size=16).hexdigest()
+
+def make_diagonal_gradient(width: int, height: int, color: tuple, angle_deg: float = -225,
+                           alpha_start: int = 60, alpha_range: int = 80) -> Image.Image:
+    """
+    Diagonal gradient (color -> qora, alpha_start -> alpha_start + alpha_range) ni NumPy bilan hisoblaydi.
+    Avvalgi piksel-piksel sikl bilan bir xil formula, lekin butun massiv bir martada.
+    """
+    ratio = diagonal_ratio(width, height, angle_deg)
+    inverse = 1 - ratio
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[..., 0] = color[0] * inverse
+    pixels[..., 1] = color[1] * inverse
+    pixels[..., 2] = color[2] * inverse
+    pixels[..., 3] = alpha_start + alpha_range * ratio
+    return Image.fromarray(pixels, "RGBA")
+
+def horizontal_gradient(width: int, height: int, start_color: tuple, end_color: tuple) -> Image.Image:
+    """Gorizontal gradient: bitta qator hisoblanadi va balandlik bo'yicha takrorlanadi"""
+    ratio = np.arange(width, dtype=np.float64) / (width - 1) if width > 1 else np.zeros(width)
+    start = np.array(start_color, dtype=np.float64)
+    end = np.array(end_color, dtype=np.float64)
+    row = (start[None, :] + (end - start)[None, :] * ratio[:, None]).astype(np.uint8)
+    return Image.fromarray(np.ascontiguousarray(np.broadcast_to(row, (height, width, 3))), "RGB")
+
+def rounded_mask(width: int, height: int, radius: int) -> Image.Image:
+    """Yumaloq burchakli maska (layer_cache da o'lcham bo'yicha keshlanadi — o'zgartirmang!)"""
+    def build():
+        mask = Image.new('L', (width, height), 0)
+        ImageDraw.Draw(mask).rounded_rectangle([0, 0, width, height], radius=radius, fill=255)
+        return mask
+    return layer_cache.get_or_build(("mask", width, height, radius), build)
+
+def build_button_sprite(btn_text: str, font_size: int,
+                        start_color: tuple = (30, 144, 255), end_color: tuple = (220, 20, 60),
+                        radius: int = 30, padding_x: int = 20, padding_y: int = 15) -> Image.Image:
+    """
+    Tayyor tugma (gradient + ramka + matn) RGBA sprite sifatida.
+    Sprite ramka uchun 1px kattaroq; alpha kanali joylashtirish maskasi bo'ladi.
+    Natija layer_cache da saqlanadi — chaqiruvchi uni o'zgartirmasligi kerak.
+    """
+    key = ("button", btn_text, font_size, start_color, end_color, radius, padding_x, padding_y)
+    return layer_cache.get_or_build(key, lambda: _draw_button_sprite(
+        btn_text, font_size, start_color, end_color, radius, padding_x, padding_y))
+
+def _draw_button_sprite(btn_text, font_size, start_color, end_color, radius, padding_x, padding_y):
+    btn_font = load_font(font_size, bold=True)
+    measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    bbox = measure.textbbox((0, 0), btn_text, font=btn_font)
+    text_w = bbox[2] - bbox[0]
+    text_h = bbox[3] - bbox[1]
+    btn_w = text_w + 2 * padding_x
+    btn_h = text_h + 2 * padding_y
+    sprite = Image.new('RGBA', (btn_w + 1, btn_h + 1), (0, 0, 0, 0))
+    sprite.paste(horizontal_gradient(btn_w, btn_h, start_color, end_color), (0, 0), rounded_mask(btn_w, btn_h, radius))
+    draw = ImageDraw.Draw(sprite)
+    # Qalin ramka
+    draw.rounded_rectangle([0, 0, btn_w, btn_h], radius=radius, outline=(255, 255, 255), width=3)
+    # Matn - Markazda
+    draw.text(((btn_w - text_w) // 2, (btn_h - text_h) // 2 - 5), btn_text, fill=(255, 255, 255), font=btn_font)
+    return sprite
+
+PALETTE_SAMPLE_SIZE = (160, 90)
+
+def extract_palette(image: Image.Image, k: int = 6) -> list:
+    """
+    Posterning asosiy ranglari: [(rgb, ulush), ...] ulush bo'yicha kamayish tartibida.
+    Rasmdan 160x90 to'r bo'yicha piksel olinadi (NEAREST - filtrsiz, ~0.01 ms),
+    keyin FASTOCTREE quantize bilan k ta rangga keltiriladi. 1920x1080 uchun < 1 ms.
+    """
+    small = image.resize(PALETTE_SAMPLE_SIZE, Image.Resampling.NEAREST).convert("RGB")
+    quantized = small.quantize(colors=k, method=Image.Quantize.FASTOCTREE)
+    flat_palette = quantized.getpalette()
+    total = small.size[0] * small.size[1]
+    merged = []
+    # FASTOCTREE bitta rangni ba'zan 2 ta yaqin yozuvga bo'ladi - ularni birlashtiramiz
+    for count, index in sorted(quantized.getcolors(k) or [], reverse=True):
+        rgb = tuple(flat_palette[index * 3:index * 3 + 3])
+        for entry in merged:
+            if sum(abs(a - b) for a, b in zip(entry[0], rgb)) < 48:
+                entry[1] += count
+                break
+        else:
+            merged.append([rgb, count])
+    merged.sort(key=lambda entry: entry[1], reverse=True)
+    return [(rgb, count / total) for rgb, count in merged]
+
+def pick_theme_colors(palette: list) -> tuple:
+    """
+    Palitradan gradient (dominant) va tugma (aksent) rangini tanlaydi.
+    Juda qora/oq ranglar (teri, fon) emas, to'yingan va ko'p uchraydigan rang afzal.
+    Aksent yetarlicha to'yingan bo'lmasa None qaytadi (standart tugma ranglari).
+    """
+    if not palette:
+        return (246, 79, 89), None
+    scored = []
+    for rgb, share in palette:
+        h, sat, val = colorsys.rgb_to_hsv(*(c / 255 for c in rgb))
+        usable = 0.2 if val < 0.2 or val > 0.95 else 1.0
+        scored.append((share * (0.35 + sat) * usable, sat * val, rgb))
+    dominant = max(scored)[2]
+    accents = [(vividness, rgb) for _, vividness, rgb in scored if rgb != dominant]
+    accent = max(accents)[1] if accents else None
+    if accent is None or max(accents)[0] < 0.25:
+        accent = None
+    return dominant, accent
+
+
+# ==================== LAYOUT SHABLONLARI ====================
+# Post rasmining barcha geometriyasi shu yerda. Admin shablonlari (JSON) faqat
+# o'zgartiriladigan qismlarni beradi, qolgani standart qiymatlardan olinadi.
+DEFAULT_LAYOUT = {
+    "crop_shift": 0.25,  # o'ng tomondan qirqilib chapga ko'chiriladigan ulush
+    "gradient": {"width": 0.6, "bottom": 0.8, "angle": -225, "alpha_start": 60, "alpha_range": 80},
+    "panel": {
+        "width": 1300, "padding": 60, "radius": 50, "blur": 25, "tint": 10,
+        "extra_height": 200, "top_margin": 120, "bottom_margin": 100, "outline": [255, 255, 255, 100],
+    },
+    "title": {"size": 60, "bold": True, "upper": True, "line_height": 65, "max_lines": 3,
+              "shadow": 4, "color": [255, 255, 255], "gap": 30},
+    "episode": {"size": 36, "bold": True, "label": "QISM {episode}", "height": 45,
+                "shadow": 3, "color": [255, 255, 255], "gap": 20},
+    "desc": {"size": 24, "bold": False, "line_height": 30, "reserve_line_height": 40, "max_lines": 8,
+             "shadow": 1, "color": [220, 220, 220], "gap": 30},
+    "button": {"text": "TOMOSHA QILISH", "size": 20, "start_color": None, "end_color": [220, 20, 60], "radius": 30},
+    "genres": {
+        "x": 100, "y": 60, "size": 28, "gap": 100, "count": 3,
+        "placeholder": "YO'Q", "fallback": ["ACTION", "DRAMA", "FANTASY"],
+        "styles": [
+            {"color": [255, 215, 0], "stroke": [139, 69, 19], "stroke_width": 2},
+            {"color": [255, 255, 255], "stroke": [0, 0, 0], "stroke_width": 1},
+            {"color": [200, 200, 200], "stroke": None, "stroke_width": 0},
+        ],
+    },
+}
+
+CANVAS_SIZE = (1920, 1080)  # DEFAULT_LAYOUT koordinatalari shu kanvas piksellarida
+
+# Chiqish o'lchami profillari. Telegram rasmni baribir ~1280px gacha kichraytiradi,
+# 720p ~2.25 barobar kam piksel chizadi; geometriya balandlik nisbatida masshtablanadi.
+# preview - adminga tasdiqlash uchun qoralama (1080p ning chorak o'lchami, ~15-50 ms).
+RENDER_PROFILES = {"preview": (480, 270), "720p": (1280, 720), "1080p": (1920, 1080)}
+DEFAULT_PROFILE = "1080p"
+PREVIEW_PROFILE = "preview"
+# Piksel o'lchamlari (butun son bo'lsa masshtablanadi); ulushlar, ranglar, sonlar o'zgarmaydi
+SCALED_KEYS = frozenset({
+    "width", "padding", "radius", "blur", "extra_height", "top_margin", "bottom_margin",
+    "size", "line_height", "reserve_line_height", "height", "shadow", "gap", "x", "y", "stroke_width",
+})
+
+# Bitta render ishchi xotirasi cho'qqisi, RGBA kadrlar sonida (bench_render.py stages "xotira" ustuni:
+# 1080p ~24 MB, 720p ~11 MB). Batch da asos kadr butun ish davomida saqlanadi - yana bitta kadr.
+RENDER_FRAME_COPIES = 3
+
+def estimate_render_bytes(profile: str = DEFAULT_PROFILE, batch: bool = False) -> int:
+    """Render pool xotira byudjeti uchun bitta ishning taxminiy xotirasi (bayt)"""
+    width, height = RENDER_PROFILES[profile]
+    return width * height * 4 * (RENDER_FRAME_COPIES + (1 if batch else 0))
+
+def scale_layout(spec, factor: float):
+    """Layout piksel qiymatlarini factor ga ko'paytiradi (0 dan katta qiymat kamida 1 bo'lib qoladi)"""
+    if isinstance(spec, dict):
+        return {
+            key: (max(1, round(value * factor)) if value else 0)
+            if key in SCALED_KEYS and isinstance(value, int) and not isinstance(value, bool)
+            else scale_layout(value, factor)
+            for key, value in spec.items()
+        }
+    if isinstance(spec, list):
+        return [scale_layout(item, factor) for item in spec]
+    return spec
+
+# Son qiymatlar chegaralari (CANVAS_SIZE piksellarida, masshtablashdan oldin): avval to'liq yo'l, keyin kalit nomi.
+# Chegaradan tashqari qiymatlar render paytida IndexError, ko'rinmas matn yoki ulkan massivlarga olib keladi.
+LAYOUT_LIMITS = {
+    "crop_shift": (0, 0.9),
+    "gradient.width": (0.05, 1), "gradient.bottom": (0, 1), "gradient.angle": (-360, 360),
+    "gradient.alpha_start": (0, 255), "gradient.alpha_range": (-255, 255),
+    "panel.width": (200, CANVAS_SIZE[0]), "panel.padding": (0, 300), "panel.blur": (0, 100),
+    "panel.tint": (0, 255), "genres.x": (0, CANVAS_SIZE[0]), "genres.gap": (0, CANVAS_SIZE[0]),
+    "size": (8, 200), "line_height": (8, 300), "reserve_line_height": (8, 300), "height": (8, 300),
+    "max_lines": (1, 20), "shadow": (0, 20), "gap": (0, 500), "radius": (0, 500), "stroke_width": (0, 20),
+    "extra_height": (0, CANVAS_SIZE[1]), "top_margin": (0, CANVAS_SIZE[1]), "bottom_margin": (0, CANVAS_SIZE[1]),
+    "y": (0, CANVAS_SIZE[1]), "count": (1, 10),
+}
+COLOR_KEYS = frozenset({"color", "outline", "start_color", "end_color", "stroke"})
+LAYOUT_TEXT_MAX = 60
+
+def _check_color(name: str, default, value):
+    if value is None and default is None:
+        return
+    size = len(default) if default is not None else 3
+    if not isinstance(value, list) or len(value) != size \
+            or not all(isinstance(c, int) and not isinstance(c, bool) and 0 <= c <= 255 for c in value):
+        raise ValueError(f"{name} {size} ta 0-255 butun sondan iborat ro'yxat bo'lishi kerak")
+
+def _check_layout_value(name: str, key: str, default, value):
+    """Bitta (dict bo'lmagan) qiymatni tekshiradi; ro'yxatlar elementlari bilan"""
+    if key in COLOR_KEYS:
+        _check_color(name, default, value)
+    elif isinstance(default, str):
+        if not isinstance(value, str) or not value.strip() or len(value) > LAYOUT_TEXT_MAX:
+            raise ValueError(f"{name} 1-{LAYOUT_TEXT_MAX} belgili matn bo'lishi kerak")
+        if key == "label":
+            try:
+                value.format(episode=1)
+            except (KeyError, IndexError, ValueError):
+                raise ValueError(f"{name} faqat {{episode}} o'rinbosarini ishlatishi mumkin")
+    elif key == "fallback":
+        if not isinstance(value, list) or not 1 <= len(value) <= 10 \
+                or not all(isinstance(item, str) and 0 < len(item) <= LAYOUT_TEXT_MAX for item in value):
+            raise ValueError(f"{name} 1-10 ta matndan iborat ro'yxat bo'lishi kerak")
+    elif isinstance(default, (int, float)) and not isinstance(default, bool):
+        low, high = LAYOUT_LIMITS.get(name) or LAYOUT_LIMITS[key]
+        if not low <= value <= high:
+            raise ValueError(f"{name} {low} dan {high} gacha bo'lishi kerak")
+        if isinstance(default, int) and not isinstance(value, int):
+            raise ValueError(f"{name} butun son bo'lishi kerak")
+
+def merge_layout(base: dict, override: dict, path: str = "") -> dict:
+    """
+    Shablonni standart layout ustiga qo'yadi. Noma'lum kalit, noto'g'ri tur yoki chegaradan
+    tashqari qiymat (LAYOUT_LIMITS, ranglar, matnlar) - ValueError.
+    """
+    merged = dict(base)
+    for key, value in override.items():
+        if key not in base:
+            raise ValueError(f"Noma'lum layout kaliti: {path}{key}")
+        default = base[key]
+        if isinstance(default, dict):
+            if not isinstance(value, dict):
+                raise ValueError(f"{path}{key} obyekt bo'lishi kerak")
+            merged[key] = merge_layout(default, value, f"{path}{key}.")
+        elif isinstance(default, bool) and not isinstance(value, bool):
+            raise ValueError(f"{path}{key} true/false bo'lishi kerak")
+        elif isinstance(default, (int, float)) and not isinstance(default, bool) \
+                and (not isinstance(value, (int, float)) or isinstance(value, bool)):
+            raise ValueError(f"{path}{key} son bo'lishi kerak")
+        elif key == "styles":
+            # Har bir uslub birinchi standart uslub ustiga qo'yiladi
+            if not isinstance(value, list) or not 1 <= len(value) <= 10 \
+                    or not all(isinstance(item, dict) for item in value):
+                raise ValueError(f"{path}{key} 1-10 ta obyektdan iborat ro'yxat bo'lishi kerak")
+            merged[key] = [merge_layout(default[0], item, f"{path}{key}[{i}].") for i, item in enumerate(value)]
+        else:
+            _check_layout_value(f"{path}{key}", key, default, value)
+            merged[key] = value
+    return merged
+
+def check_layout(spec: dict) -> dict:
+    """Birlashtirilgan layout uchun qiymatlar orasidagi shartlar; xato bo'lsa ValueError"""
+    panel, gradient = spec["panel"], spec["gradient"]
+    if 2 * panel["padding"] >= panel["width"] - 100:
+        raise ValueError("panel.padding juda katta: matn uchun kamida 100px qolishi kerak")
+    if not 0 <= gradient["alpha_start"] + gradient["alpha_range"] <= 255:
+        raise ValueError("gradient.alpha_start + gradient.alpha_range 0 dan 255 gacha bo'lishi kerak")
+    return spec
+
+def _color(value):
+    return tuple(value) if value is not None else None
+
+class RenderPlan:
+    """
+    Kompilyatsiya qilingan layout: geometriya, fontlar va rangga bog'liq bo'lmagan
+    statik qatlamlar (gradient maskasi va masofa maydoni, tugma o'lchamlari) oldindan tayyor.
+    """
+    def __init__(self, spec: dict, canvas: tuple = CANVAS_SIZE):
+        self.spec = spec
+        self.width, self.height = canvas
+        self.scale = self.height / CANVAS_SIZE[1]
+        self.crop_shift = spec["crop_shift"]
+        title, episode, desc = spec["title"], spec["episode"], spec["desc"]
+        panel, button, genres = spec["panel"], spec["button"], spec["genres"]
+        self.panel = panel
+        self.title, self.episode, self.desc, self.button, self.genres = title, episode, desc, button, genres
+        self.title_font = load_font(title["size"], bold=title["bold"])
+        self.episode_font = load_font(episode["size"], bold=episode["bold"])
+        self.desc_font = load_font(desc["size"], bold=desc["bold"])
+        self.btn_font = load_font(button["size"], bold=True)
+        self.menu_font = load_font(genres["size"], bold=True)
+        self.text_width = panel["width"] - 2 * panel["padding"]
+        # Blur balandligini hisoblash uchun tugma zaxirasi (avvalgidek: matn balandligi + 50)
+        bbox = self.btn_font.getbbox(button["text"])
+        self.btn_reserve = bbox[3] - bbox[1] + round(50 * self.scale)
+        self.button_padding = (round(20 * self.scale), round(15 * self.scale))
+        # Chap gradient: poligon maskasi va rangsiz masofa maydoni
+        gradient = spec["gradient"]
+        self.gradient_width = int(self.width * gradient["width"])
+        self.gradient_mask = Image.new('L', (self.gradient_width, self.height), 0)
+        ImageDraw.Draw(self.gradient_mask).polygon([
+            (0, 0),
+            (self.gradient_width, 0),
+            (int(gradient["bottom"] * self.gradient_width), self.height),
+            (0, self.height)
+        ], fill=255)
+        # float64 nisbat maydoni (1080p da ~10 MB) rejada saqlanmaydi: alpha uint8 da qoladi,
+        # rang qatlami uchun gradient_layer() uni qayta hisoblaydi (~5 ms, faqat backdrop keshi o'tkazib yuborilganda)
+        ratio = diagonal_ratio(self.gradient_width, self.height, gradient["angle"])
+        self.gradient_alpha = (gradient["alpha_start"] + gradient["alpha_range"] * ratio).astype(np.uint8)
+        del ratio
+        self.title_shadow = ring_offsets(title["shadow"]) if title["shadow"] else ()
+        self.episode_shadow = ring_offsets(episode["shadow"]) if episode["shadow"] else ()
+        self.desc_shadow = ((desc["shadow"], desc["shadow"]),) if desc["shadow"] else ()
+
+    def gradient_layer(self, color: tuple) -> Image.Image:
+        """Oldindan hisoblangan masofa maydonidan rangli gradient (make_diagonal_gradient bilan bir xil)"""
+        inverse = 1 - diagonal_ratio(self.gradient_width, self.height, self.spec["gradient"]["angle"])
+        pixels = np.empty((self.height, self.gradient_width, 4), dtype=np.uint8)
+        pixels[..., 0] = color[0] * inverse
+        pixels[..., 1] = color[1] * inverse
+        pixels[..., 2] = color[2] * inverse
+        pixels[..., 3] = self.gradient_alpha
+        return Image.fromarray(pixels, "RGBA")
+
+def diagonal_ratio(width: int, height: int, angle_deg: float) -> np.ndarray:
+    """make_diagonal_gradient dagi 0..1 nisbat maydoni (rangga bog'liq emas)"""
+    angle_rad = math.radians(angle_deg)
+    center_x, center_y = width / 2, height / 2
+    max_dist = math.sqrt(width**2 + height**2) / 2
+    xs = (np.arange(width, dtype=np.float64) - center_x) * math.cos(angle_rad)
+    ys = (np.arange(height, dtype=np.float64) - center_y) * math.sin(angle_rad)
+    return np.clip((ys[:, None] + xs[None, :] + max_dist) / (2 * max_dist), 0.0, 1.0)
+
+# Har bir jarayonda keshlanadigan rejalar soni (kanal uslublari x profillar)
+PLAN_CACHE_SIZE = 8
+
+def estimate_plan_bytes(profile: str = DEFAULT_PROFILE) -> int:
+    """Bitta RenderPlan xotirasi, eng yomon holatda (gradient.width = 1): maska + alpha, ikkalasi uint8"""
+    width, height = RENDER_PROFILES[profile]
+    return 2 * width * height
+
+def worker_resident_bytes(profile: str = DEFAULT_PROFILE) -> int:
+    """Bitta ishchida renderlar orasida qoladigan xotira chegarasi: layer_cache + rejalar keshi"""
+    return LAYER_CACHE_MB * 1024 * 1024 + PLAN_CACHE_SIZE * estimate_plan_bytes(profile)
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def compile_layout(layout_json: str = "", profile: str = DEFAULT_PROFILE) -> RenderPlan:
+    """JSON shablonni profil o'lchamida bir marta RenderPlan ga aylantiradi (har bir ishchi jarayonda keshlanadi)"""
+    override = json.loads(layout_json) if layout_json else {}
+    if not isinstance(override, dict):
+        raise ValueError("Layout JSON obyekt bo'lishi kerak")
+    if profile not in RENDER_PROFILES:
+        raise ValueError(f"Noma'lum render profili: {profile}")
+    canvas = RENDER_PROFILES[profile]
+    spec = check_layout(merge_layout(DEFAULT_LAYOUT, override))
+    if canvas[1] != CANVAS_SIZE[1]:
+        spec = scale_layout(spec, canvas[1] / CANVAS_SIZE[1])
+    plan = RenderPlan(spec, canvas)
+    plan.key = (layout_json, profile)  # layer_cache kalitlarida geometriya identifikatori
+    return plan
+
+def normalize_layout(layout_json: str) -> str:
+    """Tekshiradi va kanonik ko'rinishga keltiradi (kesh kaliti uchun); xato bo'lsa ValueError"""
+    override = json.loads(layout_json) if layout_json and layout_json.strip() else {}
+    if not isinstance(override, dict):
+        raise ValueError("Layout JSON obyekt bo'lishi kerak")
+    check_layout(merge_layout(DEFAULT_LAYOUT, override))
+    return json.dumps(override, sort_keys=True, ensure_ascii=False) if override else ""
+
+class StageTimer:
+    """
+    Render bosqichlari vaqtini yig'adi: timings[bosqich] += ms (oldingi belgidan beri).
+    timings=None bo'lsa hech narsa qilmaydi - ishchidagi oddiy render uchun.
+    """
+    __slots__ = ("timings", "_last")
+
+    def __init__(self, timings: dict = None):
+        self.timings = timings
+        self._last = time.perf_counter()
+
+    def mark(self, stage: str):
+        if self.timings is None:
+            return
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + (now - self._last) * 1000
+        self._last = now
+
+def decode_reduced(source_image: Image.Image, size: tuple) -> Image.Image:
+    """
+    Posterni kanvasga yaqin o'lchamda RGB sifatida ochadi (alpha gradient bosqichigacha kerak emas).
+    JPEG: draft() DCT bosqichida 1/2, 1/4, 1/8 masshtabda dekodlaydi (natija size dan kichik emas).
+    Boshqa formatlar: kanvasdan 2+ barobar katta bo'lsa reduce() bilan butun karrali kichraytiriladi.
+    """
+    if source_image.format == "JPEG":
+        source_image.draft("RGB", size)
+    image = source_image.convert("RGB")
+    factor = min(image.width // size[0], image.height // size[1])
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image
+
+def prepare_background(image_source, plan: RenderPlan, timer: StageTimer = None) -> Image.Image:
+    """
+    Posterni ochadi, kanvas o'lchamiga moslaydi va o'ng tomondan crop_shift ulushini chapga siljitadi.
+    image_source - baytlar yoki fayl yo'li (poster_cache yoki lokal Bot API fayli).
+    """
+    timer = timer or StageTimer()
+    canvas = (plan.width, plan.height)
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        with Image.open(BytesIO(image_source)) as source_image:
+            source_size = source_image.size
+            bg_image = decode_reduced(source_image, canvas)
+    else:
+        # Fayl mmap qilinadi: dekoder sahifa keshidan o'qiydi, oraliq bufer yo'q
+        with open(image_source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with Image.open(mapped) as source_image:
+                source_size = source_image.size
+                bg_image = decode_reduced(source_image, canvas)
+    timer.mark("decode")
+    logging.info(f"✅ Asl rasm o'lchami: {source_size}, dekodlangan: {bg_image.size}")
+    # 2. RASMNI KANVASGA MOSLASHTIRISH + QIRQISH
+    if bg_image.size != canvas:
+        logging.info(f"📏 Rasm {bg_image.size} -> {canvas[0]}x{canvas[1]} ga o'zgartirilmoqda")
+        bg_image = bg_image.resize(canvas, Image.Resampling.LANCZOS)
+    # O'NG TOMONDAN QIRQISH + CHAP TOMONGA SILJITISH
+    if plan.crop_shift:
+        try:
+            cut_width = int(bg_image.width * plan.crop_shift) # 25% da 480px
+            # Aylanma siljitish: o'ngdagi cut_width chapga o'tadi, qolgani o'ngga suriladi.
+            # Bitta yangi kadr - oraliq crop nusxalari yo'q
+            bg_image = ImageChops.offset(bg_image, cut_width, 0)
+            logging.info(f"✅ Qirqish yakunlandi: {cut_width}px qirqildi va chap tomonga siljitildi")
+        except Exception as crop_error:
+            logging.warning(f"⚠️ Qirqishda xatolik: {crop_error}")
+    timer.mark("resize")
+    return bg_image
+
+def fallback_background(title: str, plan: RenderPlan) -> Image.Image:
+    """Poster yuklanmasa yoki ochilmasa ishlatiladigan kulrang fon"""
+    bg_image = Image.new("RGB", (plan.width, plan.height), (25, 25, 25))
+    draw = ImageDraw.Draw(bg_image)
+    draw.text((100, 100), f"FALLBACK: {title[:20]}...", fill=(255, 255, 255), font=plan.title_font)
+    return bg_image
+
+# Chiqish formatlari. Telegram rasmni baribir JPEG ga qayta siqadi,
+# shuning uchun standart - progressive JPEG (PNG optimize 1920x1080 da juda sekin).
+ENCODERS = {
+    "jpeg": {"format": "JPEG", "ext": "jpg", "options": {"quality": 90, "progressive": True, "subsampling": 2}},
+    "webp": {"format": "WEBP", "ext": "webp", "options": {"quality": 88, "method": 4}},
+    "png": {"format": "PNG", "ext": "png", "options": {"compress_level": 1}},
+}
+DEFAULT_ENCODER = "jpeg"
+
+def encode_image(image: Image.Image, encoder: str = DEFAULT_ENCODER) -> bytes:
+    """Yakuniy rasmni tanlangan formatda BytesIO ga kodlaydi (vaqtinchalik fayl yo'q)"""
+    spec = ENCODERS[encoder]
+    buffer = BytesIO()
+    (image if image.mode == "RGB" else image.convert("RGB")).save(buffer, format=spec["format"], **spec["options"])
+    return buffer.getvalue()
+
+def build_blur_panel(image: Image.Image, box: tuple, panel: dict) -> Image.Image:
+    """Panel ostidagi hudud: Gaussian blur + qora shaffof qatlam"""
+    blurred_region = image.crop(box).filter(ImageFilter.GaussianBlur(radius=panel["blur"]))
+    if panel["tint"]:
+        # Shaffoflik - QORA SHAFFOF
+        blurred_region = Image.alpha_composite(
+            blurred_region, Image.new('RGBA', blurred_region.size, (0, 0, 0, panel["tint"])))
+    return blurred_region
+
+def build_backdrop(image_source, title: str, plan: RenderPlan, timer: StageTimer) -> tuple:
+    """
+    Poster foni + chap gradient: (RGBA rasm, aksent rang, poster ochildimi).
+    Poster ochilmasa fallback fon ishlatiladi (bunday natija keshlanmaydi).
+    """
+    try:
+        if image_source is None:
+            raise ValueError("poster berilmagan")
+        bg_image = prepare_background(image_source, plan, timer)
+        decoded = True
+    except Exception as e:
+        logging.error(f"❌ Rasmni ochishda xatolik: {e}")
+        bg_image = fallback_background(title, plan)
+        decoded = False
+        timer.mark("decode")
+        logging.info("✅ Fallback rasm tayyor")
+    # 3. Dominant va aksent ranglar - butun poster palitrasidan
+    try:
+        palette = extract_palette(bg_image, k=6)
+        dominant_color, accent_color = pick_theme_colors(palette)
+        logging.info(f"🎨 Dominant rang: {dominant_color}, aksent: {accent_color}")
+    except Exception as e:
+        logging.warning(f"⚠️ Rang hisoblashda xatolik: {e}")
+        dominant_color = (246, 79, 89)
+        accent_color = None
+    timer.mark("palette")
+    # 4. Asosiy rasm - shu yerdan alpha kerak (gradient alpha si blur panel rangiga ta'sir qiladi)
+    final_image = bg_image.convert("RGBA")
+    del bg_image
+    # 5. Chap tomonga gradient
+    try:
+        final_image.paste(plan.gradient_layer(dominant_color), (0, 0), mask=plan.gradient_mask)
+        logging.info("🌈 Gradient qo'shildi")
+    except Exception as e:
+        logging.warning(f"⚠️ Gradientda xatolik: {e}")
+    timer.mark("gradient")
+    return final_image, accent_color, decoded
+
+def compose_card_base(image_source, title: str, desc: str, genre: str, plan: RenderPlan,
+                      timer: StageTimer = None, require_poster: bool = False) -> tuple:
+    """
+    Qismga bog'liq bo'lmagan hamma narsani chizadi: fon, gradient, blur panel, sarlavha, tavsif, tugma, janrlar.
+    (RGBA rasm, qism yozuvi koordinatasi) qaytaradi - qism yozuvi draw_episode() bilan alohida chiziladi.
+    require_poster - poster ochilmasa fallback o'rniga PosterDecodeError (natija poster kaliti bilan keshlanmasin).
+    """
+    timer = timer or StageTimer()
+    # 1-5. Fon + gradient poster va geometriya bo'yicha keshlanadi; ustiga chizish uchun nusxa olinadi
+    fingerprint = poster_fingerprint(image_source)
+    backdrop_key = ("backdrop", fingerprint, plan.key) if fingerprint else None
+    cached = layer_cache.get(backdrop_key) if backdrop_key else None
+    if cached is not None:
+        backdrop, accent_color = cached
+        final_image = backdrop.copy()
+        timer.mark("decode")
+        logging.info("📦 Fon va gradient qatlam keshidan olindi")
+    else:
+        final_image, accent_color, decoded = build_backdrop(image_source, title, plan, timer)
+        if require_poster and not decoded:
+            raise PosterDecodeError("poster ochilmadi")
+        if decoded and backdrop_key:
+            layer_cache.put(backdrop_key, (final_image.copy(), accent_color))
+        else:
+            # Fallback fon ustidagi qatlamlar keshlanmaydi
+            backdrop_key = None
+    # 6. MATN O'LCHAMLARI VA BLUR PANEL
+    panel = plan.panel
+    title_text = title.upper() if plan.title["upper"] else title
+    title_layout = layout_text(title_text, plan.title_font, plan.text_width,
+                               plan.title["line_height"], max_lines=plan.title["max_lines"])
+    desc_layout = layout_text(desc, plan.desc_font, plan.text_width,
+                              plan.desc["line_height"], max_lines=plan.desc["max_lines"])
+    timer.mark("text")
+    total_text_height = (title_layout.height + plan.episode["height"]
+                         + len(desc_layout.lines) * plan.desc["reserve_line_height"] + plan.btn_reserve)
+    blur_width = min(panel["width"], plan.width)
+    blur_height = min(total_text_height + panel["extra_height"], plan.height)
+    # Markazga, keyin pastdan va tepadan minimal bo'sh joy
+    blur_x = (plan.width - blur_width) // 2
+    blur_y = (plan.height - blur_height) // 2
+    if blur_y + blur_height > plan.height - panel["bottom_margin"]:
+        blur_y = plan.height - blur_height - panel["bottom_margin"]
+    blur_y = max(blur_y, panel["top_margin"])
+    blur_height = min(blur_height, plan.height - blur_y)
+    logging.info(f"📐 Blur region: {blur_width}x{blur_height} ({blur_x}, {blur_y}), matn {total_text_height}px")
+    box = (blur_x, blur_y, blur_x + blur_width, blur_y + blur_height)
+    draw = ImageDraw.Draw(final_image)
+    try:
+        # Panel fon ustidan olinadi (matn hali chizilmagan) - poster + geometriya + box bo'yicha keshlanadi
+        blurred_region = layer_cache.get_or_build(
+            ("panel", backdrop_key, box) if backdrop_key else None,
+            lambda: build_blur_panel(final_image, box, panel))
+        final_image.paste(blurred_region, box[:2], rounded_mask(blur_width, blur_height, panel["radius"]))
+        draw.rounded_rectangle(box, radius=panel["radius"], outline=_color(panel["outline"]), width=1)
+    except Exception as blur_error:
+        logging.warning(f"⚠️ Blur jarayonida xatolik: {blur_error}")
+        # Fallback - qora fon
+        draw.rounded_rectangle(box, radius=panel["radius"], fill=(0, 0, 0, 180))
+    timer.mark("blur")
+    caption_x = blur_x + panel["padding"]
+    current_y = blur_y + panel["padding"]
+    # 7-8. SARLAVHA - bitta maska + soya
+    try:
+        if title_layout.lines:
+            draw_text_block(final_image, (caption_x, current_y), title_layout.lines, plan.title_font,
+                            title_layout.line_height, fill=_color(plan.title["color"]) + (255,),
+                            shadow_offsets=plan.title_shadow)
+        current_y += title_layout.height + plan.title["gap"]
+        logging.info(f"✅ Sarlavha yozildi: {len(title_layout.lines)} qator")
+    except Exception as e:
+        logging.warning(f"⚠️ Sarlavhada xatolik: {e}")
+        current_y += 100
+    # 9. EPISODE - joyi band qilinadi, matni draw_episode() da (qism bo'yicha yagona farq)
+    episode_xy = (caption_x, current_y)
+    current_y += plan.episode["height"] + plan.episode["gap"]
+    # 10. TAVSIF
+    try:
+        if desc_layout.lines:
+            draw_text_block(final_image, (caption_x, current_y), desc_layout.lines, plan.desc_font,
+                            desc_layout.line_height, fill=_color(plan.desc["color"]) + (255,),
+                            shadow_offsets=plan.desc_shadow)
+        current_y += desc_layout.height + plan.desc["gap"]
+        logging.info(f"✅ Tavsif yozildi: {len(desc_layout.lines)} qator")
+    except Exception as e:
+        logging.warning(f"⚠️ Tavsif xatosi: {e}")
+        current_y += 150
+    # 11. TUGMA - tayyor sprite keshdan olinadi
+    try:
+        button = plan.button
+        start_color = _color(button["start_color"]) or accent_color
+        sprite_args = {"end_color": _color(button["end_color"]), "radius": button["radius"]}
+        if start_color:
+            sprite_args["start_color"] = start_color
+        sprite_args["padding_x"], sprite_args["padding_y"] = plan.button_padding
+        btn_sprite = build_button_sprite(button["text"], button["size"], **sprite_args)
+        final_image.paste(btn_sprite, (caption_x, current_y), btn_sprite)
+        logging.info(f"✅ Tugma qo'shildi: {btn_sprite.width - 1}x{btn_sprite.height - 1}px")
+    except Exception as e:
+        logging.warning(f"⚠️ Tugma xatosi: {e}")
+    # 12. JANR MENYUSI
+    genres = plan.genres
+    try:
+        names = [g.strip().upper() for g in genre.split(',')] if genre else list(genres["fallback"])
+        count = genres["count"]
+        items = names[:count] if len(names) >= count else (names + [genres["placeholder"]] * count)[:count]
+        sprite_xy, layers = layer_cache.get_or_build(
+            ("genres", tuple(items), plan.key), lambda: build_genre_sprite(tuple(items), plan))
+        for color, mask in layers:
+            final_image.paste(color, sprite_xy, mask)
+        logging.info(f"✅ Janrlar qo'shildi: {items}")
+    except Exception as e:
+        logging.warning(f"⚠️ Janrlar xatosi: {e}")
+    timer.mark("text")
+    return final_image, episode_xy
+
+def build_genre_sprite(items: tuple, plan: RenderPlan) -> tuple:
+    """
+    Janr yozuvlari maskalari: ((x, y), [(rang, maska), ...]) - har bir janr uchun soya, kontur va matn.
+    image.paste(rang, xy, maska) draw.text bilan piksel-piksel bir xil natija beradi.
+    """
+    genres = plan.genres
+    font = plan.menu_font
+    # Soya, kontur va ascender uchun tepada va pastda shrift o'lchamicha zaxira
+    top = genres["y"] - genres["size"]
+    strip = (plan.width, genres["size"] * 3)
+    measure = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+    def ink(xy, item, **stroke):
+        mask = Image.new("L", strip, 0)
+        ImageDraw.Draw(mask).text((xy[0], xy[1] - top), item, fill=255, font=font, **stroke)
+        return mask
+
+    layers = []
+    menu_x = genres["x"]
+    for i, item in enumerate(items):
+        style = genres["styles"][min(i, len(genres["styles"]) - 1)]
+        bbox = measure.textbbox((0, 0), item, font=font)
+        # Soya
+        layers.append(((0, 0, 0, 150), ink((menu_x + 2, genres["y"] + 2), item)))
+        # Kontur, keyin asosiy matn (draw.text stroke bilan xuddi shu tartibda chizadi)
+        if style["stroke_width"]:
+            layers.append((_color(style["stroke"]) + (255,),
+                           ink((menu_x, genres["y"]), item, stroke_width=style["stroke_width"], stroke_fill=255)))
+        layers.append((_color(style["color"]) + (255,), ink((menu_x, genres["y"]), item)))
+        menu_x += bbox[2] - bbox[0] + genres["gap"]
+    boxes = [mask.getbbox() for _, mask in layers if mask.getbbox()]
+    if not boxes:
+        return (0, 0), []
+    box = (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+    return (box[0], top + box[1]), [(color, mask.crop(box)) for color, mask in layers]
+
+def draw_episode(image: Image.Image, xy: tuple, episode_num: int, plan: RenderPlan):
+    """Qism yozuvini compose_card_base() qoldirgan joyga chizadi"""
+    try:
+        episode_text = plan.episode["label"].format(episode=episode_num)
+        draw_text_block(image, xy, [episode_text], plan.episode_font,
+                        plan.episode["height"], fill=_color(plan.episode["color"]) + (255,),
+                        shadow_offsets=plan.episode_shadow)
+        logging.info(f"✅ Episode yozildi: {episode_text}")
+    except Exception as e:
+        logging.warning(f"⚠️ Episode xatosi: {e}")
+
+def render_post_image(image_source, title: str, desc: str, genre: str, episode_num: int,
+                      encoder: str = DEFAULT_ENCODER, layout: str = "", profile: str = DEFAULT_PROFILE,
+                      timings: dict = None, require_poster: bool = False) -> bytes:
+    """
+    Post rasmini to'liq chizadi va ENCODERS[encoder] formatidagi baytlarni qaytaradi.
+    ProcessPoolExecutor ishchisida chaqiriladi: argumentlar va natija pickle qilinadi.
+    image_source - poster baytlari, lokal fayl yo'li yoki None (fallback fon).
+    layout - normalize_layout() dan o'tgan JSON ("" - standart uslub).
+    profile - RENDER_PROFILES kaliti (chiqish o'lchami).
+    timings - berilsa, bosqichlar vaqti (ms) shu lug'atga yoziladi (bench_render.py uchun).
+    require_poster - poster ochilmasa PosterDecodeError (bot natijani poster kaliti bilan keshlaydi).
+    """
+    timer = StageTimer(timings)
+    plan = compile_layout(layout, profile)
+    timer.mark("plan")
+    final_image, episode_xy = compose_card_base(image_source, title, desc, genre, plan, timer, require_poster)
+    draw_episode(final_image, episode_xy, episode_num, plan)
+    timer.mark("text")
+    # 13. KODLASH - RGBA kadr kodlashdan oldin bo'shatiladi (ikkalasi bir vaqtda xotirada turmaydi)
+    final_image = final_image.convert("RGB")
+    data = encode_image(final_image, encoder)
+    timer.mark("encode")
+    logging.info(f"💾 Rasm kodlandi: {len(data)} bytes")
+    return data
+
+def render_post_batch(image_source, title: str, desc: str, genre: str, episode_nums: list,
+                      encoder: str = DEFAULT_ENCODER, layout: str = "", profile: str = DEFAULT_PROFILE,
+                      require_poster: bool = False) -> list:
+    """
+    Bir nechta qism uchun kartalar: poster bir marta ochiladi, fon/gradient/blur/matnlar bir marta chiziladi,
+    har bir qism uchun faqat asos nusxasiga qism yozuvi qo'shiladi va kodlanadi.
+    Natija episode_nums tartibidagi baytlar ro'yxati. require_poster - render_post_image() dagidek.
+    """
+    plan = compile_layout(layout, profile)
+    base, episode_xy = compose_card_base(image_source, title, desc, genre, plan, require_poster=require_poster)
+    results = []
+    for episode_num in episode_nums:
+        card = base.copy()
+        draw_episode(card, episode_xy, episode_num, plan)
+        card = card.convert("RGB")
+        results.append(encode_image(card, encoder))
+        del card
+    logging.info(f"💾 {len(results)} ta qism kartasi kodlandi")
+    return results